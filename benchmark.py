@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+# Benchmarks of the hot paths of the scripts, on deterministic synthetic
+# fixtures, so that the effect of a change can be measured without any
+# downloaded data or pretrained model:
+#
+#   - label maps of panoramic and non-panoramic shapes, drawn as a simple
+#     street scene (road, pavements, buildings, sky) in Cityscapes labels,
+#   - JPEG images rendered from those label maps, with noise,
+#   - GeoJSON tiles (as cached by mapillary_jpg_download.py) and Mapbox vector
+#     tiles (as served by Mapillary) with image points,
+#   - a grid of street lines with points along them (as make_street_points.py),
+#   - a tiny randomly initialised Mask2Former model, for segmentation throughput.
+#
+# Each benchmark is timed with timeit: the number of calls per measurement is
+# chosen to take at least --min-time seconds, and the best and median of
+# --repeat measurements are reported, per call. The results can be saved as
+# JSON (--output), along with the commit and library versions, and compared
+# with the results of another run (--compare), e.g. from before a change.
+#
+# Benchmarks whose optional dependencies (e.g. geopandas, mapbox_vector_tile)
+# are not installed are recorded as skipped.
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import tempfile
+import timeit
+from pathlib import Path
+from time import strftime
+import numpy as np
+import cv2
+
+parser = argparse.ArgumentParser(prog='benchmark.py', description='Benchmark the hot paths on synthetic fixtures')
+parser.add_argument('names', metavar='NAME', nargs='*', help='Only run the benchmarks whose names contain one of these strings (default: all)')
+parser.add_argument('--list', '-l', action='store_true', default=False, help='List the benchmarks and exit')
+parser.add_argument('--output', '-o', metavar='FILE', default=None, help='Save the results as JSON in FILE')
+parser.add_argument('--compare', '-c', metavar='FILE', default=None, help='Compare the results with those saved in FILE by an earlier run')
+parser.add_argument('--repeat', '-r', metavar='N', default=5, type=int, help='Number of measurements of each benchmark (default: 5)')
+parser.add_argument('--min-time', metavar='SECONDS', default=0.2, type=float, help='Minimum duration of each measurement (default: 0.2)')
+parser.add_argument('--threshold', metavar='FRACTION', default=0.1, type=float, help='With --compare, flag changes in the median time larger than this fraction (default: 0.1)')
+parser.add_argument('--verbose', '-v', action='store_true', default=False, help='Run in verbose mode')
+
+seed = 1234
+
+# Cityscapes labels used in the synthetic scenes
+ROAD, SIDEWALK, BUILDING, VEGETATION, SKY, CAR = 0, 1, 2, 8, 10, 13
+
+# Shapes (height, width) of the label maps: those produced by
+# torch_segm_images.py with the default scaling down by 4 of a 5760x2880
+# panorama (cropped to its top 3/4) and of a 4000x3000 photo, and those of
+# the full-resolution images.
+pano_shape = (540, 1440)
+photo_shape = (750, 1000)
+pano_image_shape = (2880, 5760)
+photo_image_shape = (3000, 4000)
+
+##################################################
+# Fixtures
+
+# A street scene: sky above buildings, and a road (with pavements) running
+# from the bottom edge to a vanishing point on the horizon, at each of the
+# given columns, with some noise. Panoramas see the road both ahead and behind.
+def synthetic_label_map(shape, vps, rng):
+    h, w = shape
+    # drawn in 8 bits (as OpenCV requires), but returned as int64 like the
+    # label maps of torch_segm_images.py
+    labels = np.full(shape, BUILDING, dtype=np.uint8)
+    horizon = h // 2
+    labels[:horizon - h // 8] = SKY
+    for vp in vps:
+        half = w // (3 * len(vps))
+        pavement = [ (vp, horizon), (vp - 2 * half, h), (vp + 2 * half, h) ]
+        road = [ (vp, horizon), (vp - half, h), (vp + half, h) ]
+        cv2.fillPoly(labels, [ np.array(pavement, np.int32) ], SIDEWALK)
+        cv2.fillPoly(labels, [ np.array(road, np.int32) ], ROAD)
+    for _ in range(8):
+        x, y = rng.integers(0, w), rng.integers(horizon, h)
+        cv2.ellipse(labels, (int(x), int(y)), (w // 60, h // 40), 0, 0, 360, CAR, -1)
+        x = rng.integers(0, w)
+        cv2.circle(labels, (int(x), horizon - h // 8), h // 12, VEGETATION, -1)
+    return labels.astype(np.int64)
+
+def pano_label_map(rng):
+    return synthetic_label_map(pano_shape, [ pano_shape[1] // 4, pano_shape[1] * 3 // 4 ], rng)
+
+def photo_label_map(rng):
+    return synthetic_label_map(photo_shape, [ photo_shape[1] // 2 ], rng)
+
+# An image (BGR) of the given shape rendered from a label map, with noise
+def synthetic_image(labels, shape, rng):
+    palette = rng.integers(40, 220, size=(labels.max() + 1, 3), dtype=np.uint8)
+    img = cv2.resize(palette[labels], (shape[1], shape[0]), interpolation=cv2.INTER_NEAREST)
+    noise = rng.normal(0, 12, size=(shape[0] // 8, shape[1] // 8, 3)).astype(np.float32)
+    img = np.clip(img + cv2.resize(noise, (shape[1], shape[0])), 0, 255).astype(np.uint8)
+    return img
+
+def write_jpeg(path, img):
+    ok, data = cv2.imencode('.jpg', img, [ cv2.IMWRITE_JPEG_QUALITY, 90 ])
+    Path(path).write_bytes(data.tobytes())
+
+# GeoJSON features of image points (as in the tiles cached by
+# mapillary_jpg_download.py), with the given image IDs, within a zoom-14 tile
+def tile_features(tilex, tiley, imgids, rng):
+    import mercantile
+    b = mercantile.bounds(tilex, tiley, 14)
+    return [ { 'type': 'Feature',
+               'geometry': { 'type': 'Point', 'coordinates': [ float(rng.uniform(b.west, b.east)), float(rng.uniform(b.south, b.north)) ] },
+               'properties': { 'id': int(imgid), 'sequence_id': f'seq{imgid // 100}', 'compass_angle': float(rng.uniform(0, 360)),
+                               'is_pano': bool(imgid % 5 == 0), 'captured_at': 1700000000000 + int(imgid) } }
+             for imgid in imgids ]
+
+def write_tiles(tiledir, ntiles, perTile, rng, firstid=1000):
+    os.makedirs(tiledir, exist_ok=True)
+    for i in range(ntiles):
+        tilex, tiley = 8414 + i % 16, 5384 + i // 16
+        imgids = range(firstid + i * perTile, firstid + (i + 1) * perTile)
+        with open(Path(tiledir) / f'mly1_public_{tilex}_{tiley}_14', 'w') as fp:
+            json.dump({ 'type': 'FeatureCollection', 'features': tile_features(tilex, tiley, imgids, rng) }, fp)
+
+# The fixtures are created on first use, in a temporary directory
+class Fixtures:
+    def __init__(self, tmpdir):
+        self.dir = Path(tmpdir)
+        self.cache = {}
+
+    def get(self, name, make):
+        if name not in self.cache:
+            self.cache[name] = make(np.random.default_rng(seed))
+        return self.cache[name]
+
+##################################################
+# Benchmarks
+
+benchmarks = {}
+
+# Registers a benchmark function, which is given the fixtures, does any
+# (untimed) set-up, and returns the function to time along with a dict of
+# parameters describing the workload. Import errors are reported as skips.
+def benchmark(name):
+    def register(f):
+        benchmarks[name] = f
+        return f
+    return register
+
+@benchmark('road_centres/pano')
+def bench_road_centres_pano(fx):
+    from torch_process_segm import road_centres
+    labels = fx.get('pano_labels', pano_label_map)
+    plus = np.append(labels, labels[:, :labels.shape[1] // 4], axis=1)
+    distance, prominence = int(2000 * labels.shape[1] // 5760), int(100 * labels.shape[0] // 2880)
+    return (lambda: road_centres(plus, distance=distance, prominence=prominence)), { 'shape': plus.shape }
+
+@benchmark('road_centres/photo')
+def bench_road_centres_photo(fx):
+    from torch_process_segm import road_centres
+    labels = fx.get('photo_labels', photo_label_map)
+    distance, prominence = int(2000 * labels.shape[1] // 5760), int(100 * labels.shape[0] // 2880)
+    return (lambda: road_centres(labels, distance=distance, prominence=prominence)), { 'shape': labels.shape }
+
+@benchmark('crop_panoramic_image')
+def bench_crop_panoramic_image(fx):
+    from torch_process_segm import crop_panoramic_image
+    labels = fx.get('pano_labels', pano_label_map)
+    img = fx.get('pano_image', lambda rng: synthetic_image(labels, pano_image_shape, rng))
+    centres = np.array([ labels.shape[1] // 4, labels.shape[1] * 3 // 4, labels.shape[1] + 10 ])
+    # the crops are views or copies; copying them all out is part of the work
+    def run():
+        subimages, subsegms, infos = crop_panoramic_image(img[:, :, ::-1], labels, centres)
+        return [ np.ascontiguousarray(s) for s in subimages ]
+    return run, { 'image_shape': img.shape, 'shape': labels.shape, 'crops': len(centres) }
+
+@benchmark('compute_hdr')
+def bench_compute_hdr(fx):
+    from image_metrics import compute_hdr
+    labels = fx.get('photo_labels', photo_label_map)
+    img = fx.get('photo_image', lambda rng: synthetic_image(labels, photo_image_shape, rng))
+    return (lambda: compute_hdr(img)), { 'image_shape': img.shape }
+
+@benchmark('image_metrics/full')
+def bench_image_metrics(fx):
+    from image_metrics import image_metrics
+    labels = fx.get('photo_labels', photo_label_map)
+    img = fx.get('photo_image', lambda rng: synthetic_image(labels, photo_image_shape, rng))
+    return (lambda: image_metrics(img)), { 'image_shape': img.shape }
+
+@benchmark('image_metrics/quality_only')
+def bench_image_metrics_quality(fx):
+    from image_metrics import image_metrics
+    labels = fx.get('photo_labels', photo_label_map)
+    img = fx.get('photo_image', lambda rng: synthetic_image(labels, photo_image_shape, rng))
+    return (lambda: image_metrics(img, quality_only=True)), { 'image_shape': img.shape }
+
+@benchmark('decode/pano')
+def bench_decode_pano(fx):
+    from torch_process_segm import DecodedImage
+    labels = fx.get('pano_labels', pano_label_map)
+    path = fx.dir / 'pano.jpg'
+    if not path.exists():
+        write_jpeg(path, fx.get('pano_image', lambda rng: synthetic_image(labels, pano_image_shape, rng)))
+    return (lambda: DecodedImage(path)), { 'image_shape': pano_image_shape, 'bytes': path.stat().st_size }
+
+@benchmark('decode/photo_reduced4')
+def bench_decode_reduced(fx):
+    from torch_process_segm import DecodedImage
+    labels = fx.get('photo_labels', photo_label_map)
+    path = fx.dir / 'photo.jpg'
+    if not path.exists():
+        write_jpeg(path, fx.get('photo_image', lambda rng: synthetic_image(labels, photo_image_shape, rng)))
+    return (lambda: DecodedImage(path, reduce=4)), { 'image_shape': photo_image_shape, 'reduce': 4 }
+
+@benchmark('render_masks_lut/pano')
+def bench_render_masks(fx):
+    from torch_process_segm import render_masks_lut
+    labels = fx.get('pano_labels', pano_label_map)
+    plus = np.append(labels, labels[:, :labels.shape[1] // 4], axis=1)
+    img = fx.get('pano_image', lambda rng: synthetic_image(labels, pano_image_shape, rng))
+    base = cv2.resize(img, (labels.shape[1], labels.shape[0]))[:, :, ::-1]
+    base = np.append(base, base[:, :base.shape[1] // 4], axis=1)
+    colors = [ '#804080', '#f423e8', '#464646', '#66669c', '#be9999', '#999999', '#faaa1e', '#dcdc00', '#6b8e23',
+               '#98fb98', '#4682b4', '#dc143c', '#ff0000', '#00008e', '#000046', '#003c64', '#005064', '#0000e6', '#770b20' ]
+    return (lambda: render_masks_lut(plus, base, colors, 0.5)), { 'shape': plus.shape }
+
+@benchmark('tiles/geojson')
+def bench_tiles_geojson(fx):
+    import torch_process_segm
+    tiledir = fx.dir / 'tiles'
+    if not tiledir.exists():
+        write_tiles(tiledir, 32, 500, np.random.default_rng(seed))
+    args = torch_process_segm.parser.parse_args([ '-T', str(tiledir) ])
+    return (lambda: torch_process_segm.setup(args, lambda s: None)), { 'tiles': 32, 'features_per_tile': 500 }
+
+@benchmark('tiles/mvt')
+def bench_tiles_mvt(fx):
+    import mapbox_vector_tile
+    from vt2geojson.tools import vt_bytes_to_geojson
+    rng = np.random.default_rng(seed)
+    # tile-local coordinates (extent 4096), as served by Mapillary
+    features = [ { 'geometry': f'POINT({int(rng.integers(0, 4096))} {int(rng.integers(0, 4096))})',
+                   'properties': { 'id': 1000 + i, 'sequence_id': f'seq{i // 100}', 'compass_angle': float(rng.uniform(0, 360)),
+                                   'is_pano': bool(i % 5 == 0), 'captured_at': 1700000000000 + i } }
+                 for i in range(2000) ]
+    data = mapbox_vector_tile.encode([ { 'name': 'image', 'features': features } ])
+    return (lambda: vt_bytes_to_geojson(data, 8414, 5384, 14, layer='image')), { 'features': len(features), 'bytes': len(data) }
+
+@benchmark('street_points/deduplicate')
+def bench_deduplicate(fx):
+    import geopandas as gpd
+    from shapely.geometry import Point
+    from make_street_points import fast_deduplicate_points
+    # a 2km x 2km grid of streets 100m apart, with points every 10m (in the
+    # Dutch RD New coordinates, EPSG:28992)
+    xs = np.arange(120000, 122001, 100)
+    ts = np.arange(0, 2001, 10)
+    points = [ Point(x, 487000 + t) for x in xs for t in ts ] + [ Point(120000 + t, 487000 + y - 120000) for y in xs for t in ts ]
+    gdf = gpd.GeoDataFrame(geometry=points, crs=28992).to_crs(4326)
+    return (lambda: fast_deduplicate_points(gdf, 50, 28992)), { 'points': len(points) }
+
+@benchmark('process_file/fast')
+def bench_process_fast(fx):
+    return process_file_benchmark(fx, [ '--fast' ])
+
+@benchmark('process_file/full')
+def bench_process_full(fx):
+    return process_file_benchmark(fx, [ '-m', '-o' ])
+
+# torch_process_segm.py on a panoramic label map and its image, as a whole
+def process_file_benchmark(fx, extra):
+    import torch_process_segm
+    labels = fx.get('pano_labels', pano_label_map)
+    tiledir = fx.dir / 'tiles-process'
+    workdir = fx.dir / 'process'
+    if not workdir.exists():
+        os.makedirs(workdir)
+        write_tiles(tiledir, 1, 10, np.random.default_rng(seed), firstid=5000)
+        np.savez_compressed(workdir / '5000.npz', predict=labels, modelname='synthetic_citys')
+        write_jpeg(workdir / '5000.jpg', fx.get('pano_image', lambda rng: synthetic_image(labels, pano_image_shape, rng)))
+    args = torch_process_segm.parser.parse_args([ '-T', str(tiledir), '-O', '-S', str(fx.dir / 'sql'), *extra ])
+    proc = torch_process_segm.setup(args, lambda s: None)
+    return (lambda: proc.do_file(workdir / '5000.npz')), { 'shape': labels.shape, 'image_shape': pano_image_shape, 'args': extra }
+
+# A tiny randomly initialised Mask2Former model, saved in the fixtures directory
+def tiny_model(fx):
+    modeldir = fx.dir / 'tiny-mask2former'
+    if not modeldir.exists():
+        import torch
+        from transformers import Mask2FormerConfig, Mask2FormerForUniversalSegmentation, Mask2FormerImageProcessor, SwinConfig
+        torch.manual_seed(seed)
+        backbone = SwinConfig(embed_dim=16, depths=[1, 1, 1, 1], num_heads=[1, 1, 1, 1], window_size=4,
+                              out_features=[ 'stage1', 'stage2', 'stage3', 'stage4' ])
+        config = Mask2FormerConfig(backbone_config=backbone, hidden_dim=32, feature_size=32, mask_feature_size=32, num_queries=10,
+                                   encoder_layers=1, decoder_layers=2, encoder_feedforward_dim=64, dim_feedforward=64,
+                                   num_attention_heads=2, num_labels=19)
+        config.id2label = { i: str(i) for i in range(19) }
+        config.label2id = { str(i): i for i in range(19) }
+        Mask2FormerForUniversalSegmentation(config).save_pretrained(modeldir)
+        Mask2FormerImageProcessor(size={ 'shortest_edge': 384, 'longest_edge': 1536 }).save_pretrained(modeldir)
+    return modeldir
+
+@benchmark('segment/tiny_model')
+def bench_segment(fx):
+    import torch_segm_images
+    from PIL import Image
+    modeldir = tiny_model(fx)
+    labels = fx.get('photo_labels', photo_label_map)
+    img = fx.get('photo_image', lambda rng: synthetic_image(labels, photo_image_shape, rng))
+    args = torch_segm_images.parser.parse_args([ '--modelname', str(modeldir), 'unused.jpg' ])
+    seg = torch_segm_images.setup(args, lambda s: None)
+    small = Image.fromarray(cv2.resize(img, (photo_shape[1], photo_shape[0]))[:, :, ::-1])
+    return (lambda: seg.segment([ small ])), { 'image_shape': photo_shape }
+
+##################################################
+
+def environment():
+    def version(module):
+        try:
+            return __import__(module).__version__
+        except Exception:
+            return None
+    try:
+        commit = subprocess.run([ 'git', 'rev-parse', 'HEAD' ], capture_output=True, text=True, cwd=Path(__file__).parent).stdout.strip() or None
+        dirty = bool(subprocess.run([ 'git', 'status', '--porcelain', '--untracked-files=no' ], capture_output=True, text=True,
+                                    cwd=Path(__file__).parent).stdout.strip())
+    except OSError:
+        commit, dirty = None, None
+    return { 'commit': commit, 'dirty': dirty, 'time': strftime('%Y-%m-%dT%H:%M:%S%z'), 'host': socket.gethostname(),
+             'python': platform.python_version(), 'platform': platform.platform(), 'cpus': len(os.sched_getaffinity(0)),
+             'versions': { m: version(m) for m in [ 'numpy', 'cv2', 'scipy', 'torch', 'transformers' ] } }
+
+def compare(old, new, threshold):
+    print(f'\n{"benchmark":<30} {"before":>12} {"after":>12} {"ratio":>7}')
+    for name in sorted(set(old) | set(new)):
+        o, n = old.get(name, {}), new.get(name, {})
+        if 'median' not in o or 'median' not in n:
+            print(f'{name:<30} {fmt(o.get("median")):>12} {fmt(n.get("median")):>12}')
+            continue
+        ratio = n['median'] / o['median']
+        flag = ' slower' if ratio > 1 + threshold else ' faster' if ratio < 1 / (1 + threshold) else ''
+        print(f'{name:<30} {fmt(o["median"]):>12} {fmt(n["median"]):>12} {ratio:7.2f}{flag}')
+
+def fmt(t):
+    if t is None: return '-'
+    if t < 1e-3: return f'{t*1e6:.1f}us'
+    if t < 1: return f'{t*1e3:.2f}ms'
+    return f'{t:.3f}s'
+
+def main():
+    args = parser.parse_args()
+    def vlog(s):
+        if args.verbose:
+            print(s, flush=True)
+
+    selected = [ n for n in benchmarks if not args.names or any(s in n for s in args.names) ]
+    if args.list:
+        print('\n'.join(selected))
+        return
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='benchmark-') as tmpdir:
+        fx = Fixtures(tmpdir)
+        print(f'{"benchmark":<30} {"best":>12} {"median":>12} {"calls":>7}')
+        for name in selected:
+            try:
+                vlog(f'Setting up {name}...')
+                fn, params = benchmarks[name](fx)
+            except ImportError as e:
+                results[name] = { 'skipped': f'missing dependency: {e.name}' }
+                print(f'{name:<30} skipped (missing dependency: {e.name})')
+                continue
+            fn() # warm-up, e.g. for lazily-initialised state
+            timer = timeit.Timer(fn)
+            number = 1
+            while True:
+                t = timer.timeit(number)
+                if t >= args.min_time: break
+                number *= 2 if t <= 0 else max(2, min(10, int(args.min_time / t) + 1))
+            times = [ t / number for t in timer.repeat(args.repeat, number) ]
+            results[name] = { 'params': json.loads(json.dumps(params, default=str)), 'number': number, 'times': times,
+                              'best': min(times), 'median': float(np.median(times)), 'mean': float(np.mean(times)) }
+            print(f'{name:<30} {fmt(min(times)):>12} {fmt(float(np.median(times))):>12} {number:7d}', flush=True)
+
+    if args.output is not None:
+        with open(args.output, 'w') as fp:
+            json.dump({ 'environment': environment(), 'seed': seed, 'benchmarks': results }, fp, indent=2)
+        vlog(f'Saved results to "{args.output}".')
+    if args.compare is not None:
+        with open(args.compare) as fp:
+            old = json.load(fp)
+        compare(old['benchmarks'], results, args.threshold)
+
+if __name__=='__main__':
+    main()
+
+# vim: ai sw=4 sts=4 ts=4 et
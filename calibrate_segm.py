@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# Calibrate the speed and accuracy of segmentation settings.
+#
+# --scaledown-factor and --scaledown-interp of torch_segm_images.py (and the
+# choice between segmenting whole images or in tiles, --tile-size and
+# --tile-stitch) decide most of the cost of segmentation, but also how much
+# the outcome changes. This script segments a sample of images with every
+# combination of the given scaling down factors, interpolations and
+# 'backends' (whole: the whole image at once; tiled: in --tile-size tiles
+# blending the class probabilities; tiled-labels: in tiles keeping the most
+# confident label), measuring the time per image (decoding, scaling down and
+# inference) and the peak memory used, and compares the label maps with those
+# of a reference setting:
+#
+#   miou      mean intersection over union of the classes, with the label
+#             maps scaled up (nearest neighbour) to the size of the reference
+#   road      intersection over union of the road class alone
+#   centres   fraction of images with as many road centres (as found by
+#             torch_process_segm.py) as in the reference, and the mean
+#             distance of the reference centres from the nearest one found,
+#             as a percentage of the image width
+#   accept    fraction of images for which filter_output.py would make the
+#             same decision as with the reference (the image quality scores
+#             do not depend on the segmentation, but the road check does)
+#
+# The results are printed as a table sorted by time per image, in which the
+# settings on the Pareto front (those that no other setting beats on time
+# per image, mean IoU and accept agreement at once) are marked with '*', and
+# can also be written out as JSON lines with the measurements of every image.
+#
+# Each setting is run in its own child process (forked once the model has
+# been loaded), so that its peak memory is measured on its own (as the rise
+# of the peak resident size, which can only be reset on Linux, so it is
+# given as n/a elsewhere); with --gpu, the settings are run one after another
+# in this process instead, and the peak memory is that allocated on the GPU.
+import argparse
+import json
+import random
+import multiprocessing as mp
+from itertools import product
+from time import perf_counter
+from types import SimpleNamespace
+import numpy as np
+from PIL import Image
+from image_metrics import prescreen_image, quality_accept
+
+parser = argparse.ArgumentParser(prog='calibrate_segm.py', description='Measure the time per image, peak memory and agreement with a reference setting of segmentation over a grid of scaling down factors, interpolations and backends')
+parser.add_argument('paths', metavar='PATH', nargs='+', help='Image files or directories to sample from (or filelists, see -F)')
+parser.add_argument('--verbose', '-v', action='store_true', default=False, help='Run in verbose mode')
+parser.add_argument('--filelist', '-F', action='store_true', default=False, help='Supplied paths are actually lists of image filenames, one per line (a path of - reads the list from standard input)')
+parser.add_argument('--recursive', '-r', action='store_true', default=False, help='Recursively search for images in the given directories and subdirectories (only if -F not enabled)')
+parser.add_argument('--image-extensions', '-e', metavar='EXT', nargs='+', default=['jpg', 'jpeg'], help='Image filename extensions to consider (default: jpg jpeg). Case-insensitive.')
+parser.add_argument('--exclusion-pattern', '-E', metavar='REGEX', default='.*(npz|mask|over|out|_x[0-9]+).*', help='Regex to indicate which files should be excluded (default: label maps, masks, overlays, logs and crops)')
+parser.add_argument('--sample', '-n', metavar='N', default=20, type=int, help='Calibrate on a random sample of N of the images (default: 20; 0 means all of them)')
+parser.add_argument('--seed', metavar='N', default=0, type=int, help='Random seed for the sample (default: 0)')
+parser.add_argument('--factors', metavar='LIST', default='2,4,6,8', help='Comma-separated scaling down factors (default: 2,4,6,8)')
+parser.add_argument('--interps', metavar='LIST', default='BICUBIC,BILINEAR,NEAREST', help='Comma-separated interpolation methods, by name or number as --scaledown-interp of torch_segm_images.py (default: BICUBIC,BILINEAR,NEAREST)')
+parser.add_argument('--backends', metavar='LIST', default='whole', help='Comma-separated backends: whole, tiled, tiled-labels (default: whole)')
+parser.add_argument('--reference', metavar='FACTOR,INTERP,BACKEND', default=None, help='Setting to compare the others with (default: the smallest factor, with the first interpolation and backend)')
+parser.add_argument('--tile-size', metavar='PX', default=512, type=int, help='Tile size of the tiled backends (default: 512)')
+parser.add_argument('--tile-overlap', metavar='PX', default=64, type=int, help='Tile overlap of the tiled backends (default: 64)')
+parser.add_argument('--modelname', metavar='MODEL', help='Use a specified model (from https://huggingface.co/models?search=mask2former)', default="facebook/mask2former-swin-large-cityscapes-semantic")
+parser.add_argument('--gpu', '-G', metavar='N', nargs='?', default=None, const=True, help='Use GPU (optionally specify which one)')
+parser.add_argument('--contrast-threshold', '-C', metavar='NUMBER', default=0.35, type=float, help='Minimum contrast as in filter_output.py (default: 0.35)')
+parser.add_argument('--tone-mapping-floor', metavar='NUMBER', default=0.8, type=float, help='Tone mapping floor as in filter_output.py (default: 0.8)')
+parser.add_argument('--disable-road-check', action='store_true', default=False, help='As filter_output.py, do not reject images that lack exactly one road')
+parser.add_argument('--output', '-o', metavar='FILE', default=None, help='Also write the results of each setting, with the measurements of every image, to FILE as JSON lines')
+
+interp_names = { 'NEAREST': 0, 'LANCZOS': 1, 'BILINEAR': 2, 'BICUBIC': 3, 'BOX': 4, 'HAMMING': 5 }
+interp_numbers = { v: k for k, v in interp_names.items() }
+backends = [ 'whole', 'tiled', 'tiled-labels' ]
+
+def parse_interp(s):
+    s = s.strip()
+    if s.upper() in interp_names:
+        return interp_names[s.upper()]
+    if s.isdigit() and int(s) in interp_numbers:
+        return int(s)
+    parser.error(f'unknown interpolation method "{s}"')
+
+def parse_backend(s):
+    s = s.strip()
+    if s not in backends:
+        parser.error(f'unknown backend "{s}" (one of {", ".join(backends)})')
+    return s
+
+def setting_name(setting):
+    factor, interp, backend = setting
+    return f'x{factor:g} {interp_numbers[interp]} {backend}'
+
+# Peak resident memory of this process (in bytes) since the last call of
+# reset_peak_memory, from /proc/self/status, or None where not available
+def peak_memory():
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+# Reset the peak resident memory to the current resident size, and return
+# it as read straight afterwards (to measure the peak from), or None if it
+# cannot be reset. (The only other measure, ru_maxrss, cannot be reset, so
+# it would include the memory of loading the model, and is not used.)
+def reset_peak_memory():
+    try:
+        with open('/proc/self/clear_refs', 'w') as fp:
+            fp.write('5')
+    except OSError:
+        return None
+    return peak_memory()
+
+# Road centres of a label map, as torch_process_segm.py finds them, as
+# fractions of the width of the image
+def centres_of(predict):
+    from torch_process_segm import road_centres, road_peaks_params
+    is_pano = predict.shape[1] >= predict.shape[0] * 2
+    distance, prominence = road_peaks_params(predict.shape)
+    centres = road_centres(predict, distance=distance, prominence=prominence, plus=is_pano)
+    # (kept as found, as their number is what filter_output.py checks, but
+    # those found in the appended quarter are moved to the lefthand side)
+    return (centres % predict.shape[1]) / predict.shape[1], is_pano
+
+# Mean distance of each reference centre from the nearest of the given
+# centres (as fractions of the width, wrapping around for panoramic images),
+# or None if either has none
+def centre_error(refcentres, centres, is_pano):
+    if len(refcentres) == 0 or len(centres) == 0:
+        return None
+    d = np.abs(refcentres[:, None] - centres[None, :])
+    if is_pano:
+        d = np.minimum(d, 1 - d)
+    return float(d.min(axis=1).mean())
+
+# Mean IoU over the classes present in either label map, and IoU of the
+# road class (0), of a label map against the reference
+def label_iou(ref, predict):
+    if predict.shape != ref.shape:
+        predict = np.asarray(Image.fromarray(predict).resize(ref.shape[::-1], resample=Image.NEAREST))
+    n = int(max(ref.max(), predict.max())) + 1
+    # confusion matrix of the reference and given labels
+    confusion = np.bincount(ref.ravel().astype(np.int64) * n + predict.ravel(), minlength=n*n).reshape(n, n)
+    inter = np.diag(confusion)
+    union = confusion.sum(axis=0) + confusion.sum(axis=1) - inter
+    present = union > 0
+    ious = inter[present] / union[present]
+    road = inter[0] / union[0] if union[0] > 0 else 1.0
+    return float(ious.mean()), float(road)
+
+# Set by main() before forking the child process of each setting
+pool_seg = None
+pool_segargs = None
+pool_sample = None
+
+# Segment the sample with the given setting, returning the label maps, the
+# time taken on each image, and the peak memory used (or None if it cannot
+# be measured)
+def run_setting(setting):
+    import torch
+    factor, interp, backend = setting
+    # segment() reads the tile options from the arguments given to setup()
+    pool_segargs.tile_size = 0 if backend == 'whole' else pool_segargs.calibrate_tile_size
+    pool_segargs.tile_stitch = 'labels' if backend == 'tiled-labels' else 'logits'
+    opts = SimpleNamespace(**{ **vars(pool_segargs), 'scaledown_factor': factor, 'scaledown_interp': interp })
+    gpu = pool_segargs.gpu is not None and torch.cuda.is_available()
+    # (untimed) warm-up on the first image, so that one-off initialisation
+    # (e.g. of the thread pools) is not counted against this setting
+    pool_seg.segment([ pool_seg.load_image(pool_sample[0], opts) ])
+    if gpu:
+        torch.cuda.reset_peak_memory_stats()
+    else:
+        baseline = reset_peak_memory()
+    predicts = []
+    times = []
+    for path in pool_sample:
+        t0 = perf_counter()
+        img = pool_seg.load_image(path, opts)
+        [predict] = pool_seg.segment([img])
+        times.append(perf_counter() - t0)
+        # (the class numbers of the models used fit in a byte)
+        predicts.append(predict.astype(np.uint8))
+    if gpu:
+        peak = torch.cuda.max_memory_allocated()
+    else:
+        # (None if not measurable; the resident size may also have shrunk
+        # below the baseline, if memory was given back)
+        hwm = peak_memory()
+        peak = max(0, hwm - baseline) if baseline is not None and hwm is not None else None
+    return predicts, times, peak
+
+def main():
+    args = parser.parse_args()
+    def vlog(s):
+        if args.verbose:
+            print(s, flush=True)
+
+    factors = [ float(f) for f in args.factors.split(',') ]
+    interps = [ parse_interp(s) for s in args.interps.split(',') ]
+    backendlist = [ parse_backend(s) for s in args.backends.split(',') ]
+    if args.reference is not None:
+        try:
+            f, i, b = args.reference.split(',')
+            reference = (float(f), parse_interp(i), parse_backend(b))
+        except ValueError:
+            parser.error('--reference must be of the form FACTOR,INTERP,BACKEND')
+    else:
+        reference = (min(factors), interps[0], backendlist[0])
+    settings = [ reference ] + [ s for s in product(factors, interps, backendlist) if s != reference ]
+
+    # for iter_inputs
+    args.shard = None
+    import torch_segm_images
+    inputs = list(torch_segm_images.iter_inputs(args))
+    if not inputs:
+        parser.error('no images found')
+    if args.sample > 0 and len(inputs) > args.sample:
+        inputs = sorted(random.Random(args.seed).sample(inputs, args.sample))
+    vlog(f'Calibrating on {len(inputs)} image(s), {len(settings)} setting(s); reference: {setting_name(reference)}.')
+
+    # the quality half of the decisions of filter_output.py
+    quality_ok = []
+    for path in inputs:
+        contrast, tone_mapping = prescreen_image(path, 1)
+        quality_ok.append(bool(quality_accept(contrast, tone_mapping, args.contrast_threshold, args.tone_mapping_floor)))
+
+    segargs = torch_segm_images.parser.parse_args([ '--modelname', args.modelname, *([ '--gpu' ] if args.gpu is True else [ '--gpu', args.gpu ] if args.gpu else []) ])
+    segargs.calibrate_tile_size = args.tile_size
+    segargs.tile_overlap = args.tile_overlap
+    import instrument
+    global pool_seg, pool_segargs, pool_sample
+    pool_seg = torch_segm_images.setup(segargs, lambda s: None, instr=instrument.Instrument('calibrate_segm.py'))
+    pool_segargs = segargs
+    pool_sample = inputs
+
+    def run(setting):
+        if args.gpu is not None:
+            return run_setting(setting)
+        # a fresh child process per setting, for its peak memory
+        with mp.get_context('fork').Pool(1) as pool:
+            return pool.apply(run_setting, (setting,))
+
+    results = []
+    refpredicts = None
+    refcentres = None
+    outfp = open(args.output, 'w') if args.output is not None else None
+    for setting in settings:
+        vlog(f'Running {setting_name(setting)}...')
+        predicts, times, peak = run(setting)
+        centres = [ centres_of(p) for p in predicts ]
+        road_ok = [ len(c) == 1 for c, _ in centres ]
+        accepts = [ q and (r or args.disable_road_check) for q, r in zip(quality_ok, road_ok) ]
+        if refpredicts is None:
+            refpredicts, refcentres, refaccepts = predicts, centres, accepts
+        images = []
+        for i, path in enumerate(inputs):
+            miou, roadiou = label_iou(refpredicts[i], predicts[i])
+            err = centre_error(refcentres[i][0], centres[i][0], centres[i][1])
+            images.append({ 'path': str(path), 'time': times[i], 'shape': list(predicts[i].shape), 'miou': miou, 'road_iou': roadiou,
+                            'centres': centres[i][0].tolist(), 'centre_error': err, 'same_centre_count': len(centres[i][0]) == len(refcentres[i][0]),
+                            'accept': accepts[i], 'same_accept': accepts[i] == refaccepts[i] })
+        errs = [ im['centre_error'] for im in images if im['centre_error'] is not None ]
+        result = { 'setting': setting_name(setting), 'scaledown_factor': setting[0], 'scaledown_interp': setting[1], 'backend': setting[2],
+                   'reference': setting == reference, 'time_per_image': float(np.mean(times)), 'peak_memory': None if peak is None else int(peak),
+                   'miou': float(np.mean([ im['miou'] for im in images ])), 'road_iou': float(np.mean([ im['road_iou'] for im in images ])),
+                   'same_centre_count': float(np.mean([ im['same_centre_count'] for im in images ])),
+                   'centre_error': float(np.mean(errs)) if errs else None,
+                   'accept_agreement': float(np.mean([ im['same_accept'] for im in images ])),
+                   'accepted': int(sum(accepts)) }
+        vlog(f'{result["setting"]}: {result["time_per_image"]:.3f}s per image, mean IoU {result["miou"]:.3f}, accept agreement {result["accept_agreement"]:.3f}.')
+        results.append(result)
+        if outfp is not None:
+            outfp.write(json.dumps({ **result, 'images': images }) + '\n')
+            outfp.flush()
+    if outfp is not None:
+        outfp.close()
+
+    # A setting is on the Pareto front unless another is at least as good on
+    # time per image, mean IoU and accept agreement, and better on one of them
+    def dominates(a, b):
+        better_or_equal = a['time_per_image'] <= b['time_per_image'] and a['miou'] >= b['miou'] and a['accept_agreement'] >= b['accept_agreement']
+        better = a['time_per_image'] < b['time_per_image'] or a['miou'] > b['miou'] or a['accept_agreement'] > b['accept_agreement']
+        return better_or_equal and better
+    for r in results:
+        r['pareto'] = not any(dominates(o, r) for o in results if o is not r)
+
+    memunit = 'GPU MB' if args.gpu is not None else 'MB'
+    print(f'Reference: {setting_name(reference)}; {len(inputs)} image(s), of which {sum(refaccepts)} accepted by filter_output.py.')
+    print(f'  {"setting":<26} {"s/image":>8} {"peak " + memunit:>11} {"mIoU":>6} {"road":>6} {"centres":>8} {"err %w":>7} {"accept":>7}')
+    for r in sorted(results, key=lambda r: r['time_per_image']):
+        err = f'{100*r["centre_error"]:7.2f}' if r['centre_error'] is not None else f'{"-":>7}'
+        peak = f'{r["peak_memory"]/1e6:11.0f}' if r['peak_memory'] is not None else f'{"n/a":>11}'
+        print(f'{"*" if r["pareto"] else " "} {r["setting"] + (" (ref)" if r["reference"] else ""):<26} {r["time_per_image"]:8.3f} {peak}'
+              f' {r["miou"]:6.3f} {r["road_iou"]:6.3f} {r["same_centre_count"]:8.3f} {err} {r["accept_agreement"]:7.3f}')
+    if any(r['peak_memory'] is None for r in results):
+        print('(peak n/a: the peak resident memory cannot be reset here, as it needs /proc/self/clear_refs (Linux))')
+
+if __name__=='__main__':
+    main()
+
+# vim: ai sw=4 sts=4 ts=4 et
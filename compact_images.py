@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# Free up disk space by compacting the original images once they have been
+# segmented and post-processed.
+#
+# Most of the space taken by a region goes to the full-resolution originals
+# downloaded by mapillary_jpg_download.py, which torch_segm_images.py scales
+# down (by --scaledown-factor, 4 by default) before segmentation anyway, and
+# which torch_process_segm.py only needs at full resolution for the crops.
+# Once an image is complete (its label map exists, as well as its panoramic
+# crops, and its successful post-processing is recorded in one of the
+# --processed metrics files, as the image metrics are computed from the image
+# itself; done-filelists are not accepted, as they list failed inputs too),
+# it is replaced by a 'working copy': the same image re-encoded at 1/--scale
+# of its resolution, under the same filename. The original is moved into
+# the --archive directory, if given (with --scale 1, it is only moved, and a
+# symbolic link to it is left in its place).
+#
+# The later stages read the working copy transparently: it is marked with a
+# JPEG comment giving its scale, from which torch_segm_images.py adjusts its
+# --scaledown-factor so that the label maps keep the same size, and
+# torch_process_segm.py works at whatever resolution the image has (the crops
+# and overlays simply come out smaller).
+#
+# Every image compacted is recorded in the --manifest (JSON lines), with its
+# original size and the location of the original. It is safe to interrupt at
+# any point: the working copy is written under a temporary name, the original
+# is archived (copied under a temporary name and then renamed) before being
+# replaced, and the working copy is then renamed over it in one step. Running
+# again skips the images already compacted (recognised by their JPEG comment
+# or symbolic link).
+import argparse
+import os
+import shutil
+import sys
+import multiprocessing as mp
+from pathlib import Path
+from time import time
+from PIL import Image
+from metrics_io import append_rows, read_rows
+from segm_store import SegmStore
+
+parser = argparse.ArgumentParser(prog='compact_images.py', description='Replace segmented and processed original images with reduced-resolution working copies, optionally archiving the originals')
+parser.add_argument('paths', metavar='PATH', nargs='+', help='Image files or directories to compact (or filelists, see -F)')
+parser.add_argument('--verbose', '-v', action='store_true', default=False, help='Run in verbose mode')
+parser.add_argument('--filelist', '-F', action='store_true', default=False, help='Supplied paths are actually lists of image filenames, one per line (a path of - reads the list from standard input)')
+parser.add_argument('--recursive', '-r', action='store_true', default=False, help='Recursively search for images in the given directories and subdirectories (only if -F not enabled)')
+parser.add_argument('--image-extensions', '-e', metavar='EXT', nargs='+', default=['jpg', 'jpeg'], help='Image filename extensions to consider (default: jpg jpeg). Case-insensitive.')
+parser.add_argument('--exclusion-pattern', '-E', metavar='REGEX', default='.*(npz|mask|over|out|_x[0-9]+).*', help='Regex to indicate which files should be excluded (default: label maps, masks, overlays, logs and crops)')
+parser.add_argument('--scale', '-s', metavar='N', default=4, type=int, help='Scale the working copies down by a factor of N (default: 4, as torch_segm_images.py --scaledown-factor); 1 means only archiving the originals')
+parser.add_argument('--quality', metavar='Q', default=90, type=int, help='JPEG quality of the working copies (default: 90)')
+parser.add_argument('--archive', metavar='DIR', default=None, help='Move the originals into DIR, keeping their paths relative to --root (by default, their sequence directory and filename)')
+parser.add_argument('--root', metavar='DIR', default=None, help='With --archive, the directory (e.g. the --seqdir of mapillary_jpg_download.py) relative to which the paths of the originals are kept')
+parser.add_argument('--discard-originals', action='store_true', default=False, help='Without --archive, delete the originals once replaced by their working copies')
+parser.add_argument('--manifest', metavar='FILE', required=True, help='Record each image compacted in FILE, as JSON lines')
+parser.add_argument('--store', metavar='DIR', default=None, help='Look for the label maps in the sharded store DIR (see segm_store.py) rather than as .npz/.npy files next to the images')
+parser.add_argument('--output-extension', metavar='EXT', default=None, help='Filename extension of the label maps, as torch_segm_images.py --output-extension (default: npz or npy)')
+parser.add_argument('--cropsdir', metavar='DIR', default=None, help='Directory where torch_process_segm.py --cropsdir wrote the crops of panoramic images (default: next to the images)')
+parser.add_argument('--processed', metavar='FILE', nargs='+', default=None, help='Only compact the images that appear in the metrics file FILE (.jsonl, by torch_process_segm.py --metrics-file, which only has the images processed successfully; done-filelists, which also list the inputs that failed, are not accepted); required with --scale above 1, as the metrics of an image compacted before its post-processing would be computed on its working copy')
+parser.add_argument('--jobs', '-j', metavar='N', default=1, type=int, help='Compact the images in N parallel worker processes (default: 1)')
+parser.add_argument('--dry-run', action='store_true', default=False, help='Only report which images would be compacted')
+
+# Prefix of the JPEG comment marking a working copy
+comment_prefix = b'compact_images.py scale='
+
+# The scale of a working copy written by this script, given as a PIL image
+# or a filename, or 1 if it is an original (or a link to an archived one)
+def working_copy_scale(img):
+    if not isinstance(img, Image.Image):
+        with Image.open(img) as i:
+            return working_copy_scale(i)
+    comment = img.info.get('comment', b'')
+    if comment.startswith(comment_prefix):
+        try:
+            return int(comment[len(comment_prefix):].split()[0])
+        except (ValueError, IndexError):
+            pass
+    return 1
+
+# Whether the image has already been compacted
+def is_compacted(path):
+    return path.is_symlink() or working_copy_scale(path) > 1
+
+# The image IDs (filename stems) of the images processed successfully,
+# according to the given --processed metrics files
+def read_processed(filenames):
+    stems = set()
+    for filename in filenames:
+        stems.update(str(row['imgid']) for row in read_rows(filename, kind='image') if row.get('status', 'ok') == 'ok')
+    return stems
+
+# Set by main() before forking the worker processes of --jobs
+pool_compact = None
+
+def pool_task(path):
+    try:
+        return pool_compact(path)
+    except Exception as e:
+        return { 'path': str(path), 'status': 'failed', 'error': str(e) }
+
+def main():
+    args = parser.parse_args()
+    def vlog(s):
+        if args.verbose:
+            print(s, flush=True)
+
+    if args.scale < 1:
+        parser.error('--scale must be at least 1')
+    if args.archive is None and args.scale == 1:
+        parser.error('--scale 1 (only archiving) requires --archive')
+    if args.archive is None and not args.discard_originals:
+        parser.error('either --archive or --discard-originals is required, to say what becomes of the originals')
+    # (a label map alone does not mean that the image metrics, which
+    # torch_process_segm.py computes from the image, have been computed)
+    if args.processed is None and args.scale > 1:
+        parser.error('--processed is required with --scale above 1, to only compact the images already post-processed')
+    for filename in args.processed or []:
+        if not filename.endswith('.jsonl'):
+            parser.error(f'--processed "{filename}" is not a metrics file (.jsonl): done-filelists also list the inputs that failed')
+
+    # for iter_inputs
+    args.shard = None
+
+    store = SegmStore(args.store) if args.store is not None else None
+    processed = read_processed(args.processed) if args.processed is not None else None
+    extensions = [ args.output_extension ] if args.output_extension is not None else [ 'npz', 'npy' ]
+
+    # The reason why the image is not (yet) to be compacted, or None if it is
+    def incomplete(path, img):
+        stem = path.stem
+        if store is not None:
+            if stem not in store:
+                return 'no label map'
+        elif not any(path.with_suffix(f'.{ext}').exists() for ext in extensions):
+            return 'no label map'
+        if processed is not None and stem not in processed:
+            return 'not processed'
+        # panoramic images (as detected by torch_segm_images.py) are cropped
+        if img.size[0] >= img.size[1] * 2:
+            cropsdir = Path(args.cropsdir) if args.cropsdir is not None else path.parent
+            if not any(cropsdir.glob(f'{stem}_x*.jpg')):
+                return 'no crops'
+        return None
+
+    def archive_path(path):
+        if args.root is not None:
+            rel = path.resolve().relative_to(Path(args.root).resolve())
+        else:
+            rel = Path(path.parent.name) / path.name
+        return Path(args.archive) / rel
+
+    # Link or copy the original into the archive (under a temporary name
+    # first, so that an interrupted copy is never mistaken for a complete one)
+    def archive(path):
+        dest = archive_path(path)
+        os.makedirs(dest.parent, exist_ok=True)
+        tmp = dest.with_name(f'.{dest.name}.{os.getpid()}.tmp')
+        try:
+            os.link(path, tmp)
+        except OSError:
+            # e.g. the archive is on another filesystem
+            shutil.copy2(path, tmp)
+        os.replace(tmp, dest)
+        return dest
+
+    def compact(path):
+        path = Path(path)
+        if is_compacted(path):
+            return { 'path': str(path), 'status': 'already' }
+        with Image.open(path) as img:
+            reason = incomplete(path, img)
+            if reason is not None:
+                return { 'path': str(path), 'status': 'skipped', 'reason': reason }
+            row = { 'path': str(path), 'time': time(), 'scale': args.scale, 'original_size': list(img.size),
+                    'original_bytes': path.stat().st_size, 'archive': None }
+            if args.dry_run:
+                return { **row, 'status': 'dry-run' }
+            if args.scale > 1:
+                size = (img.size[0] // args.scale, img.size[1] // args.scale)
+                # let the JPEG decoder do most of the scaling down
+                img.draft('RGB', size)
+                exif = img.info.get('exif')
+                small = img.convert('RGB').resize(size, resample=Image.BICUBIC)
+                tmp = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+                small.save(tmp, 'JPEG', quality=args.quality, comment=comment_prefix + str(args.scale).encode(),
+                           **({ 'exif': exif } if exif else {}))
+                row.update(size=list(size), bytes=tmp.stat().st_size, quality=args.quality)
+        if args.scale > 1:
+            if args.archive is not None:
+                row['archive'] = str(archive(path))
+        else:
+            row.update(archive=str(archive(path)), bytes=0)
+            tmp = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+            os.symlink(Path(row['archive']).resolve(), tmp)
+        # recorded before the original is replaced (in one step), so that
+        # every image compacted is in the manifest, even if interrupted
+        append_rows(args.manifest, [ row ])
+        os.replace(tmp, path)
+        return { **row, 'status': 'compacted' }
+
+    def record(result):
+        if result['status'] == 'compacted':
+            vlog(f'Compacted "{result["path"]}": {result["original_bytes"]} -> {result["bytes"]} bytes' +
+                 (f', original archived as "{result["archive"]}"' if result['archive'] else '') + '.')
+        elif result['status'] == 'failed':
+            print(f'Failed to compact "{result["path"]}": {result["error"]}', file=sys.stderr)
+        else:
+            vlog(f'{result["status"].capitalize()}: "{result["path"]}"' + (f' ({result["reason"]})' if 'reason' in result else '') + '.')
+
+    counts = {}
+    # bytes of the originals replaced, and of their working copies
+    original_bytes = 0
+    working_bytes = 0
+    def tally(result):
+        nonlocal original_bytes, working_bytes
+        record(result)
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+        if result['status'] in ('compacted', 'dry-run'):
+            original_bytes += result['original_bytes']
+            working_bytes += result.get('bytes', 0)
+
+    # imported here, as torch_segm_images.py imports this module
+    from torch_segm_images import iter_inputs
+    global pool_compact
+    pool_compact = compact
+    t1 = time()
+    if args.jobs <= 1:
+        for path in iter_inputs(args):
+            tally(pool_task(path))
+    else:
+        with mp.get_context('fork').Pool(args.jobs) as pool:
+            for result in pool.imap_unordered(pool_task, iter_inputs(args), chunksize=4):
+                tally(result)
+    t2 = time()
+    summary = f'{sum(counts.values())} image(s) in {t2-t1:.1f}s: ' + ', '.join(f'{n} {status}' for status, n in sorted(counts.items()))
+    if args.dry_run:
+        summary += f'; {original_bytes/1e6:.1f}MB of originals would be replaced.'
+    else:
+        summary += f'; {original_bytes/1e6:.1f}MB of originals replaced by {working_bytes/1e6:.1f}MB of working copies.'
+    print(summary)
+
+if __name__=='__main__':
+    main()
+
+# vim: ai sw=4 sts=4 ts=4 et
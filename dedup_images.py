@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# Skip near-duplicate images before segmentation.
+#
+# Stationary or slow-moving capture leaves runs of near-identical frames in a
+# sequence directory (seqdir/<sequence_id>/ as written by
+# mapillary_jpg_download.py), each of which would otherwise cost a full pass
+# of the segmentation model. This script computes a perceptual hash of every
+# image from a scaled-down decode (the JPEG decoder itself scales the image
+# down by 8, so this is fast), clusters the images of each sequence whose
+# hashes differ in at most --threshold bits, and writes a filelist holding
+# one representative image per cluster, for 'torch_segm_images.py -F'.
+#
+# The hashes are kept in a cache directory (see result_cache.py), keyed on the
+# identity of each image file (path, size and modification time), so that
+# running again after more images have been downloaded only hashes the new
+# ones.
+#
+# Hashes:
+#   phash   the signs of the lowest 8x8 frequencies of the discrete cosine
+#           transform of the 32x32 greyscale image, relative to their median
+#           (robust to small shifts, changes of exposure and JPEG noise)
+#   ahash   the pixels of the 8x8 greyscale image, relative to their mean
+#           (faster, but more easily fooled by changes of exposure)
+import argparse
+import json
+import multiprocessing as mp
+from pathlib import Path
+from time import time
+import numpy as np
+from PIL import Image
+from scipy.fft import dctn
+from result_cache import ResultCache, file_identity
+
+parser = argparse.ArgumentParser(prog='dedup_images.py', description='Cluster near-duplicate images within each sequence by perceptual hash, and list one image per cluster for segmentation')
+parser.add_argument('paths', metavar='PATH', nargs='+', help='Image files or directories (or filelists, see -F)')
+parser.add_argument('--verbose', '-v', action='store_true', default=False, help='Run in verbose mode')
+parser.add_argument('--filelist', '-F', action='store_true', default=False, help='Supplied paths are actually lists of image filenames, one per line (a path of - reads the list from standard input)')
+parser.add_argument('--recursive', '-r', action='store_true', default=False, help='Recursively search for images in the given directories and subdirectories (only if -F not enabled)')
+parser.add_argument('--image-extensions', '-e', metavar='EXT', nargs='+', default=['jpg', 'jpeg'], help='Image filename extensions to consider (default: jpg jpeg). Case-insensitive.')
+parser.add_argument('--exclusion-pattern', '-E', metavar='REGEX', default='.*(npz|mask|over|out|_x[0-9]+).*', help='Regex to indicate which files should be excluded (default: label maps, masks, overlays, logs and crops)')
+parser.add_argument('--output', '-o', metavar='FILE', required=True, help='Write the representative image of each cluster to FILE, one filename per line (for torch_segm_images.py -F)')
+parser.add_argument('--clusters', metavar='FILE', default=None, help='Also write each cluster to FILE as a JSON line, with its representative image, its members and their distances from it in bits')
+parser.add_argument('--hash', choices=['phash', 'ahash'], default='phash', help='Perceptual hash to use (default: phash)')
+parser.add_argument('--threshold', '-t', metavar='BITS', default=6, type=int, help='Images whose hashes differ from the representative of a cluster in at most BITS of their 64 bits join that cluster (default: 6)')
+parser.add_argument('--cache-dir', metavar='DIR', default=None, help='Cache the hashes in DIR, and reuse them when run again on unchanged images')
+parser.add_argument('--cache-size-mb', metavar='MB', default=256, type=int, help='Size budget of the cache (see --cache-dir) (default: 256)')
+parser.add_argument('--jobs', '-j', metavar='N', default=1, type=int, help='Hash the images in N parallel worker processes (default: 1)')
+
+# 64-bit perceptual hash of an image file, as an unsigned integer
+def image_hash(path, method='phash'):
+    size = 32 if method == 'phash' else 8
+    with Image.open(path) as img:
+        # decoded at 1/8 of the resolution (or as close as possible above
+        # that), then reduced to the hash size by averaging
+        img.draft('L', (img.size[0] // 8, img.size[1] // 8))
+        small = np.asarray(img.convert('L').resize((size, size), resample=Image.BOX), dtype=np.float64)
+    if method == 'phash':
+        low = dctn(small, norm='ortho')[:8, :8].ravel()
+        # the DC coefficient (the mean brightness) is left out of the median
+        bits = low > np.median(low[1:])
+    else:
+        bits = small.ravel() > small.mean()
+    return int(np.packbits(bits).view('>u8')[0])
+
+# Greedy 'leader' clustering of one sequence: each image (in the given order)
+# joins the cluster of the closest representative within threshold bits, or
+# else becomes the representative of a new cluster. Comparing with the
+# representatives, rather than with any member, stops slow drift across a
+# long run of frames from chaining them all into one cluster. Returns a list
+# of (representative, [(member, distance), ...]).
+def cluster(hashes, threshold):
+    reps = []
+    repvalues = np.zeros(0, dtype=np.uint64)
+    clusters = []
+    for path, h in hashes:
+        if len(reps) > 0:
+            # bit counts of the XORs with every representative at once
+            x = np.bitwise_xor(repvalues, np.uint64(h))
+            dists = np.unpackbits(x.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+            best = int(dists.argmin())
+            if dists[best] <= threshold:
+                clusters[best][1].append((path, int(dists[best])))
+                continue
+        reps.append(path)
+        repvalues = np.append(repvalues, np.uint64(h))
+        clusters.append((path, [ (path, 0) ]))
+    return clusters
+
+# Set by main() before forking the worker processes of --jobs
+pool_hash_method = None
+
+def pool_task(path):
+    try:
+        return path, image_hash(path, pool_hash_method), None
+    except Exception as e:
+        return path, None, str(e)
+
+def main():
+    args = parser.parse_args()
+    def vlog(s):
+        if args.verbose:
+            print(s, flush=True)
+
+    # for iter_inputs
+    args.shard = None
+    from torch_segm_images import iter_inputs
+
+    cache = None
+    if args.cache_dir is not None:
+        cache = ResultCache(args.cache_dir, max_bytes=args.cache_size_mb << 20)
+
+    t1 = time()
+    # images grouped by sequence (directory)
+    sequences = {}
+    hashes = {}
+    failed = []
+    tohash = []
+    for path in iter_inputs(args):
+        sequences.setdefault(str(path.parent), []).append(path)
+        if cache is not None:
+            key = cache.key(args.hash, image=file_identity(path))
+            h = cache.get(key)
+            if h is not None:
+                hashes[path] = int(h, 16)
+                continue
+        tohash.append(path)
+    vlog(f'Found {sum(len(ps) for ps in sequences.values())} image(s) in {len(sequences)} sequence(s); '
+         f'{len(hashes)} hash(es) found in the cache, {len(tohash)} to compute.')
+
+    global pool_hash_method
+    pool_hash_method = args.hash
+    if args.jobs <= 1:
+        results = map(pool_task, tohash)
+    else:
+        pool = mp.get_context('fork').Pool(args.jobs)
+        results = pool.imap(pool_task, tohash, chunksize=16)
+    for path, h, error in results:
+        if h is None:
+            vlog(f'Failed to hash "{path}": {error}. Keeping it.')
+            failed.append(path)
+            continue
+        hashes[path] = h
+        if cache is not None:
+            cache.put(cache.key(args.hash, image=file_identity(path)), f'{h:016x}')
+    if args.jobs > 1:
+        pool.close()
+        pool.join()
+    t2 = time()
+
+    kept = 0
+    total = 0
+    clustersfp = open(args.clusters, 'w') if args.clusters is not None else None
+    with open(args.output, 'w') as fp:
+        for seq, paths in sequences.items():
+            # in filename (image ID) order, so that the outcome does not
+            # depend on the order of the directory listing or filelist
+            paths = sorted(paths, key=lambda p: p.name)
+            clusters = cluster([ (p, hashes[p]) for p in paths if p in hashes ], args.threshold)
+            for rep, members in clusters:
+                fp.write(f'{rep}\n')
+                if clustersfp is not None:
+                    clustersfp.write(json.dumps({ 'sequence': Path(seq).name, 'representative': str(rep),
+                                                  'members': [ { 'path': str(p), 'distance': d } for p, d in members ] }) + '\n')
+            # images that could not be hashed are left for segmentation to deal with
+            for p in paths:
+                if p not in hashes:
+                    fp.write(f'{p}\n')
+            seqkept = len(clusters) + sum(1 for p in paths if p not in hashes)
+            vlog(f'Sequence "{Path(seq).name}": keeping {seqkept} of {len(paths)} image(s).')
+            kept += seqkept
+            total += len(paths)
+    if clustersfp is not None:
+        clustersfp.close()
+    print(f'Kept {kept} of {total} image(s) ({total - kept} near-duplicate(s) skipped) in {len(sequences)} sequence(s); '
+          f'hashed {len(tohash)} image(s) in {t2-t1:.2f}s' + (f', {len(failed)} failed' if failed else '') + '.')
+    if cache is not None:
+        vlog(f'Cache: {cache.hits} hit(s), {cache.misses} miss(es).')
+
+if __name__=='__main__':
+    main()
+
+# vim: ai sw=4 sts=4 ts=4 et
@@ -0,0 +1,165 @@
+# Discovery of the input images in directory trees.
+#
+# The sequence directories hold, next to each image, the label map (.npz),
+# log (.out), error (.err), mask, overlay and crops (_x{N}.jpg) written by the
+# later stages, so a walk that stats every entry slows down as the processing
+# progresses. scan_images walks the trees with os.scandir, telling files from
+# directories by the type recorded in each directory entry (no stat() call,
+# except for symbolic links, which are followed as before), and only looking
+# at the names of files with one of the image extensions; it yields the images
+# as it goes, so that processing starts before the walk is complete.
+#
+# With threads > 1, the directories are listed by a pool of threads (the
+# listing itself does not hold the GIL), which helps on network filesystems;
+# the images are then yielded in the order in which their directories are
+# listed, rather than depth first.
+#
+# With a ListingIndex, the list of image files and subdirectories of each
+# directory is saved (as JSON) along with the modification time of the
+# directory, which changes whenever an entry is added, removed or renamed in
+# it, and is reused while that time is unchanged: an unchanged sequence
+# directory then costs one stat() rather than a full listing. Note that
+# writing new files (e.g. label maps) into a directory also changes its
+# modification time, so it is listed again on the next run after that.
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+
+# Listings of directories modified less than this long ago (in nanoseconds)
+# are not saved in the index: more entries could still be added within the
+# same tick of a coarse modification time, without changing it
+recent_ns = 2_000_000_000
+
+class ListingIndex:
+    def __init__(self, path, extensions):
+        self.path = path
+        self.extensions = sorted(extensions)
+        # directory -> [ modification time (ns), image files, subdirectories ]
+        self.dirs = {}
+        self.changed = False
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        try:
+            with open(path) as fp:
+                data = json.load(fp)
+            # listings made for other extensions are of no use
+            if data.get('extensions') == self.extensions:
+                self.dirs = data['dirs']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    # The files and subdirectories of dirpath if listed at modification time
+    # mtime_ns, or None
+    def get(self, dirpath, mtime_ns):
+        with self.lock:
+            entry = self.dirs.get(dirpath)
+            if entry is not None and entry[0] == mtime_ns:
+                self.hits += 1
+                return entry[1], entry[2]
+            self.misses += 1
+            return None
+
+    def put(self, dirpath, mtime_ns, files, subdirs):
+        if time.time_ns() - mtime_ns < recent_ns:
+            return
+        with self.lock:
+            self.dirs[dirpath] = [ mtime_ns, files, subdirs ]
+            self.changed = True
+
+    # Write the index (under a temporary name, then renamed into place)
+    def save(self):
+        if not self.changed: return
+        tmppath = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmppath, 'w') as fp:
+            json.dump({ 'extensions': self.extensions, 'dirs': self.dirs }, fp)
+        os.replace(tmppath, self.path)
+        self.changed = False
+
+def extension(name):
+    return os.path.splitext(name)[1][1:].lower()
+
+# The names of the files with one of the extensions, and of the
+# subdirectories, of dirpath
+def list_dir(dirpath, extensions, index=None):
+    try:
+        # (taken before listing, so that any change made meanwhile is seen
+        # as a change of modification time next time)
+        mtime_ns = os.stat(dirpath).st_mtime_ns
+    except OSError:
+        return [], []
+    if index is not None:
+        listing = index.get(dirpath, mtime_ns)
+        if listing is not None:
+            return listing
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(dirpath) as it:
+            for entry in it:
+                if extension(entry.name) in extensions:
+                    if entry.is_file():
+                        files.append(entry.name)
+                elif entry.is_dir():
+                    subdirs.append(entry.name)
+    except OSError:
+        return [], []
+    if index is not None:
+        index.put(dirpath, mtime_ns, files, subdirs)
+    return files, subdirs
+
+# Yield the paths of the image files among paths (files or directories,
+# searched recursively if recursive is set) whose extensions are among
+# extensions and whose names do not match the regex exclude
+def scan_images(paths, extensions, exclude, recursive=False, index=None, threads=1):
+    extensions = set(e.lower() for e in extensions)
+    def wanted(dirpath, names):
+        for name in names:
+            if not exclude.match(name):
+                yield Path(os.path.join(dirpath, name))
+
+    def walk(dirpath):
+        files, subdirs = list_dir(dirpath, extensions, index)
+        yield from wanted(dirpath, files)
+        for name in subdirs:
+            yield from walk(os.path.join(dirpath, name))
+
+    def walk_parallel(dirpaths):
+        with ThreadPoolExecutor(threads) as executor:
+            pending = { executor.submit(list_dir, d, extensions, index): d for d in dirpaths }
+            try:
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        dirpath = pending.pop(future)
+                        files, subdirs = future.result()
+                        for name in subdirs:
+                            d = os.path.join(dirpath, name)
+                            pending[executor.submit(list_dir, d, extensions, index)] = d
+                        yield from wanted(dirpath, files)
+            finally:
+                # e.g. if the caller stops early
+                executor.shutdown(cancel_futures=True)
+
+    try:
+        dirpaths = []
+        for name in paths:
+            p = Path(name)
+            if p.is_file():
+                if extension(p.name) in extensions and not exclude.match(p.name):
+                    yield p
+            elif recursive and p.is_dir():
+                if threads > 1:
+                    dirpaths.append(str(p))
+                else:
+                    yield from walk(str(p))
+        if dirpaths:
+            yield from walk_parallel(dirpaths)
+    finally:
+        if index is not None:
+            index.save()
+
+# vim: ai sw=4 sts=4 ts=4 et
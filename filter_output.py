@@ -3,16 +3,23 @@ import argparse
 import sys
 from pathlib import Path
 import os
+import numpy as np
+from metrics_io import read_rows
 
 parser = argparse.ArgumentParser(prog='filter_output.py', description='Filter output files based on criteria')
 parser.add_argument('filename', metavar='FILENAME', help='Saved out file to process, or list of such files (see -F)')
 parser.add_argument('--filelist', '-F', action='store_true', default=False, help='Supplied path is actually a list of numpy filenames, one per line, to process.')
+parser.add_argument('--metrics', '-M', action='store_true', default=False, help='Supplied path is a metrics file written by torch_process_segm.py --metrics-file (or, with -F, a list of them) rather than .out files')
 parser.add_argument('--output', '-o', metavar='FILENAME', required=True, default=None, help='File to write the list of filtered image identifiers')
 parser.add_argument('--verbose', '-v', action='store_true', default=False, help='Run in verbose mode')
 parser.add_argument('--contrast-threshold', '-C', metavar='NUMBER', default=0.35, type=float, help='Minimum contrast')
 parser.add_argument('--tone-mapping-threshold', '-H', metavar='NUMBER', default=0.35, type=float, help='Minimum contrast')
 parser.add_argument('--tone-mapping-floor', metavar='NUMBER', default=0.8, type=float, help='Tone mapping floor')
 parser.add_argument('--disable-road-check', action='store_true', default=False, help='Do not filter out images that lack a road')
+parser.add_argument('--sweep', action='store_true', default=False, help='Also print a table of the number of accepted images for every combination of the --sweep-* settings (the list written to --output is still for the settings given above)')
+parser.add_argument('--sweep-contrast', metavar='LIST', default=None, help='With --sweep, comma-separated contrast thresholds, or START:STOP:STEP (default: --contrast-threshold)')
+parser.add_argument('--sweep-floor', metavar='LIST', default=None, help='With --sweep, comma-separated tone mapping floors, or START:STOP:STEP (default: --tone-mapping-floor)')
+parser.add_argument('--sweep-road-check', action='store_true', default=False, help='With --sweep, show each combination both with and without the road check')
 
 out_extensions = ['out']
 
@@ -21,13 +28,52 @@ tone_mapping_tag = 'Tone-mapping score: '
 centres_tag = 'Found road centres: ['
 imgid_tag = 'Assuming imgid='
 
+# Parse a list of numbers given as 'A,B,C' or as a range 'START:STOP:STEP' (inclusive of STOP)
+def parse_grid(s):
+    if ':' in s:
+        start, stop, step = map(float, s.split(':'))
+        return np.arange(start, stop + step / 2, step)
+    return np.array([ float(x) for x in s.split(',') ])
+
+# Combined quality score of each image (as image_metrics.quality_accept), for arrays of scores
+def quality_scores(contrast, tone_mapping, floor):
+    return contrast + np.maximum(0, tone_mapping - floor)
+
 def main():
     args = parser.parse_args()
     def vlog(s):
         if args.verbose:
             print(s)
 
-    def do_file(fname, outfp):
+    # All the inputs are read into these lists first, and then filtered at once
+    imgids = []
+    contrasts = []
+    tone_mappings = []
+    centre_counts = []
+
+    def add_image(imgid, contrast, tone_mapping, centres):
+        imgids.append(imgid)
+        # missing scores become NaN, which is never accepted
+        contrasts.append(np.nan if contrast is None else contrast)
+        tone_mappings.append(np.nan if tone_mapping is None else tone_mapping)
+        centre_counts.append(-1 if centres is None else len(centres))
+
+    # The last row of each image in the metrics files: they are only ever
+    # appended to, so an image processed again (e.g. re-run or retried) has
+    # a row for each time, of which only the last counts
+    metrics_rows = {}
+    def do_metrics_file(fname):
+        for row in read_rows(fname, kind='image'):
+            metrics_rows[row['imgid']] = row
+
+    def add_metrics_rows():
+        for row in metrics_rows.values():
+            if 'skimage_contrast' not in row:
+                vlog(f'imgid={row["imgid"]} has no quality metrics (no image found, or --centres-only), skipping.')
+                continue
+            add_image(row['imgid'], row['skimage_contrast'], row['tone_mapping'], row['centres'])
+
+    def do_file(fname):
         contrast = None
         tone_mapping = None
         imgid = None
@@ -46,21 +92,57 @@ def main():
                         vlog(f'Invalid road centres line: {line}')
                     else:
                         centres = list(map(int,filter(lambda x: x, line[len(centres_tag):closebracketpos].strip().split(' '))))
-                    
-        v = contrast + max(0, tone_mapping - args.tone_mapping_floor)
-        accept = v > args.contrast_threshold and (args.disable_road_check or len(centres) == 1)
-        vlog(f'imgid={imgid} contrast={contrast} Tone-mapping={tms} road centres={centres} v={v} accept?: {accept}')
-        if accept: outfp.write(f'{imgid}\n')
 
+        add_image(imgid, contrast, tone_mapping, centres)
+
+    if args.filelist:
+        with open(args.filename) as fp:
+            for name in fp:
+                p = Path(name.strip())
+                if args.metrics and p.is_file():
+                    do_metrics_file(p)
+                elif p.is_file() and p.suffix.lower()[1:] in out_extensions:
+                    do_file(p)
+    elif args.metrics:
+        do_metrics_file(args.filename)
+    else:
+        do_file(args.filename)
+    add_metrics_rows()
+
+    contrasts = np.array(contrasts, dtype=np.float64)
+    tone_mappings = np.array(tone_mappings, dtype=np.float64)
+    one_road = np.array(centre_counts) == 1
+
+    v = quality_scores(contrasts, tone_mappings, args.tone_mapping_floor)
+    accept = v > args.contrast_threshold
+    if not args.disable_road_check:
+        accept &= one_road
+    if args.verbose:
+        for i, imgid in enumerate(imgids):
+            vlog(f'imgid={imgid} contrast={contrasts[i]} Tone-mapping={tone_mappings[i]} road centre count={centre_counts[i]} v={v[i]} accept?: {accept[i]}')
     with open(args.output, 'w') as outfp:
-        if args.filelist:
-            with open(args.filename) as fp:
-                for name in fp:
-                    p = Path(name.strip())
-                    if p.is_file() and p.suffix.lower()[1:] in out_extensions:
-                        do_file(p, outfp)
-        else:
-            do_file(args.filename, outfp)
+        for i in np.flatnonzero(accept):
+            outfp.write(f'{imgids[i]}\n')
+    vlog(f'Accepted {np.count_nonzero(accept)} of {len(imgids)} image(s).')
+
+    if args.sweep:
+        thresholds = parse_grid(args.sweep_contrast) if args.sweep_contrast else np.array([ args.contrast_threshold ])
+        floors = parse_grid(args.sweep_floor) if args.sweep_floor else np.array([ args.tone_mapping_floor ])
+        road_checks = [ True, False ] if args.sweep_road_check else [ not args.disable_road_check ]
+        print(f'{"contrast":>10} {"floor":>8} {"road":>5} {"accepted":>10} {"fraction":>9}')
+        n = max(len(imgids), 1)
+        for floor in floors:
+            # The number of scores above each threshold is found by a binary
+            # search in the sorted scores, rather than comparing them all again.
+            v = quality_scores(contrasts, tone_mappings, floor)
+            for road_check in road_checks:
+                sortedv = np.sort(v[one_road] if road_check else v)
+                # NaNs sort last and are never accepted
+                nvalid = np.count_nonzero(~np.isnan(sortedv))
+                counts = nvalid - np.searchsorted(sortedv[:nvalid], thresholds, side='right')
+                for threshold, count in zip(thresholds, counts):
+                    print(f'{threshold:10.3f} {floor:8.3f} {"yes" if road_check else "no":>5} {count:10d} {count/n:9.3f}')
+
 if __name__=='__main__':
     main()
 
@@ -0,0 +1,177 @@
+# Image quality metrics, shared by torch_process_segm.py (which logs them
+# for filter_output.py) and the pre-screening in torch_segm_images.py.
+import numpy as np
+from numpy.linalg import norm
+import cv2
+import math
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from scipy.stats import beta
+from skimage.util.dtype import dtype_limits
+from PIL import Image
+
+# https://stackoverflow.com/questions/58821130/how-to-calculate-the-contrast-of-an-image
+def rms_contrast(img):
+    img_grey = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return img_grey.std()
+
+def michaelson_contrast(img):
+    Y = cv2.cvtColor(img, cv2.COLOR_BGR2YUV)[:,:,0]
+
+    # compute min and max of Y
+    min = np.min(Y).astype(float)
+    max = np.max(Y).astype(float)
+
+    # compute contrast
+    contrast = (max-min)/(max+min)
+    return contrast
+
+###################################################
+# https://towardsdatascience.com/measuring-enhancing-image-quality-attributes-234b0f250e10
+RED_SENSITIVITY = 0.299
+GREEN_SENSITIVITY = 0.587
+BLUE_SENSITIVITY = 0.114
+def convert_to_brightness_image(image: np.ndarray) -> np.ndarray:
+    if image.dtype == np.uint8:
+        raise ValueError("uint8 is not a good dtype for the image")
+
+    return np.sqrt(
+        image[..., 2] ** 2 * RED_SENSITIVITY
+        + image[..., 1] ** 2 * GREEN_SENSITIVITY
+        + image[..., 0] ** 2 * BLUE_SENSITIVITY
+    )
+def get_resolution(image: np.ndarray):
+    height, width = image.shape[:2]
+    return height * width
+
+def brightness_histogram(image: np.ndarray) -> np.ndarray:
+    nr_of_pixels = get_resolution(image)
+    brightness_image = convert_to_brightness_image(image)
+    hist, _ = np.histogram(brightness_image, bins=256, range=(0, 255))
+    return hist / nr_of_pixels
+def distribution_pmf(dist, start, stop, nr_of_steps):
+    xs = np.linspace(start, stop, nr_of_steps)
+    ys = dist.pdf(xs)
+    # divide by the sum to make a probability mass function
+    return ys / np.sum(ys)
+def correlation_distance(
+    distribution_a: np.ndarray, distribution_b: np.ndarray
+) -> float:
+    dot_product = np.dot(distribution_a, distribution_b)
+    squared_dist_a = np.sum(distribution_a ** 2)
+    squared_dist_b = np.sum(distribution_b ** 2)
+    return dot_product / math.sqrt(squared_dist_a * squared_dist_b)
+# The reference distribution for compute_hdr is the same for every image
+@lru_cache(maxsize=None)
+def reference_pmf():
+    pmf = distribution_pmf(beta(2, 2), 0, 1, 256)
+    pmf.flags.writeable = False
+    return pmf
+def compute_hdr(cv_image: np.ndarray):
+    img_brightness_pmf = brightness_histogram(np.float32(cv_image))
+    return correlation_distance(reference_pmf(), img_brightness_pmf)
+###################################################
+
+# Taken from skimage source code:
+def skimage_contrast(image, lower_percentile=1, upper_percentile=99):
+    image = np.asanyarray(image)
+
+    if image.dtype == bool:
+        return not ((image.max() == 1) and (image.min() == 0))
+
+    if image.ndim == 3:
+        from skimage.color import rgb2gray, rgba2rgb  # avoid circular import
+
+        if image.shape[2] == 4:
+            image = rgba2rgb(image)
+        if image.shape[2] == 3:
+            image = rgb2gray(image)
+
+    dlimits = dtype_limits(image, clip_negative=False)
+    limits = np.percentile(image, [lower_percentile, upper_percentile])
+    ratio = (limits[1] - limits[0]) / (dlimits[1] - dlimits[0])
+    return ratio
+
+# https://stackoverflow.com/questions/14243472/estimate-brightness-of-an-image-opencv
+def simple_brightness(img):
+    if len(img.shape) == 3:
+        # Colored RGB or BGR (*Do Not* use HSV images with this function)
+        # create brightness with euclidean norm
+        return np.average(norm(img, axis=2)) / np.sqrt(3)
+    else:
+        # Grayscale
+        return np.average(img)
+
+# http://alienryderflex.com/hsp.html
+def finley_brightness(img):
+    return np.average(np.sqrt(np.sum(img.reshape(-1,3).astype(np.float32)**2 * [0.114, 0.587, 0.299], axis=1)))
+
+def laplacian(image):
+    return cv2.Laplacian(image, cv2.CV_64F).var()
+
+# All of the metrics above for one image (BGR, as from cv2.imread), in a single
+# pass: the image is converted to floating point once, and the grey, luma and
+# brightness images are each derived once from that and shared between the
+# metrics that need them. The results are the same as those of the separate
+# functions, except that Michaelson contrast is computed on the greyscale image
+# used for RMS contrast instead of the Y channel of YUV (which may differ by
+# one grey level), and that is_low_contrast (with fraction_threshold=0.35) is
+# derived from the Skimage contrast, which is the ratio it thresholds.
+#
+# With quality_only, only the two scores used by filter_output.py are computed
+# ('skimage_contrast' and 'tone_mapping'), as in torch_process_segm.py --fast.
+def image_metrics(img, quality_only=False):
+    metrics = {}
+    f = img.astype(np.float32)
+    # luma as computed by skimage.color.rgb2gray (on a scale of 0..255 here)
+    luma = f @ np.array([0.0721, 0.7154, 0.2125], dtype=np.float32)
+    # skimage_contrast: the dtype range of the float grey image is -1..1
+    lo, hi = np.percentile(luma, [1, 99], overwrite_input=True)
+    del luma
+    metrics['skimage_contrast'] = float((hi - lo) / 255 / 2)
+    # from here on, f holds the squares of the channel values
+    sq = np.square(f, out=f)
+    brightness = sq @ np.array([BLUE_SENSITIVITY, GREEN_SENSITIVITY, RED_SENSITIVITY], dtype=np.float32)
+    np.sqrt(brightness, out=brightness)
+    hist, _ = np.histogram(brightness, bins=256, range=(0, 255))
+    metrics['tone_mapping'] = float(correlation_distance(reference_pmf(), hist / get_resolution(img)))
+    if quality_only:
+        return metrics
+    norms = sq @ np.ones(3, dtype=np.float32)
+    metrics['simple_brightness'] = float(np.sqrt(norms, out=norms).mean(dtype=np.float64) / np.sqrt(3))
+    del norms
+    metrics['finley_brightness'] = float(brightness.mean(dtype=np.float64))
+    grey = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    gmin, gmax = float(grey.min()), float(grey.max())
+    metrics['michaelson_contrast'] = (gmax - gmin) / (gmax + gmin) if gmax + gmin > 0 else np.nan
+    metrics['rms_contrast'] = float(grey.std())
+    metrics['is_low_contrast'] = metrics['skimage_contrast'] < 0.35
+    # The Laplacian of 8-bit values is exact in single precision; its variance
+    # over all channels is put together from the per-channel mean and variance.
+    mean, std = cv2.meanStdDev(cv2.Laplacian(img, cv2.CV_32F))
+    metrics['laplacian'] = float((std**2 + mean**2).mean() - mean.mean()**2)
+    return metrics
+
+# image_metrics for a list of images, computed in the given number of threads
+# (numpy and OpenCV release the GIL for most of the work).
+def image_metrics_batch(imgs, quality_only=False, threads=1):
+    if threads <= 1:
+        return [ image_metrics(img, quality_only) for img in imgs ]
+    with ThreadPoolExecutor(threads) as pool:
+        return list(pool.map(lambda img: image_metrics(img, quality_only), imgs))
+
+# The acceptance criterion on image quality applied by filter_output.py
+def quality_accept(contrast, tone_mapping, contrast_threshold=0.35, tone_mapping_floor=0.8):
+    return contrast + max(0, tone_mapping - tone_mapping_floor) > contrast_threshold
+
+# Compute the 'Skimage contrast' and 'Tone-mapping score' of an image file
+# cheaply, by letting the JPEG decoder scale it down by (up to) the given
+# factor while decoding.
+def prescreen_image(path, scale=4):
+    with Image.open(path) as img:
+        img.draft('RGB', (img.size[0]//scale, img.size[1]//scale))
+        rgbimg = np.asarray(img.convert('RGB'))
+    metrics = image_metrics(rgbimg[:, :, ::-1], quality_only=True)
+    return metrics['skimage_contrast'], metrics['tone_mapping']
+
+# vim: ai sw=4 sts=4 ts=4 et
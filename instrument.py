@@ -0,0 +1,272 @@
+# Timing instrumentation shared by the scripts.
+#
+# Each stage of the work on an input (e.g. 'decode', 'inference', 'save',
+# 'centres', 'crops') is timed with
+#
+#     with instr.stage('decode'):
+#         ...
+#
+# which measures its wall-clock and CPU time (of the whole process, so
+# including any threads used by torch or OpenCV) and the number of bytes read
+# and written by the process meanwhile (from /proc/self/io, where available:
+# reads of memory-mapped files are not counted). The work on each input (an
+# image, or a tile) is wrapped in 'with instr.item(name):' so that throughput
+# can be reported.
+#
+# With --trace FILE, every stage is recorded as it finishes: as JSON lines,
+# or, if FILE ends in '.json', in the Chrome trace event format (for
+# chrome://tracing or https://ui.perfetto.dev). Any number of processes can
+# append to the same file, as with metrics_io.py. With --progress SECONDS, a
+# summary of the throughput, estimated time remaining (when the number of
+# inputs is known) and time spent per stage is printed at that interval, and
+# again at the end. With --profile FILE, the run is profiled with cProfile and
+# the statistics saved in FILE (see 'python -m pstats FILE').
+import fcntl
+import json
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+def add_arguments(parser):
+    parser.add_argument('--trace', metavar='FILE', default=None, help='Append the wall-clock and CPU time, bytes read and written, and image count of every stage of processing to FILE, as JSON lines, or in the Chrome trace event format if FILE ends in .json (see instrument.py)')
+    parser.add_argument('--progress', metavar='SECONDS', default=0, type=float, help='Print the throughput, estimated time remaining and time spent per stage every SECONDS, and at the end (default: 0, meaning never)')
+    parser.add_argument('--profile', metavar='FILE', default=None, help='Profile the run with cProfile and save the statistics in FILE (worker processes save theirs in FILE.N)')
+
+# Bytes read and written by this process so far (not counting the bytes of
+# this very read, which are given as well), or None if unknown
+def io_counters():
+    try:
+        with open('/proc/self/io') as fp:
+            data = fp.read()
+        counters = dict(line.split(': ') for line in data.splitlines())
+        return int(counters['rchar']), int(counters['wchar']), len(data)
+    except (OSError, KeyError, ValueError):
+        return None
+
+# Accumulated totals of one stage
+stage_fields = [ 'count', 'wall', 'cpu', 'bytes_read', 'bytes_written', 'images' ]
+
+def format_duration(secs):
+    secs = int(secs)
+    if secs >= 3600:
+        return f'{secs//3600}h{secs%3600//60:02d}m'
+    if secs >= 60:
+        return f'{secs//60}m{secs%60:02d}s'
+    return f'{secs}s'
+
+def format_bytes(n):
+    for unit in [ 'B', 'kB', 'MB', 'GB' ]:
+        if n < 1000: break
+        n /= 1000
+    return f'{n:.0f}{unit}' if unit == 'B' else f'{n:.1f}{unit}'
+
+class Instrument:
+    def __init__(self, script, trace=None, progress=0, total=None, unit='images', log=print):
+        self.script = script
+        self.tracefile = trace
+        self.chrome = trace is not None and trace.endswith('.json')
+        self.progress = progress
+        self.total = total
+        self.unit = unit
+        self.log = log
+        # whether to print the progress summaries (turned off in worker
+        # processes, whose totals are reported by their parent instead)
+        self.reporting = progress > 0
+        self.host = socket.gethostname()
+        self.totals = {}
+        self.done = 0
+        self.events = []
+        # the stages of segm_server.py are timed in several threads
+        self.lock = threading.Lock()
+        self.current = None
+        self.depth = 0
+        self.starttime = time.time()
+        self.lastreport = self.starttime
+        # the throughput is measured from the start of the first input, after
+        # any set-up (e.g. loading the model)
+        self.firststart = None
+
+    # Time the stage name in the with block; the yielded object has the
+    # measurements afterwards (e.g. s.wall). images: the number of images
+    # that the stage deals with, if more than one.
+    @contextmanager
+    def stage(self, name, images=1):
+        s = StageTimer(name, images)
+        start_io = io_counters()
+        s.start = time.time()
+        t0, c0 = time.perf_counter(), time.process_time()
+        try:
+            yield s
+        finally:
+            s.wall = time.perf_counter() - t0
+            s.cpu = time.process_time() - c0
+            end_io = io_counters()
+            if start_io is not None and end_io is not None:
+                s.bytes_read = end_io[0] - start_io[0] - start_io[2]
+                s.bytes_written = end_io[1] - start_io[1]
+            self.record(s)
+
+    def record(self, s):
+        with self.lock:
+            t = self.totals.setdefault(s.name, dict.fromkeys(stage_fields, 0))
+            t['count'] += 1
+            t['wall'] += s.wall
+            t['cpu'] += s.cpu
+            t['bytes_read'] += s.bytes_read
+            t['bytes_written'] += s.bytes_written
+            t['images'] += s.images
+        if self.tracefile is None: return
+        if self.chrome:
+            event = { 'name': s.name, 'cat': self.script, 'ph': 'X', 'ts': int(s.start * 1e6), 'dur': int(s.wall * 1e6),
+                      'pid': os.getpid(), 'tid': threading.get_native_id(),
+                      'args': { 'item': self.current, 'cpu': round(s.cpu, 6), 'bytes_read': s.bytes_read,
+                                'bytes_written': s.bytes_written, 'images': s.images } }
+        else:
+            event = { 'script': self.script, 'host': self.host, 'pid': os.getpid(), 'stage': s.name, 'item': self.current,
+                      'start': round(s.start, 6), 'wall': round(s.wall, 6), 'cpu': round(s.cpu, 6),
+                      'bytes_read': s.bytes_read, 'bytes_written': s.bytes_written, 'images': s.images }
+        with self.lock:
+            self.events.append(event)
+        if self.depth == 0:
+            self.flush()
+
+    # The work on one input, recorded as the stage 'item'. Nested items (e.g.
+    # torch_segm_images.py --process handing a label map over to
+    # torch_process_segm.py) count as part of the outer one.
+    @contextmanager
+    def item(self, name):
+        if self.depth > 0:
+            yield
+            return
+        self.current = str(name)
+        if self.firststart is None:
+            self.firststart = time.time()
+        try:
+            with self.stage('item'):
+                self.depth += 1
+                try:
+                    yield
+                finally:
+                    self.depth -= 1
+        finally:
+            self.current = None
+            self.flush()
+            self.finished()
+
+    # Count n inputs as finished, and report progress if it is time to
+    def finished(self, n=1):
+        self.done += n
+        if self.reporting and time.time() - self.lastreport >= self.progress:
+            self.report()
+
+    # Append the recorded events to the trace file, all at once and while
+    # holding a lock on it, so that the events of different processes are
+    # not interleaved
+    def flush(self):
+        with self.lock:
+            events, self.events = self.events, []
+        if not events: return
+        if self.chrome:
+            # the closing bracket of the array is optional in this format
+            data = ''.join(json.dumps(e) + ',\n' for e in events)
+        else:
+            data = ''.join(json.dumps(e) + '\n' for e in events)
+        fd = os.open(self.tracefile, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if self.chrome and os.fstat(fd).st_size == 0:
+                data = '[\n' + data
+            os.write(fd, data.encode())
+        finally:
+            os.close(fd)
+
+    # Returns the totals accumulated since the last call, e.g. for a worker
+    # process to hand them over to its parent (see merge)
+    def take_totals(self):
+        with self.lock:
+            totals, self.totals = self.totals, {}
+        return totals
+
+    def merge(self, totals):
+        with self.lock:
+            self.merge_totals(totals)
+
+    def merge_totals(self, totals):
+        for name, t in totals.items():
+            mine = self.totals.setdefault(name, dict.fromkeys(stage_fields, 0))
+            for k in stage_fields:
+                mine[k] += t[k]
+
+    def report(self, final=False):
+        now = time.time()
+        self.lastreport = now
+        elapsed = now - (self.firststart or self.starttime)
+        rate = self.done / elapsed if elapsed > 0 else 0
+        line = f'[{self.script}] {"Finished: " if final else ""}{self.done} {self.unit} in {format_duration(elapsed)} ({rate:.2f} {self.unit}/s)'
+        if self.total is not None and not final:
+            remaining = max(0, self.total - self.done)
+            eta = format_duration(remaining / rate) if rate > 0 else '?'
+            line += f'; {remaining} of {self.total} remaining, ETA {eta}'
+        self.log(line)
+        # stages in order of the time spent in them, per input finished
+        per = max(1, self.done)
+        for name, t in sorted(self.totals.items(), key=lambda kv: -kv[1]['wall']):
+            if name == 'item': continue
+            self.log(f'    {name:<12} {t["wall"]/per:8.3f}s wall {t["cpu"]/per:8.3f}s cpu per {self.unit[:-1] if self.unit.endswith("s") else self.unit};'
+                     f' total {t["wall"]:.1f}s over {t["count"]} call(s), read {format_bytes(t["bytes_read"])}, wrote {format_bytes(t["bytes_written"])}')
+
+    def close(self):
+        self.flush()
+        if self.reporting:
+            self.report(final=True)
+
+class StageTimer:
+    def __init__(self, name, images):
+        self.name = name
+        self.images = images
+        self.start = None
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+def from_args(script, args, total=None, unit='images', log=print):
+    return Instrument(script, trace=args.trace, progress=args.progress, total=total, unit=unit, log=log)
+
+# Profile the with block with cProfile if path is given, saving the
+# statistics in path, and printing the top entries if show is set
+@contextmanager
+def profiled(path, show=False, log=print):
+    if path is None:
+        yield
+        return
+    import cProfile
+    import pstats
+    import io
+    prof = cProfile.Profile()
+    prof.enable()
+    try:
+        yield
+    finally:
+        prof.disable()
+        prof.dump_stats(path)
+        if show:
+            out = io.StringIO()
+            pstats.Stats(prof, stream=out).sort_stats('cumulative').print_stats(20)
+            log(f'Profile saved in "{path}"; top entries by cumulative time:')
+            log(out.getvalue())
+
+# Number of lines of a filelist, to estimate the time remaining (None for
+# standard input or a pipe, which cannot be read ahead)
+def count_lines(path):
+    if path == '-' or not os.path.isfile(path):
+        return None
+    try:
+        with open(path, 'rb') as fp:
+            return sum(1 for line in fp if line.strip())
+    except OSError:
+        return None
+
+# vim: ai sw=4 sts=4 ts=4 et
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# Shared queue of work for processes on several machines.
+#
+# When torch_segm_images.py and torch_process_segm.py run on several machines
+# against a shared filesystem, skipping the inputs whose output exists does
+# not stop two processes from starting on the same input at once. With
+# '--queue DB', they instead take their inputs one at a time from a queue kept
+# in the SQLite database DB (on the shared filesystem), which hands each
+# input to only one process at a time.
+#
+# Each input ('job') of each stage ('segment' or 'process') is in one of the
+# states:
+#   pending   waiting to be handed out
+#   leased    handed out to a process (recorded with its host and process ID),
+#             until its lease expires (--lease SECONDS): if the process has
+#             not finished with it by then (e.g. because it was killed), it
+#             is handed out again
+#   done      finished
+#   failed    failed, or its lease expired, --max-attempts times; a job that
+#             fails fewer times than that goes back to pending, to be
+#             handed out again after the jobs not yet attempted
+#
+# Any PATHs given to the scripts along with --queue are added to the queue
+# first (once only, however many processes add them), so the queue can be
+# filled by the first process started, or beforehand with 'job_queue.py DB
+# --add FILE'. The label maps saved by torch_segm_images.py --queue are added
+# to the 'process' stage of the same queue, for torch_process_segm.py --queue.
+#
+# Run as a command, this script adds inputs to a queue, puts failed jobs back,
+# and reports the number of jobs in each state and the throughput of each
+# host.
+#
+# Every change is made in a transaction that locks the whole database, which
+# is quick enough for one transaction per image, but relies on the locking of
+# the shared filesystem (which works on NFS with most current servers and
+# clients, but not on all network filesystems).
+import argparse
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+stages = [ 'segment', 'process' ]
+states = [ 'pending', 'leased', 'done', 'failed' ]
+
+schema = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    stage TEXT NOT NULL,
+    item TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    host TEXT,
+    pid INTEGER,
+    started REAL,
+    lease_expires REAL,
+    finished REAL,
+    error TEXT,
+    PRIMARY KEY (stage, item)
+);
+-- (by attempts too, as the pending jobs are leased in that order)
+CREATE INDEX IF NOT EXISTS jobs_state_attempts ON jobs (stage, state, attempts);
+'''
+
+def add_arguments(parser):
+    parser.add_argument('--queue', metavar='DB', default=None, help='Take the inputs one at a time from the job queue in the SQLite database DB (see job_queue.py), shared with other processes and machines; any PATHs given are added to the queue first')
+    parser.add_argument('--lease', metavar='SECONDS', default=1800, type=float, help='With --queue, hand an input over to another process if this one has not finished with it after SECONDS (default: 1800)')
+    parser.add_argument('--max-attempts', metavar='N', default=3, type=int, help='With --queue, give up on an input after N failed (or expired) attempts (default: 3)')
+
+class JobQueue:
+    def __init__(self, path, stage, lease=1800, max_attempts=3):
+        self.path = path
+        self.stage = stage
+        self.lease_secs = lease
+        self.max_attempts = max_attempts
+        self.host = socket.gethostname()
+        self.pid = os.getpid()
+        # transactions are begun explicitly (see transaction), waiting for
+        # up to the timeout for other processes to finish theirs; the
+        # connection may be used by several threads (e.g. torch_process_segm.py
+        # --jobs leases in the thread feeding its pool), one transaction at a time
+        self.db = sqlite3.connect(path, timeout=600, isolation_level=None, check_same_thread=False)
+        self.lock = threading.RLock()
+        with self.transaction():
+            for statement in schema.split(';'):
+                if statement.strip():
+                    self.db.execute(statement)
+            # (superseded by jobs_state_attempts in queues created before it)
+            if self.db.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'jobs_state'").fetchone() is not None:
+                self.db.execute('DROP INDEX jobs_state')
+
+    # An exclusive transaction: the database is locked against other writers
+    # from the start, so that a job read as pending cannot be leased by
+    # another process before this one marks it leased
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+
+    # Add the items as pending jobs of the stage (by default that of this
+    # queue), unless already there; returns the number added
+    def add(self, items, stage=None):
+        with self.transaction() as db:
+            before = db.total_changes
+            db.executemany('INSERT OR IGNORE INTO jobs (stage, item) VALUES (?, ?)', ((stage or self.stage, str(item)) for item in items))
+            return db.total_changes - before
+
+    # Lease the next job, returning its item, or None if there is none left
+    # to lease (all done or failed, or leased by other processes). The jobs
+    # that have failed before come after all those not yet attempted, so
+    # that a failed job is not handed straight back to the process that
+    # just failed it (while there are others to do).
+    def lease(self):
+        now = time.time()
+        with self.transaction() as db:
+            # expired leases that were the last attempt allowed
+            db.execute("UPDATE jobs SET state = 'failed', error = 'lease expired', finished = ? WHERE stage = ? AND state = 'leased' AND lease_expires < ? AND attempts >= ?",
+                       (now, self.stage, now, self.max_attempts))
+            row = db.execute("SELECT item FROM jobs WHERE stage = ? AND state = 'pending' ORDER BY attempts, rowid LIMIT 1", (self.stage,)).fetchone()
+            if row is None:
+                row = db.execute("SELECT item FROM jobs WHERE stage = ? AND state = 'leased' AND lease_expires < ? ORDER BY lease_expires LIMIT 1", (self.stage, now)).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE jobs SET state = 'leased', attempts = attempts + 1, host = ?, pid = ?, started = ?, lease_expires = ?, finished = NULL WHERE stage = ? AND item = ?",
+                       (self.host, self.pid, now, now + self.lease_secs, self.stage, row[0]))
+        return row[0]
+
+    # Record a leased job as done. Only while this process still holds the
+    # lease: once it has expired and the job has been handed out again, the
+    # outcome is left to the process that holds it now. Returns whether the
+    # lease was still held.
+    def done(self, item):
+        with self.transaction() as db:
+            return db.execute("UPDATE jobs SET state = 'done', finished = ?, lease_expires = NULL, error = NULL WHERE stage = ? AND item = ? AND state = 'leased' AND host = ? AND pid = ?",
+                              (time.time(), self.stage, str(item), self.host, self.pid)).rowcount > 0
+
+    # Record a failed attempt (as done, only while this process holds the
+    # lease): the job goes back to pending, unless it has had all its attempts
+    def failed(self, item, error):
+        with self.transaction() as db:
+            return db.execute("UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, finished = ?, lease_expires = NULL, error = ? WHERE stage = ? AND item = ? AND state = 'leased' AND host = ? AND pid = ?",
+                              (self.max_attempts, time.time(), str(error), self.stage, str(item), self.host, self.pid)).rowcount > 0
+
+    # Give a leased job back (e.g. when interrupted), without counting the attempt
+    def release(self, item):
+        with self.transaction() as db:
+            db.execute("UPDATE jobs SET state = 'pending', attempts = attempts - 1, lease_expires = NULL WHERE stage = ? AND item = ? AND state = 'leased' AND host = ? AND pid = ?",
+                       (self.stage, str(item), self.host, self.pid))
+
+    # Put the failed jobs of the stage back to pending, with all their attempts
+    def retry_failed(self):
+        with self.transaction() as db:
+            return db.execute("UPDATE jobs SET state = 'pending', attempts = 0, error = NULL WHERE stage = ? AND state = 'failed'", (self.stage,)).rowcount
+
+    # Number of jobs of the stage not yet done or failed
+    def remaining(self):
+        return self.db.execute("SELECT COUNT(*) FROM jobs WHERE stage = ? AND state IN ('pending', 'leased')", (self.stage,)).fetchone()[0]
+
+def from_args(args, stage):
+    return JobQueue(args.queue, stage, lease=args.lease, max_attempts=args.max_attempts)
+
+# Lease jobs one at a time and pass their items to do_item, which returns
+# an error message if it failed, and otherwise None, until there are none
+# left to lease. Returns the number of jobs dealt with.
+def work(jobs, do_item, log=print):
+    n = 0
+    while (item := jobs.lease()) is not None:
+        try:
+            error = do_item(item)
+        except Exception as e:
+            error = str(e)
+        except BaseException:
+            # e.g. KeyboardInterrupt: leave the job to another process
+            jobs.release(item)
+            raise
+        if error is None:
+            held = jobs.done(item)
+        else:
+            log(f'Failed: "{item}": {error}')
+            held = jobs.failed(item, error)
+        if not held:
+            log(f'Lease of "{item}" expired before it was finished; left to the process holding it now.')
+        n += 1
+    return n
+
+parser = argparse.ArgumentParser(prog='job_queue.py', description='Add inputs to a job queue shared by torch_segm_images.py --queue and torch_process_segm.py --queue, and report its state and the throughput of each host')
+parser.add_argument('queue', metavar='DB', help='Job queue (SQLite database, created if necessary)')
+parser.add_argument('--stage', choices=stages, default='segment', help='Stage to which --add, --retry-failed and --list apply (default: segment)')
+parser.add_argument('--add', metavar='FILE', nargs='+', default=None, help='Add the inputs listed in FILE (one per line; - for standard input) as pending jobs of the --stage, unless already in the queue')
+parser.add_argument('--retry-failed', action='store_true', default=False, help='Put the failed jobs of the --stage back to pending')
+parser.add_argument('--list', metavar='STATE', choices=states, default=None, help='List the jobs of the --stage in STATE (with the error of each failed job)')
+parser.add_argument('--window', metavar='MINUTES', default=10, type=float, help='Report the recent throughput of each host over the last MINUTES (default: 10)')
+
+def main():
+    args = parser.parse_args()
+    jobs = JobQueue(args.queue, args.stage)
+    if args.add is not None:
+        for filename in args.add:
+            with (nullcontext(sys.stdin) if filename == '-' else open(filename)) as fp:
+                n = jobs.add(line.strip() for line in fp if line.strip())
+            print(f'Added {n} job(s) from "{filename}" to stage {args.stage}.')
+    if args.retry_failed:
+        print(f'Put {jobs.retry_failed()} failed job(s) of stage {args.stage} back to pending.')
+    if args.list is not None:
+        for item, host, error in jobs.db.execute('SELECT item, host, error FROM jobs WHERE stage = ? AND state = ? ORDER BY rowid', (args.stage, args.list)):
+            print(f'{item}\t{host or ""}' + (f'\t{error}' if error else ''))
+        return
+
+    now = time.time()
+    since = now - args.window * 60
+    print(f'{"stage":<8} ' + ' '.join(f'{s:>9}' for s in states) + f' {"expired":>9}')
+    for stage in stages:
+        counts = dict(jobs.db.execute('SELECT state, COUNT(*) FROM jobs WHERE stage = ? GROUP BY state', (stage,)).fetchall())
+        expired = jobs.db.execute("SELECT COUNT(*) FROM jobs WHERE stage = ? AND state = 'leased' AND lease_expires < ?", (stage, now)).fetchone()[0]
+        if counts:
+            print(f'{stage:<8} ' + ' '.join(f'{counts.get(s, 0):9d}' for s in states) + f' {expired:9d}')
+    # per host: the jobs done, the time each took, and the rate both overall
+    # (from the first job started to the last finished) and recently
+    rows = jobs.db.execute('''SELECT stage, host,
+                                      SUM(state = 'done'), SUM(state = 'failed'), SUM(state = 'leased'),
+                                      AVG(CASE WHEN state = 'done' THEN finished - started END),
+                                      MIN(started), MAX(finished),
+                                      SUM(state = 'done' AND finished >= ?)
+                               FROM jobs WHERE host IS NOT NULL GROUP BY stage, host ORDER BY stage, host''', (since,)).fetchall()
+    if rows:
+        print()
+        print(f'{"stage":<8} {"host":<20} {"done":>8} {"failed":>7} {"leased":>7} {"s/job":>7} {"jobs/h":>8} {f"last {args.window:g}m/h":>11} {"last seen":>10}')
+    for stage, host, done, failed, leased, secs, first, last, recent in rows:
+        overall = done / (last - first) * 3600 if done and last and last > first else 0
+        lastseen = f'{int(now - last)}s ago' if last else '-'
+        print(f'{stage:<8} {host:<20} {done:8d} {failed:7d} {leased:7d} {secs or 0:7.2f} {overall:8.0f} {recent / (args.window * 60) * 3600:11.0f} {lastseen:>10}')
+
+if __name__=='__main__':
+    main()
+
+# vim: ai sw=4 sts=4 ts=4 et
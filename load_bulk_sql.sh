@@ -0,0 +1,79 @@
+#!/bin/bash
+#
+# Load the files written by 'torch_process_segm.py --sql-bulk-dir DIR' into the
+# database in a single transaction: all the rows are copied into a temporary
+# table, from which the image and image_geo tables are filled with one
+# set-based INSERT (equivalent to running every _insert.sql file written by
+# --sqloutdir), and then optionally enabled with one UPDATE (equivalent to
+# running the _enable.sql files).
+#
+# Usage: load_bulk_sql.sh [-e ACCEPTED-IDS | -E] [-n] DIR [PSQL-OPTIONS...]
+#
+#   -e ACCEPTED-IDS  Enable the images (and their crops) whose image IDs are
+#                    listed in the file ACCEPTED-IDS (see filter_output.py)
+#   -E               Enable all the images loaded
+#   -n               Print the SQL rather than running it
+#
+# Any further arguments are passed to psql, e.g. the database name.
+
+usage() {
+    echo "Usage: $0 [-e ACCEPTED-IDS | -E] [-n] DIR [PSQL-OPTIONS...]" >&2
+    exit 1
+}
+
+ENABLE=
+ENABLE_ALL=
+DRY_RUN=
+while getopts "e:En" opt; do
+    case $opt in
+        e) ENABLE="$OPTARG" ;;
+        E) ENABLE_ALL=1 ;;
+        n) DRY_RUN=1 ;;
+        *) usage ;;
+    esac
+done
+shift $((OPTIND-1))
+[ $# -ge 1 ] || usage
+DIR="$1"
+shift
+
+# psql string literal for a filename
+quote() {
+    printf "'%s'" "$(printf '%s' "$1" | sed "s/'/''/g")"
+}
+
+generate_sql() {
+    cat <<EOF
+CREATE TEMP TABLE bulk_image (imgid text, seqid text, stem text, url text, system_path text, cityname text,
+                              angle_deg double precision, lon double precision, lat double precision) ON COMMIT DROP;
+EOF
+    find "$DIR" -maxdepth 1 -name '*.image.tsv' | sort | while read -r f; do
+        echo "\\copy bulk_image FROM $(quote "$f")"
+    done
+    cat <<EOF
+-- the same image may have been written more than once (e.g. by re-runs)
+CREATE TEMP TABLE bulk_image_unique ON COMMIT DROP AS SELECT DISTINCT ON (system_path) * FROM bulk_image ORDER BY system_path;
+WITH image_ins AS (
+INSERT INTO image (url, system_path, cityname, enabled) SELECT url, system_path, cityname, false FROM bulk_image_unique ON CONFLICT DO NOTHING RETURNING image_id, system_path
+)
+INSERT INTO image_geo (angle_deg, geo, image_id)
+  SELECT b.angle_deg, ST_SetSRID(ST_MakePoint(b.lon, b.lat),4326)::geometry(POINT, 4326), i.image_id
+  FROM image_ins i JOIN bulk_image_unique b USING (system_path) ON CONFLICT DO NOTHING;
+EOF
+    if [ -n "$ENABLE" ]; then
+        cat <<EOF
+CREATE TEMP TABLE bulk_accepted (imgid text) ON COMMIT DROP;
+\\copy bulk_accepted FROM $(quote "$ENABLE")
+UPDATE image SET enabled=true FROM bulk_image_unique b
+  WHERE image.system_path = b.system_path AND b.imgid IN (SELECT imgid FROM bulk_accepted);
+EOF
+    elif [ -n "$ENABLE_ALL" ]; then
+        echo "UPDATE image SET enabled=true WHERE system_path IN (SELECT system_path FROM bulk_image_unique);"
+    fi
+}
+
+if [ -n "$DRY_RUN" ]; then
+    generate_sql
+else
+    generate_sql | psql --single-transaction -v ON_ERROR_STOP=1 "$@"
+fi
@@ -25,6 +25,7 @@ import shutil
 import time
 import sys
 import io
+import instrument
 
 parser = argparse.ArgumentParser(prog='mapillary_jpg_download.py', description='Download mapillary images')
 parser.add_argument('--configfile', '--config', '-c', default=None, required=False, metavar='FILENAME', help='Configuration file to process')
@@ -35,6 +36,7 @@ parser.add_argument('--tile-list-file', metavar='FILE', help='Work on the listed
 parser.add_argument('--tiles-only', action='store_true', default=False, help='Only download the tile cache, no JPGs')
 parser.add_argument('--seqdir', metavar='DIR', help='Directory in which to store image sequences',default=None)
 parser.add_argument('--imgid-file', metavar='FILE', help='Only download the Mapillary image IDs found in this file (1 ID listed per line)',default=None)
+parser.add_argument('--output-filelist', metavar='FILE', help='Record the filenames of the downloaded images (including those already downloaded) in this FILE, one per line, as they are saved',default=None)
 parser.add_argument('--failed-imgid-file', metavar='FILE', help='Record failed-to-download Mapillary image IDs into this file',default=None)
 parser.add_argument('--token', metavar='TOKEN', help='Mapillary API token (see Developers help for Mapillary)',default=None)
 parser.add_argument('--token-file', metavar='FILE', help='Alternatively, read the token from this file (with the token written on a single line)',default='token.txt')
@@ -44,6 +46,7 @@ parser.add_argument('--west', default=None, metavar='LON', type=float, help='Wes
 parser.add_argument('--south', default=None, metavar='LAT', type=float, help='Southern boundary (latitude)')
 parser.add_argument('--east', default=None, metavar='LON', type=float, help='Eastern boundary (longitude)')
 parser.add_argument('--north', default=None, metavar='LAT', type=float, help='Northern boundary (latitude)')
+instrument.add_arguments(parser)
 
 def signal_handler(sig, frame):
     sys.exit(0)
@@ -64,6 +67,14 @@ def main():
 
     args = parser.parse_args()
 
+    instr = instrument.from_args('mapillary_jpg_download.py', args)
+    with instrument.profiled(args.profile, show=not args.quiet):
+        try:
+            run(args, instr)
+        finally:
+            instr.close()
+
+def run(args, instr):
     # 'verbose' log -- print to screen if quiet mode is not enabled
     def vlog(s):
         if not args.quiet:
@@ -182,25 +193,33 @@ def main():
     os.makedirs(tiledir, exist_ok=True)
     os.makedirs(seqdir, exist_ok=True)
 
+    # flushed after every line, so that the list can be followed while it is
+    # being written (e.g. by pipeline.py)
+    def record_output(imgfile):
+        if args.output_filelist is not None:
+            with open(args.output_filelist, 'a') as fp:
+                fp.write(f'{imgfile}\n')
+
     # loop through list of tiles to get tile z/x/y to plug in to Mapillary endpoints and make request
     for tile in tiles:
         tile_cache_filename = os.path.join(tiledir,'{}_{}_{}_{}'.format(tile_coverage,tile.x,tile.y,tile.z))
         if allowed_tiles is not None and '{}_{}_{}_{}'.format(tile_coverage,tile.x,tile.y,tile.z) not in allowed_tiles:
             vlog(f'Skipping tile {tile_cache_filename}: not found in --tile-list-file {args.tile_list_file}.')
             continue
-        data = {}
-        if not args.overwrite and os.path.exists(tile_cache_filename):
-            with open(tile_cache_filename) as f:
-                data = json.load(f)
-            vlog(f'Loaded tile ({tile.x}, {tile.y}, {tile.z}) cache file "{tile_cache_filename}".')
-        if not data:
-            vlog(f'Fetching tile ({tile.x}, {tile.y}, {tile.z}) from Mapillary.')
-            tile_url = 'https://tiles.mapillary.com/maps/vtp/{}/2/{}/{}/{}?access_token={}'.format(tile_coverage,tile.z,tile.x,tile.y,access_token)
-            response = requests.get(tile_url)
-            data = vt_bytes_to_geojson(response.content, tile.x, tile.y, tile.z,layer=tile_layer)
-
-            with open(tile_cache_filename,'w') as f:
-                json.dump(data, f, indent=4)
+        with instr.stage('tiles', images=0):
+            data = {}
+            if not args.overwrite and os.path.exists(tile_cache_filename):
+                with open(tile_cache_filename) as f:
+                    data = json.load(f)
+                vlog(f'Loaded tile ({tile.x}, {tile.y}, {tile.z}) cache file "{tile_cache_filename}".')
+            if not data:
+                vlog(f'Fetching tile ({tile.x}, {tile.y}, {tile.z}) from Mapillary.')
+                tile_url = 'https://tiles.mapillary.com/maps/vtp/{}/2/{}/{}/{}?access_token={}'.format(tile_coverage,tile.z,tile.x,tile.y,access_token)
+                response = requests.get(tile_url)
+                data = vt_bytes_to_geojson(response.content, tile.x, tile.y, tile.z,layer=tile_layer)
+
+                with open(tile_cache_filename,'w') as f:
+                    json.dump(data, f, indent=4)
 
         if args.tiles_only: continue
 
@@ -226,6 +245,7 @@ def main():
 
                 if not args.overwrite and os.path.isfile(imgfile) and is_jpg_file(imgfile):
                     vlog(f'Sequence {sequence_id}, image ID {image_id} is already downloaded.')
+                    record_output(imgfile)
                     continue
 
                 os.makedirs(os.path.join(seqdir,sequence_id),exist_ok=True)
@@ -236,56 +256,58 @@ def main():
 
                 vlog(f'Downloading: sequence {sequence_id}, image ID {image_id}... ')
 
-                header = {'Authorization' : 'OAuth {}'.format(access_token)}
-                url = 'https://graph.mapillary.com/{}?fields=thumb_original_url'.format(image_id)
-
-                cursleep=1
-                for retryno in range(retries+1):
-                    try:
-                        r = requests.get(url, headers=header)
-                        data = r.json()
-                    except Exception as e:
-                        vlog(f'Error obtaining thumb_original_url: {e}')
-                        data = {}
-                    if 'thumb_original_url' not in data:
-                        vlog(f'  thumb_original_url not found in {data}.')
-                        if retryno < retries:
-                            vlog(f'  retrying after {cursleep} seconds...')
-                            time.sleep(cursleep)
-                            cursleep *= 2 # exponential backoff
-                        else:
-                            vlog('  out of retries, skipping.')
-                            break
-                    else:
-                        break
-
-                if 'thumb_original_url' not in data:
-                    if args.failed_imgid_file is not None:
-                        with open(args.failed_imgid_file, 'a') as fp:
-                            fp.write(f'{image_id}\n')
-                        vlog(f'Appended an entry for the Mapillary Image ID {image_id} to {args.failed_imgid_file}.')
-                    continue # skip because unable to download
-
-                image_url = data['thumb_original_url']
+                with instr.item(imgfile), instr.stage('download'):
+                    header = {'Authorization' : 'OAuth {}'.format(access_token)}
+                    url = 'https://graph.mapillary.com/{}?fields=thumb_original_url'.format(image_id)
 
-                # save each image with ID as filename to directory by sequence ID
-                with open(imgfile, 'wb') as handler:
                     cursleep=1
                     for retryno in range(retries+1):
-                        image_data = requests.get(image_url, stream=True).content
-                        if is_jpg_data(image_data):
-                            handler.write(image_data)
-                            break
-                        else:
-                            vlog(f'  error: downloaded data for {imgfile} is not a jpeg!')
+                        try:
+                            r = requests.get(url, headers=header)
+                            data = r.json()
+                        except Exception as e:
+                            vlog(f'Error obtaining thumb_original_url: {e}')
+                            data = {}
+                        if 'thumb_original_url' not in data:
+                            vlog(f'  thumb_original_url not found in {data}.')
                             if retryno < retries:
-                                vlog(f'  retrying after waiting for {cursleep} seconds...')
+                                vlog(f'  retrying after {cursleep} seconds...')
                                 time.sleep(cursleep)
                                 cursleep *= 2 # exponential backoff
                             else:
-                                print(f'imgfile={imgfile} image_url={image_url}')
-                                print(f'download attempt out of retries, exiting...')
-                                exit(1)
+                                vlog('  out of retries, skipping.')
+                                break
+                        else:
+                            break
+
+                    if 'thumb_original_url' not in data:
+                        if args.failed_imgid_file is not None:
+                            with open(args.failed_imgid_file, 'a') as fp:
+                                fp.write(f'{image_id}\n')
+                            vlog(f'Appended an entry for the Mapillary Image ID {image_id} to {args.failed_imgid_file}.')
+                        continue # skip because unable to download
+
+                    image_url = data['thumb_original_url']
+
+                    # save each image with ID as filename to directory by sequence ID
+                    with open(imgfile, 'wb') as handler:
+                        cursleep=1
+                        for retryno in range(retries+1):
+                            image_data = requests.get(image_url, stream=True).content
+                            if is_jpg_data(image_data):
+                                handler.write(image_data)
+                                break
+                            else:
+                                vlog(f'  error: downloaded data for {imgfile} is not a jpeg!')
+                                if retryno < retries:
+                                    vlog(f'  retrying after waiting for {cursleep} seconds...')
+                                    time.sleep(cursleep)
+                                    cursleep *= 2 # exponential backoff
+                                else:
+                                    print(f'imgfile={imgfile} image_url={image_url}')
+                                    print(f'download attempt out of retries, exiting...')
+                                    exit(1)
+                record_output(imgfile)
 
 if __name__=='__main__':
     main()
@@ -0,0 +1,49 @@
+# Structured per-image metrics output, as JSON Lines.
+#
+# 'torch_process_segm.py --metrics-file FILE' appends one JSON object per line
+# for every image it processes (with "kind": "image") and for every crop taken
+# from a panoramic image ("kind": "crop"), holding the quality metrics (of
+# the crop itself, for crops), road centres, panoramic flag, matrix shape and
+# model name that otherwise only appear as free text in the verbose output. 'filter_output.py --metrics' reads
+# it back.
+#
+# All the rows for one image are written with a single write() call on a file
+# opened in append mode, while holding an exclusive lock on it, so that any
+# number of processes (e.g. 'torch_process_segm.py --jobs N', or several runs
+# at once) can append to the same file without their rows being interleaved.
+import fcntl
+import json
+import os
+import numpy as np
+
+# json.dumps fallback for numpy scalars and arrays
+def jsonable(o):
+    if isinstance(o, np.ndarray):
+        return o.tolist()
+    if isinstance(o, np.generic):
+        return o.item()
+    return str(o)
+
+def append_rows(path, rows):
+    data = ''.join(json.dumps(row, default=jsonable) + '\n' for row in rows).encode()
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        os.write(fd, data)
+    finally:
+        # closing the file also releases the lock
+        os.close(fd)
+
+# Yields the rows of a metrics file, optionally only those of the given kind
+def read_rows(path, kind=None):
+    with open(path) as fp:
+        for line in fp:
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                # partially-written final line of an interrupted run
+                continue
+            if kind is None or row.get('kind') == kind:
+                yield row
+
+# vim: ai sw=4 sts=4 ts=4 et
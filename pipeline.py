@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+# Run the whole chain of mapillary_jpg_download.py, torch_segm_images.py,
+# torch_process_segm.py and filter_output.py at once, as concurrent stages
+# connected by bounded queues, instead of one after another over the whole
+# region: segmentation starts on the first images downloaded, post-processing
+# on the first label maps, and filtering on the first metrics.
+#
+# Each stage runs as one or more long-lived worker processes of the usual
+# script, reading the names of its inputs from standard input ('-F -'). Each
+# worker records every input it has dealt with in a 'done' list, and its
+# outputs in an output list, and this script follows (tails) those lists to
+# hand the outputs on to the next stage and to keep at most --in-flight
+# inputs outstanding at each worker. When too many inputs are waiting for a
+# stage (--queue-size), the stage before it is held back: the downloader is
+# paused (SIGSTOP) and segmentation workers are given no further images.
+#
+# All the lists are kept in a work directory, and appended to as the work
+# proceeds. Running the same command again after an interruption replays
+# them, so that only the inputs that were not done are handed out again (the
+# stage scripts themselves also skip existing outputs).
+#
+# Work directory contents:
+#   downloaded.txt   images downloaded (mapillary_jpg_download.py --output-filelist)
+#   segment-done.txt images dealt with by torch_segm_images.py (--done-filelist)
+#   segmented.txt    label maps saved (torch_segm_images.py --output-filelist)
+#   process-done.txt label maps dealt with by torch_process_segm.py (--done-filelist)
+#   metrics.jsonl    metrics of each image (torch_process_segm.py --metrics-file)
+#   accepted.txt     IDs of the images accepted by the filter (as filter_output.py -o)
+#   *.log            output of each worker process
+import argparse
+import json
+import os
+import shlex
+import signal
+import subprocess
+import sys
+from collections import deque, Counter
+from pathlib import Path
+from time import time, sleep
+from image_metrics import quality_accept
+
+parser = argparse.ArgumentParser(prog='pipeline.py', description='Download, segment, process and filter images in one concurrent pipeline')
+parser.add_argument('workdir', metavar='WORKDIR', help='Directory in which to keep the state of the pipeline (created if necessary); run again with the same WORKDIR to resume')
+parser.add_argument('--verbose', '-v', action='store_true', default=False, help='Run in verbose mode')
+parser.add_argument('--download', metavar='ARGS', default=None, help='Arguments for mapillary_jpg_download.py, as one string (e.g. "-c examples/greater-amsterdam.json")')
+parser.add_argument('--images', metavar='FILE', default=None, help='Instead of --download, start from the images listed in FILE, one per line')
+parser.add_argument('--segment-workers', metavar='N', default=1, type=int, help='Number of torch_segm_images.py worker processes (default: 1)')
+parser.add_argument('--segment-args', metavar='ARGS', default='', help='Further arguments for torch_segm_images.py, as one string (e.g. "--gpu 0 --prescreen")')
+parser.add_argument('--process-workers', metavar='N', default=1, type=int, help='Number of torch_process_segm.py worker processes (default: 1)')
+parser.add_argument('--process-args', metavar='ARGS', default='', help='Further arguments for torch_process_segm.py, as one string (e.g. "-T tiles.pkl -S sqldir --fast")')
+parser.add_argument('--in-flight', metavar='N', default=2, type=int, help='Number of inputs handed to each worker at a time (default: 2)')
+parser.add_argument('--queue-size', metavar='N', default=64, type=int, help='Maximum number of inputs waiting for a stage before holding back the stage before it (default: 64)')
+parser.add_argument('--contrast-threshold', '-C', metavar='NUMBER', default=0.35, type=float, help='Minimum contrast, as in filter_output.py (default: 0.35)')
+parser.add_argument('--tone-mapping-floor', metavar='NUMBER', default=0.8, type=float, help='Tone mapping floor, as in filter_output.py (default: 0.8)')
+parser.add_argument('--disable-road-check', action='store_true', default=False, help='Do not filter out images that lack a road, as in filter_output.py')
+parser.add_argument('--status-interval', metavar='SECONDS', default=10, type=float, help='Print the progress of each stage this often (default: 10)')
+
+# How often to look for new lines in the lists, in seconds
+poll_interval = 0.2
+
+scriptdir = Path(__file__).resolve().parent
+
+# Follows a file that is being appended to, returning the complete lines
+# added since the last call (nothing if the file does not exist yet)
+class Tail:
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.partial = b''
+
+    def lines(self):
+        try:
+            with open(self.path, 'rb') as fp:
+                fp.seek(self.offset)
+                data = fp.read()
+        except FileNotFoundError:
+            return []
+        self.offset += len(data)
+        *lines, self.partial = (self.partial + data).split(b'\n')
+        return [ line.decode().strip() for line in lines if line.strip() ]
+
+# A stage of the pipeline: a queue of pending inputs, and worker processes
+# that are each handed up to --in-flight inputs at a time.
+class Stage:
+    def __init__(self, name, cmd, nworkers, workdir, in_flight, vlog):
+        self.name = name
+        self.cmd = cmd
+        self.nworkers = nworkers
+        self.workdir = workdir
+        self.in_flight = in_flight
+        self.vlog = vlog
+        self.pending = deque()
+        self.seen = set()
+        self.done = set()
+        self.inflight = {} # input -> worker number
+        self.load = Counter() # worker number -> number of inputs in flight
+        self.failed = 0
+        self.workers = []
+        self.closed = False
+
+    def start(self):
+        for i in range(self.nworkers):
+            log = open(self.workdir / f'{self.name}-{i}.log', 'a')
+            self.vlog(f'Starting {self.name} worker {i}: {shlex.join(self.cmd)}')
+            self.workers.append(subprocess.Popen(self.cmd, stdin=subprocess.PIPE, stdout=log, stderr=subprocess.STDOUT,
+                                                 text=True, bufsize=1))
+            log.close()
+
+    def add(self, item):
+        if item not in self.seen and item not in self.done:
+            self.seen.add(item)
+            self.pending.append(item)
+
+    def mark_done(self, item):
+        self.done.add(item)
+        if item in self.inflight:
+            self.load[self.inflight.pop(item)] -= 1
+
+    # Hand out pending inputs to the workers with spare capacity
+    def feed(self):
+        for i, proc in enumerate(self.workers):
+            while self.pending and self.load[i] < self.in_flight and proc.poll() is None and not self.closed:
+                item = self.pending.popleft()
+                try:
+                    proc.stdin.write(f'{item}\n')
+                except BrokenPipeError:
+                    self.pending.appendleft(item)
+                    break
+                self.inflight[item] = i
+                self.load[i] += 1
+
+    # Which workers have exited (noted before reading the lists, so that the
+    # last lines a worker wrote before exiting are not missed)
+    def exited_workers(self):
+        return [ proc.poll() is not None for proc in self.workers ]
+
+    # Give up on the inputs still in flight at workers that had exited: they
+    # are not marked as done, so they are handed out again when resuming.
+    def reap(self, exited):
+        for i, proc in enumerate(self.workers):
+            if exited[i] and self.load[i] > 0:
+                lost = [ item for item, w in self.inflight.items() if w == i ]
+                for item in lost:
+                    del self.inflight[item]
+                self.load[i] = 0
+                self.failed += len(lost)
+                print(f'{self.name} worker {i} exited (status {proc.returncode}) without finishing: {" ".join(lost)}; '
+                      f'see "{self.workdir / f"{self.name}-{i}.log"}".')
+
+    def idle(self):
+        return not self.pending and not self.inflight
+
+    # No more inputs: let the workers finish and exit
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            for proc in self.workers:
+                try:
+                    proc.stdin.close()
+                except BrokenPipeError:
+                    pass
+
+    def terminate(self):
+        for proc in self.workers:
+            if proc.poll() is None:
+                proc.terminate()
+        for proc in self.workers:
+            proc.wait()
+
+    def status(self):
+        return f'{self.name}: {len(self.pending)} waiting, {len(self.inflight)} in progress, {len(self.done)} done' + \
+               (f', {self.failed} lost' if self.failed else '')
+
+# Whether the option is among the arguments in argstring
+def has_option(argstring, option):
+    return any(a == option or a.startswith(f'{option}=') for a in shlex.split(argstring))
+
+def main():
+    args = parser.parse_args()
+    def vlog(s):
+        if args.verbose:
+            print(s, flush=True)
+
+    if (args.download is None) == (args.images is None):
+        parser.error('exactly one of --download or --images is required')
+    # with --store, the label maps are handed on by the names of their images,
+    # which torch_process_segm.py only looks up in a store
+    if has_option(args.segment_args, '--store') != has_option(args.process_args, '--store'):
+        parser.error('--store must be given in both --segment-args and --process-args, or in neither')
+
+    workdir = Path(args.workdir)
+    os.makedirs(workdir, exist_ok=True)
+    downloaded = workdir / 'downloaded.txt'
+    segmentdone = workdir / 'segment-done.txt'
+    segmented = workdir / 'segmented.txt'
+    processdone = workdir / 'process-done.txt'
+    metricsfile = workdir / 'metrics.jsonl'
+    acceptedfile = workdir / 'accepted.txt'
+
+    python = sys.executable
+    segment = Stage('segment', [ python, str(scriptdir / 'torch_segm_images.py'), '-F', '-',
+                                 '--output-filelist', str(segmented), '--done-filelist', str(segmentdone),
+                                 *shlex.split(args.segment_args) ],
+                    args.segment_workers, workdir, args.in_flight, vlog)
+    process = Stage('process', [ python, str(scriptdir / 'torch_process_segm.py'), '-F', '-',
+                                 '--metrics-file', str(metricsfile), '--done-filelist', str(processdone),
+                                 *shlex.split(args.process_args) ],
+                    args.process_workers, workdir, args.in_flight, vlog)
+
+    # Replay the work already done, so that only the rest is handed out
+    segmentdonetail = Tail(segmentdone)
+    segmentedtail = Tail(segmented)
+    processdonetail = Tail(processdone)
+    for item in segmentdonetail.lines():
+        segment.mark_done(item)
+    for item in processdonetail.lines():
+        process.mark_done(item)
+    vlog(f'Resuming with {len(segment.done)} image(s) segmented and {len(process.done)} label map(s) processed.')
+
+    if args.images is not None:
+        with open(args.images) as fp:
+            for name in fp:
+                if name.strip(): segment.add(name.strip())
+        downloader = None
+        downloadedtail = None
+    else:
+        cmd = [ python, str(scriptdir / 'mapillary_jpg_download.py'), '--output-filelist', str(downloaded),
+                *shlex.split(args.download) ]
+        vlog(f'Starting downloader: {shlex.join(cmd)}')
+        with open(workdir / 'download.log', 'a') as log:
+            downloader = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+        downloadedtail = Tail(downloaded)
+    paused = False
+
+    # The filter is applied to the metrics as they arrive; the metrics file is
+    # replayed from the start, so the list of accepted images is rewritten.
+    metricstail = Tail(metricsfile)
+    accepted = set()
+    filtered = 0
+    acceptedfp = open(acceptedfile, 'w')
+    def do_metrics(row):
+        nonlocal filtered
+        if row.get('kind') != 'image' or 'skimage_contrast' not in row:
+            return
+        filtered += 1
+        accept = quality_accept(row['skimage_contrast'], row['tone_mapping'], args.contrast_threshold, args.tone_mapping_floor)
+        if not args.disable_road_check:
+            accept = accept and len(row.get('centres') or []) == 1
+        if accept and row['imgid'] not in accepted:
+            accepted.add(row['imgid'])
+            acceptedfp.write(f'{row["imgid"]}\n')
+            acceptedfp.flush()
+
+    def status():
+        if downloader is None or downloader.poll() is not None:
+            download = 'finished'
+        else:
+            download = 'paused' if paused else 'running'
+        print(f'[{time()-t1:.0f}s] download: {download}; {segment.status()}; {process.status()}; '
+              f'filter: {len(accepted)} of {filtered} accepted.', flush=True)
+
+    t1 = time()
+    lastclock = t1
+    segment.start()
+    process.start()
+    try:
+        while True:
+            # Whether each stage had finished is noted before reading the
+            # lists, so that its final lines are not missed.
+            sourcedone = downloader is None or downloader.poll() is not None
+            segmentworkers = segment.exited_workers()
+            processworkers = process.exited_workers()
+
+            if downloadedtail is not None:
+                for item in downloadedtail.lines():
+                    segment.add(item)
+            for item in segmentdonetail.lines():
+                segment.mark_done(item)
+            for item in segmentedtail.lines():
+                process.add(item)
+            for item in processdonetail.lines():
+                process.mark_done(item)
+            for line in metricstail.lines():
+                try:
+                    do_metrics(json.loads(line))
+                except json.JSONDecodeError:
+                    pass
+            segment.reap(segmentworkers)
+            process.reap(processworkers)
+            segmentexited = all(segmentworkers)
+            processexited = all(processworkers)
+
+            # Backpressure: hold back the downloader while the segmentation
+            # queue is full, and the segmentation while the processing queue is.
+            if downloader is not None and not sourcedone:
+                if not paused and len(segment.pending) >= args.queue_size:
+                    vlog(f'Pausing the downloader: {len(segment.pending)} image(s) waiting for segmentation.')
+                    downloader.send_signal(signal.SIGSTOP)
+                    paused = True
+                elif paused and len(segment.pending) <= args.queue_size // 2:
+                    vlog('Resuming the downloader.')
+                    downloader.send_signal(signal.SIGCONT)
+                    paused = False
+            if len(process.pending) < args.queue_size:
+                segment.feed()
+            process.feed()
+
+            if sourcedone and segment.idle():
+                segment.close()
+            if segmentexited and process.idle():
+                process.close()
+            if segmentexited and processexited:
+                break
+            stuck = [ stage for stage, exited in ((segment, segmentexited), (process, processexited))
+                      if exited and not stage.closed ]
+            if stuck:
+                print(f'All the {stuck[0].name} workers have exited (see "{workdir / stuck[0].name}-*.log"); '
+                      'giving up (run again to resume).')
+                break
+
+            if time() - lastclock >= args.status_interval:
+                lastclock = time()
+                status()
+            sleep(poll_interval)
+    except KeyboardInterrupt:
+        print('Interrupted; run the same command again to resume.')
+    finally:
+        if downloader is not None and downloader.poll() is None:
+            if paused:
+                downloader.send_signal(signal.SIGCONT)
+            downloader.terminate()
+            downloader.wait()
+        segment.terminate()
+        process.terminate()
+        acceptedfp.close()
+    status()
+    print(f'Accepted image IDs are in "{acceptedfile}".')
+    if not (segment.closed and process.closed):
+        sys.exit(1)
+
+if __name__=='__main__':
+    main()
+
+# vim: ai sw=4 sts=4 ts=4 et
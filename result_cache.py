@@ -0,0 +1,140 @@
+# Cache of intermediate results, for incremental reprocessing.
+#
+# torch_process_segm.py --cache-dir DIR stores the results of each stage of
+# its processing of an image (image metrics, road centres, vanishing points,
+# and the final outcome) under a key computed from everything that the stage
+# depends on: the identity of its input files (path, size and modification
+# time) and the values of the relevant parameters. When it is run again, a
+# stage whose key is unchanged is not computed again, and an image for which
+# nothing at all has changed is skipped entirely.
+#
+# The entries (small JSON values) are kept in one SQLite database in the
+# cache directory, so that millions of them do not take millions of files,
+# and so that they can be written by any number of processes at once (each
+# write is a short transaction). Reading an entry records when it was last
+# used, and once the cache grows beyond its size budget, the least recently
+# used entries are removed. The total size of the entries is kept up to date
+# in the database itself (by triggers) as entries are added and removed, so
+# that no process has to go through all the entries to find it.
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+schema = '''
+BEGIN IMMEDIATE;
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_used ON entries (used);
+CREATE TABLE IF NOT EXISTS total (bytes INTEGER NOT NULL);
+INSERT INTO total SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM total);
+CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries
+    BEGIN UPDATE total SET bytes = bytes + new.size; END;
+CREATE TRIGGER IF NOT EXISTS entries_update AFTER UPDATE OF size ON entries
+    BEGIN UPDATE total SET bytes = bytes + new.size - old.size; END;
+CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries
+    BEGIN UPDATE total SET bytes = bytes - old.size; END;
+COMMIT;
+'''
+
+# Identity of an input file, for use in a key: changes if the file is
+# replaced or modified (or removed, in which case it is None).
+def file_identity(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [ str(Path(path).resolve()), st.st_size, st.st_mtime_ns ]
+
+class ResultCache:
+    def __init__(self, cachedir, max_bytes=1<<30):
+        self.cachedir = Path(cachedir)
+        os.makedirs(self.cachedir, exist_ok=True)
+        self.path = self.cachedir / 'cache.sqlite'
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        self.pid = None
+        self._db = None
+        self.db.executescript(schema)
+        self.hits = 0
+        self.misses = 0
+
+    # The connection of this process: the worker processes forked after the
+    # cache is opened (e.g. by torch_process_segm.py --jobs) each open their
+    # own, as an SQLite connection must not be used across a fork
+    @property
+    def db(self):
+        if self.pid != os.getpid():
+            # transactions are begun explicitly (see transaction), waiting for
+            # up to the timeout for other processes to finish theirs
+            self._db = sqlite3.connect(self.path, timeout=600, isolation_level=None, check_same_thread=False)
+            self.pid = os.getpid()
+        return self._db
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            db = self.db
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+
+    # The key of an entry of the given stage: a hash of the stage name and
+    # the given values (which must be JSON-serialisable, or convertible with str).
+    def key(self, stage, **parts):
+        data = json.dumps(parts, sort_keys=True, default=str)
+        return f'{stage}-{hashlib.sha256(data.encode()).hexdigest()}'
+
+    # Returns the value stored under key, or None if there is none.
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute('SELECT value FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                self.db.execute('UPDATE entries SET used = ? WHERE key = ?', (time.time(), key))
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        data = json.dumps(value)
+        with self.transaction() as db:
+            db.execute('INSERT INTO entries (key, value, size, used) VALUES (?, ?, ?, ?) '
+                       'ON CONFLICT (key) DO UPDATE SET value = excluded.value, size = excluded.size, used = excluded.used',
+                       (key, data, len(key) + len(data.encode()), time.time()))
+            if self.total_bytes(db) > self.max_bytes:
+                self.evict(db)
+
+    # Total size of the entries (their keys and JSON values, not counting
+    # the overhead of the database)
+    def total_bytes(self, db=None):
+        return (db or self.db).execute('SELECT bytes FROM total').fetchone()[0]
+
+    # Remove the least recently used entries until the cache is back to 90%
+    # of its size budget.
+    def evict(self, db=None):
+        if db is None:
+            with self.transaction() as db:
+                return self.evict(db)
+        excess = self.total_bytes(db) - int(self.max_bytes * 0.9)
+        evicted = []
+        for key, size in db.execute('SELECT key, size FROM entries ORDER BY used'):
+            if excess <= 0: break
+            evicted.append((key,))
+            excess -= size
+        db.executemany('DELETE FROM entries WHERE key = ?', evicted)
+
+# vim: ai sw=4 sts=4 ts=4 et
@@ -0,0 +1,300 @@
+# Server and client for running torch_segm_images.py as a persistent service.
+#
+# Loading the model takes far longer than segmenting a handful of images, so
+# 'torch_segm_images.py --serve SOCKET' loads it once and then waits for jobs
+# on a Unix socket, and 'torch_segm_images.py --server SOCKET ...' submits
+# jobs to it, taking the same arguments as a normal run.
+#
+# The protocol is one JSON object per line in each direction. Requests:
+#   {"op": "segment", "id": ID, "path": FILENAME, "options": {...}}
+#   {"op": "segment", "id": ID, "name": FILENAME, "data": BASE64-JPEG, "options": {...}}
+#   {"op": "status"}
+# Responses to "segment" carry the same ID and a "status" of "done",
+# "skipped" or "failed", and arrive as the jobs complete (not necessarily in
+# order). With "path", the server checks for existing output, pre-screens the
+# image and writes the output itself, replying with its "output" name. With
+# "data", the reply carries the label map in "predict" (base64 of a
+# segm_store-encoded array): the client checks for existing output and
+# pre-screens the image before sending it, and saves the label map itself.
+#
+# Jobs are gathered into micro-batches of equally-sized images (up to
+# --max-batch, waiting at most --batch-wait milliseconds for a batch to fill).
+import base64
+import io
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+from argparse import Namespace
+from collections import deque
+from pathlib import Path
+from time import time
+import numpy as np
+from segm_store import encode_predict, decode_predict
+import instrument
+
+# Arguments that a client may set per job; the others are fixed by the server
+job_options = [ 'overwrite', 'dry_run', 'output_extension', 'no_detect_panoramic', 'scaledown_factor', 'scaledown_interp',
+                'prescreen', 'prescreen_scale', 'contrast_threshold', 'tone_mapping_floor' ]
+
+# Maximum number of jobs a client keeps outstanding at the server
+client_window = 64
+
+def serve(args, vlog, seg):
+    jobs = queue.Queue()
+    lock = threading.Lock()
+    stats = { 'received': 0, 'done': 0, 'skipped': 0, 'rejected': 0, 'failed': 0, 'batches': 0, 'in_progress': 0 }
+    latencies = deque(maxlen=1000)
+    starttime = time()
+
+    def status():
+        with lock:
+            lat = np.array(latencies) if latencies else np.zeros(1)
+            return { **stats, 'queue_depth': jobs.qsize(), 'modelname': args.modelname,
+                     'uptime': time() - starttime, 'num_labels': seg.num_labels,
+                     'mean_batch_size': stats['done'] / stats['batches'] if stats['batches'] else 0,
+                     'latency_mean': float(lat.mean()), 'latency_p50': float(np.percentile(lat, 50)),
+                     'latency_p95': float(np.percentile(lat, 95)) }
+
+    def count(key, n=1):
+        with lock:
+            stats[key] += n
+
+    # Called in the connection's thread: check for existing output and load
+    # the image, then queue it for the model thread.
+    def submit(req, reply, t0):
+        opts = Namespace(**vars(args))
+        for k, v in req.get('options', {}).items():
+            if k in job_options: setattr(opts, k, v)
+        # the client keeps its own --output-filelist
+        opts.output_filelist = None
+        count('received')
+        quality = None
+        try:
+            if 'data' in req:
+                inputpath = Path(req['name'])
+                img = seg.load_image(inputpath, opts, fp=io.BytesIO(base64.b64decode(req['data'])))
+            else:
+                inputpath = Path(req['path'])
+                output = seg.existing_output(inputpath, opts)
+                if output is not None:
+                    count('skipped')
+                    reply({ 'id': req.get('id'), 'status': 'skipped', 'output': output })
+                    return
+                if opts.prescreen:
+                    quality = seg.prescreen(inputpath, opts)
+                    if quality is None:
+                        count('rejected')
+                        reply({ 'id': req.get('id'), 'status': 'rejected' })
+                        return
+                img = seg.load_image(inputpath, opts)
+        except Exception as e:
+            vlog(f'Failed: {e}.')
+            count('failed')
+            reply({ 'id': req.get('id'), 'status': 'failed', 'error': str(e) })
+            return
+        jobs.put((req, inputpath, img, opts, quality, reply, t0))
+
+    def model_thread():
+        while True:
+            batch = [ jobs.get() ]
+            deadline = time() + args.batch_wait / 1000
+            while len(batch) < args.max_batch:
+                try:
+                    batch.append(jobs.get(timeout=max(0, deadline - time())))
+                except queue.Empty:
+                    break
+            with lock:
+                stats['in_progress'] = len(batch)
+            # only images of the same size can be batched without changing the results
+            bysize = {}
+            for job in batch:
+                bysize.setdefault(job[2].size, []).append(job)
+            for group in bysize.values():
+                t1 = time()
+                try:
+                    with seg.instr.stage('inference', images=len(group)):
+                        predicts = seg.segment([ job[2] for job in group ])
+                except Exception as e:
+                    vlog(f'Failed batch: {e}.')
+                    predicts = [ e ] * len(group)
+                count('batches')
+                for (req, inputpath, img, opts, quality, reply, t0), predict in zip(group, predicts):
+                    resp = { 'id': req.get('id') }
+                    try:
+                        if isinstance(predict, Exception): raise predict
+                        if 'data' in req:
+                            resp['predict'] = base64.b64encode(encode_predict(predict)).decode('ascii')
+                        else:
+                            resp['output'] = seg.save(inputpath, predict, opts, quality=quality)
+                        resp['status'] = 'done'
+                        count('done')
+                    except Exception as e:
+                        if 'data' not in req:
+                            seg.record_failure(inputpath, e)
+                        resp.update({ 'status': 'failed', 'error': str(e) })
+                        count('failed')
+                    with lock:
+                        latencies.append(time() - t0)
+                    reply(resp)
+                seg.instr.finished(len(group))
+                vlog(f'Batch of {len(group)} image(s) of size {group[0][2].size[0]}x{group[0][2].size[1]} in {time()-t1:.2f}s; queue depth={jobs.qsize()}.')
+            with lock:
+                stats['in_progress'] = 0
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            wlock = threading.Lock()
+            def reply(obj):
+                with wlock:
+                    try:
+                        self.wfile.write((json.dumps(obj) + '\n').encode())
+                        self.wfile.flush()
+                    except (OSError, ValueError):
+                        pass # client went away
+            try:
+                for line in self.rfile:
+                    t0 = time()
+                    try:
+                        req = json.loads(line)
+                    except json.JSONDecodeError:
+                        reply({ 'status': 'failed', 'error': 'invalid request' })
+                        continue
+                    if req.get('op') == 'status':
+                        reply(status())
+                    elif req.get('op') == 'segment':
+                        submit(req, reply, t0)
+                    else:
+                        reply({ 'id': req.get('id'), 'status': 'failed', 'error': f'unknown op {req.get("op")}' })
+            except ConnectionError:
+                pass # client went away
+
+    if os.path.exists(args.serve):
+        os.unlink(args.serve)
+    server = socketserver.ThreadingUnixStreamServer(args.serve, Handler)
+    server.daemon_threads = True
+    threading.Thread(target=model_thread, daemon=True).start()
+    print(f'Serving on "{args.serve}" (model "{args.modelname}").', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.serve)
+        seg.finish()
+
+def client(args, vlog, inputs):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(args.server)
+    rfile = sock.makefile('rb')
+    wfile = sock.makefile('wb')
+    def send(obj):
+        wfile.write((json.dumps(obj) + '\n').encode())
+        wfile.flush()
+
+    if args.server_status:
+        send({ 'op': 'status' })
+        print(json.dumps(json.loads(rfile.readline()), indent=2))
+        return
+
+    # With --send-data, the label maps are saved here, as torch_segm_images.py
+    # would (into the --store, or as npz or npy files), so the existing
+    # output and the pre-screen are checked here as well before sending
+    out = None
+    if args.send_data:
+        from torch_segm_images import setup_output
+        send({ 'op': 'status' })
+        server = json.loads(rfile.readline())
+        npy_dtype = np.uint8 if server['num_labels'] <= 256 else np.int32
+        instr = instrument.from_args('torch_segm_images.py', args)
+        out = setup_output(args, vlog, instr, server['modelname'], npy_dtype)
+
+    options = { k: getattr(args, k) for k in job_options }
+    window = threading.Semaphore(client_window)
+    paths = {}
+    sent = { 'count': 0, 'finished': False }
+    counts = { 'done': 0, 'skipped': 0, 'rejected': 0, 'failed': 0 }
+    lock = threading.Lock()
+
+    # Deal with the response to the job of the input (name, p), whether
+    # from the server or not sent at all (existing or rejected)
+    def finished(name, p, resp, quality=None):
+        with lock:
+            output = resp.get('output')
+            if 'predict' in resp:
+                try:
+                    output = out.save(p, decode_predict(base64.b64decode(resp['predict'])), quality=quality)
+                except Exception as e:
+                    resp = { 'status': 'failed', 'error': str(e) }
+            counts[resp['status']] = counts.get(resp['status'], 0) + 1
+            if resp['status'] == 'failed':
+                vlog(f'Failed "{p}": {resp.get("error")}.')
+                if out is not None:
+                    out.record_failure(p, resp.get('error'))
+            if output is not None:
+                vlog(f'{resp["status"].capitalize()}: "{p}" -> "{output}".')
+                # (with --send-data, recorded by out)
+                if args.output_filelist is not None and out is None:
+                    with open(args.output_filelist, 'a') as fp:
+                        fp.write(f'{output}\n')
+            if args.done_filelist is not None:
+                with open(args.done_filelist, 'a') as fp:
+                    fp.write(f'{name}\n')
+
+    # inputs: (name, path) pairs, the name being recorded in --done-filelist
+    def sender():
+        for i, (name, p) in enumerate(inputs):
+            quality = None
+            req = { 'op': 'segment', 'id': i, 'options': options }
+            if args.send_data:
+                try:
+                    output = out.existing_output(p)
+                    if output is not None:
+                        finished(name, p, { 'status': 'skipped', 'output': output })
+                        continue
+                    if args.prescreen:
+                        quality = out.prescreen(p)
+                        if quality is None:
+                            finished(name, p, { 'status': 'rejected' })
+                            continue
+                    req['name'] = str(p)
+                    with open(p, 'rb') as fp:
+                        req['data'] = base64.b64encode(fp.read()).decode('ascii')
+                except Exception as e:
+                    finished(name, p, { 'status': 'failed', 'error': str(e) })
+                    continue
+            else:
+                # the server may be running in another directory
+                req['path'] = str(p.resolve())
+            window.acquire()
+            paths[i] = (name, p, quality)
+            send(req)
+            sent['count'] += 1
+        sent['finished'] = True
+        # wake up the receiving loop in case everything was already answered
+        send({ 'op': 'status' })
+
+    t1 = time()
+    threading.Thread(target=sender, daemon=True).start()
+    received = 0
+    while not sent['finished'] or received < sent['count']:
+        line = rfile.readline()
+        if not line:
+            print('Server closed the connection.')
+            break
+        resp = json.loads(line)
+        if 'id' not in resp: continue # status reply
+        received += 1
+        window.release()
+        name, p, quality = paths.pop(resp['id'])
+        finished(name, p, resp, quality=quality)
+    if out is not None:
+        out.close()
+        instr.close()
+    total = sum(counts.values())
+    vlog(f'Completed {total} job(s) ({counts["done"]} done, {counts["skipped"]} skipped, {counts["rejected"]} rejected, {counts["failed"]} failed) in {time()-t1:.2f}s.')
+
+# vim: ai sw=4 sts=4 ts=4 et
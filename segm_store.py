@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# Sharded storage for segmentation label maps.
+#
+# Instead of writing one '.npz' file next to every image, many label maps are
+# packed into a small number of large 'shard' files inside a single store
+# directory. Each shard is accompanied by an index file with one JSON line per
+# record giving the image key (the image filename stem, i.e. the Mapillary
+# image ID), the byte offset and length of the record within the shard, and
+# some metadata (source image path, model name).
+#
+# Every writer process creates its own uniquely-named shards, so any number of
+# writers (on one or more machines sharing a filesystem) can add to the same
+# store at once without locking. A record is only listed in the index after
+# its data has been written out, so an interrupted writer leaves at worst some
+# unreferenced bytes at the end of its last shard.
+#
+# Can also be run as a command to list the contents of a store, or to export
+# records back into individual '.npz' files.
+import argparse
+import io
+import json
+import os
+import socket
+import zlib
+from pathlib import Path
+from time import time
+import numpy as np
+
+shard_suffix = '.shard'
+index_suffix = '.idx'
+
+# Serialise a label map as a zlib-compressed .npy blob (self-describing shape & dtype)
+def encode_predict(predict, level=6):
+    buf = io.BytesIO()
+    np.save(buf, predict, allow_pickle=False)
+    return zlib.compress(buf.getvalue(), level)
+
+def decode_predict(blob):
+    return np.load(io.BytesIO(zlib.decompress(blob)), allow_pickle=False)
+
+class ShardWriter:
+    """ Appends label maps to shards owned exclusively by this writer.
+        A new shard is started once the current one exceeds max_shard_bytes. """
+    def __init__(self, storedir, max_shard_bytes=1<<30, compresslevel=6):
+        self.storedir = Path(storedir)
+        os.makedirs(self.storedir, exist_ok=True)
+        self.max_shard_bytes = max_shard_bytes
+        self.compresslevel = compresslevel
+        # unique prefix for the shards of this writer: host, process and start time
+        self.prefix = f'{socket.gethostname()}-{os.getpid()}-{int(time()*1000)}'
+        self.shardno = -1
+        self.shardfp = None
+        self.indexfp = None
+
+    def _next_shard(self):
+        self.close()
+        self.shardno += 1
+        name = f'{self.prefix}-{self.shardno:04d}'
+        self.shardname = name + shard_suffix
+        self.shardfp = open(self.storedir / self.shardname, 'ab')
+        self.indexfp = open(self.storedir / (name + index_suffix), 'a')
+
+    # quality: optional dict of image quality scores (see torch_segm_images.py --prescreen)
+    def put(self, key, predict, path=None, modelname=None, quality=None):
+        if self.shardfp is None or self.shardfp.tell() >= self.max_shard_bytes:
+            self._next_shard()
+        blob = encode_predict(predict, self.compresslevel)
+        offset = self.shardfp.tell()
+        self.shardfp.write(blob)
+        self.shardfp.flush()
+        entry = { 'key': str(key), 'shard': self.shardname, 'offset': offset, 'length': len(blob),
+                  'shape': list(predict.shape), 'path': None if path is None else str(path),
+                  'modelname': modelname, 'time': time() }
+        if quality is not None:
+            entry['quality'] = quality
+        self.indexfp.write(json.dumps(entry) + '\n')
+        self.indexfp.flush()
+
+    def close(self):
+        if self.shardfp is not None:
+            self.shardfp.close()
+            self.indexfp.close()
+            self.shardfp = None
+            self.indexfp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class SegmStore:
+    """ Read access to a store directory: iterate over all records, or look
+        up a single label map by key. The index is read when the store is
+        opened (or refreshed), so records added afterwards by other writers
+        are only seen after calling update() (which reads only the index
+        lines added since, and returns the number of records read) or
+        refresh(). """
+    def __init__(self, storedir):
+        self.storedir = Path(storedir)
+        self.refresh()
+
+    def refresh(self):
+        self.index = {}
+        # bytes of each index file read so far (complete lines only)
+        self.offsets = {}
+        self.update()
+
+    def update(self):
+        if not self.storedir.is_dir(): return 0
+        shardsizes = {}
+        nread = 0
+        for idxfile in sorted(self.storedir.glob(f'*{index_suffix}')):
+            offset = self.offsets.get(idxfile.name, 0)
+            with open(idxfile, 'rb') as fp:
+                fp.seek(offset)
+                data = fp.read()
+            for line in data.splitlines(keepends=True):
+                if not line.endswith(b'\n'):
+                    # still being written: read again next time
+                    break
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # partially-written final line of an interrupted writer
+                    offset += len(line)
+                    continue
+                shard = entry['shard']
+                if shard not in shardsizes:
+                    shardpath = self.storedir / shard
+                    shardsizes[shard] = shardpath.stat().st_size if shardpath.exists() else 0
+                if entry['offset'] + entry['length'] > shardsizes[shard]:
+                    # the label map is not visible yet (e.g. over NFS, the
+                    # index can be seen before the shard): read this line
+                    # and those after it again next time
+                    break
+                offset += len(line)
+                nread += 1
+                # if the same key was written more than once, the latest one wins
+                prev = self.index.get(entry['key'])
+                if prev is None or prev['time'] <= entry['time']:
+                    self.index[entry['key']] = entry
+            self.offsets[idxfile.name] = offset
+        return nread
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return str(key) in self.index
+
+    def keys(self):
+        return self.index.keys()
+
+    def entry(self, key):
+        return self.index[str(key)]
+
+    def get(self, key):
+        entry = self.index[str(key)]
+        with open(self.storedir / entry['shard'], 'rb') as fp:
+            fp.seek(entry['offset'])
+            return decode_predict(fp.read(entry['length']))
+
+    # Yields (key, predict, entry) tuples, reading each shard sequentially.
+    def __iter__(self):
+        byshard = {}
+        for entry in self.index.values():
+            byshard.setdefault(entry['shard'], []).append(entry)
+        for shard in sorted(byshard):
+            with open(self.storedir / shard, 'rb') as fp:
+                for entry in sorted(byshard[shard], key=lambda e: e['offset']):
+                    fp.seek(entry['offset'])
+                    yield entry['key'], decode_predict(fp.read(entry['length'])), entry
+
+parser = argparse.ArgumentParser(prog='segm_store.py', description='List or export the contents of a sharded segmentation store')
+parser.add_argument('store', metavar='DIR', help='Store directory (see torch_segm_images.py --store)')
+parser.add_argument('--export', metavar='DIR', default=None, help='Write every record as an individual .npz file into DIR')
+parser.add_argument('--overwrite', '-O', action='store_true', default=False, help='Overwrite any existing exported file')
+
+def main():
+    args = parser.parse_args()
+    store = SegmStore(args.store)
+    if args.export is None:
+        for key in sorted(store.keys()):
+            e = store.entry(key)
+            print(f'{key}\t{"x".join(map(str, e["shape"]))}\t{e["path"]}\t{e["shard"]}:{e["offset"]}')
+        return
+    os.makedirs(args.export, exist_ok=True)
+    for key, predict, entry in store:
+        outputpath = Path(args.export) / f'{key}.npz'
+        if outputpath.exists() and not args.overwrite: continue
+        np.savez_compressed(str(outputpath), predict=predict, modelname=entry['modelname'] or '')
+        print(f'Exported {outputpath}')
+
+if __name__=='__main__':
+    main()
+
+# vim: ai sw=4 sts=4 ts=4 et
@@ -0,0 +1,155 @@
+# Tests that loading the files written by torch_process_segm.py --sql-bulk-dir
+# as load_bulk_sql.sh does gives the same image and image_geo tables as
+# running the per-image _insert.sql and _enable.sql files of --sqloutdir, with
+# SQLite standing in for PostgreSQL (run with pytest).
+import re
+import sqlite3
+import subprocess
+from pathlib import Path
+import numpy as np
+import pytest
+import torch_process_segm
+from benchmark import pano_label_map, photo_label_map, synthetic_image, write_jpeg, write_tiles
+
+##################################################
+# SQLite stand-in for the PostgreSQL database
+
+schema = '''
+CREATE TABLE image (image_id INTEGER PRIMARY KEY, url TEXT, system_path TEXT UNIQUE, cityname TEXT, enabled BOOLEAN);
+CREATE TABLE image_geo (angle_deg REAL, geo TEXT, image_id INTEGER UNIQUE);
+'''
+
+def connect():
+    db = sqlite3.connect(':memory:', isolation_level=None)
+    # (PostGIS) the point is kept as its WKT, with its SRID
+    db.create_function('ST_MakePoint', 2, lambda lon, lat: f'POINT({float(lon)!r} {float(lat)!r})')
+    db.create_function('ST_SetSRID', 2, lambda geom, srid: f'SRID={srid};{geom}')
+    db.executescript(schema)
+    return db
+
+# Run an _insert.sql file, whose INSERT INTO image ... RETURNING within a WITH
+# clause (not supported by SQLite) is run first, its image IDs standing in
+# for the image_ins table of the INSERT INTO image_geo that follows
+def run_insert_sql(db, sql):
+    m = re.fullmatch(r'\s*WITH image_ins AS \(\s*(INSERT INTO image .*? RETURNING image_id)\s*\)\s*(INSERT INTO image_geo .*);\s*', sql, re.S)
+    assert m is not None, sql
+    ids = db.execute(m[1]).fetchall()
+    db.execute('CREATE TEMP TABLE image_ins (image_id INTEGER)')
+    db.executemany('INSERT INTO image_ins VALUES (?)', ids)
+    # (SQLite needs a WHERE clause before the ON CONFLICT of an INSERT ... SELECT)
+    db.execute(m[2].replace('::geometry(POINT, 4326)', '').replace(' ON CONFLICT', ' WHERE true ON CONFLICT'))
+    db.execute('DROP TABLE image_ins')
+
+# A field in PostgreSQL's COPY text format (as written by copy_field)
+def copy_value(s):
+    if s == '\\N':
+        return None
+    return re.sub(r'\\(.)', lambda m: { 't': '\t', 'n': '\n', 'r': '\r' }.get(m[1], m[1]), s)
+
+# Load the bulk files as load_bulk_sql.sh does: copied into a temporary
+# table, deduplicated on the system path, inserted into image and image_geo
+# in one go, and then enabled (all of them, or those of the accepted IDs)
+def load_bulk(db, bulkdir, accepted=None, enable_all=False):
+    db.execute('''CREATE TEMP TABLE bulk_image (imgid TEXT, seqid TEXT, stem TEXT, url TEXT, system_path TEXT, cityname TEXT,
+                                                angle_deg REAL, lon REAL, lat REAL)''')
+    for f in sorted(Path(bulkdir).glob(f'*{torch_process_segm.bulk_suffix}')):
+        with open(f) as fp:
+            rows = [ [ copy_value(v) for v in line.rstrip('\n').split('\t') ] for line in fp ]
+        assert all(len(row) == 9 for row in rows)
+        db.executemany('INSERT INTO bulk_image VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    # (DISTINCT ON (system_path) in PostgreSQL; the WHERE clauses before
+    # ON CONFLICT below are needed by SQLite)
+    db.execute('CREATE TEMP TABLE bulk_image_unique AS SELECT * FROM bulk_image WHERE rowid IN (SELECT MIN(rowid) FROM bulk_image GROUP BY system_path) ORDER BY system_path')
+    ids = db.execute("INSERT INTO image (url, system_path, cityname, enabled) SELECT url, system_path, cityname, false FROM bulk_image_unique WHERE true "
+                     "ON CONFLICT DO NOTHING RETURNING image_id, system_path").fetchall()
+    db.execute('CREATE TEMP TABLE image_ins (image_id INTEGER, system_path TEXT)')
+    db.executemany('INSERT INTO image_ins VALUES (?, ?)', ids)
+    db.execute('''INSERT INTO image_geo (angle_deg, geo, image_id)
+                    SELECT b.angle_deg, ST_SetSRID(ST_MakePoint(b.lon, b.lat),4326), i.image_id
+                    FROM image_ins i JOIN bulk_image_unique b USING (system_path) WHERE true ON CONFLICT DO NOTHING''')
+    if accepted is not None:
+        db.execute(f'UPDATE image SET enabled=true FROM bulk_image_unique b WHERE image.system_path = b.system_path AND b.imgid IN ({",".join("?" * len(accepted))})',
+                   [ str(imgid) for imgid in accepted ])
+    elif enable_all:
+        db.execute('UPDATE image SET enabled=true WHERE system_path IN (SELECT system_path FROM bulk_image_unique)')
+
+# The contents of the tables, independent of the order in which the image
+# IDs were given out
+def tables(db):
+    return sorted(db.execute('SELECT i.url, i.system_path, i.cityname, i.enabled, g.angle_deg, g.geo FROM image i LEFT JOIN image_geo g USING (image_id)').fetchall())
+
+##################################################
+# Fixtures
+
+# A panoramic image (with crops) and a non-panoramic one, processed twice
+# (as by a re-run), with both --sqloutdir and --sql-bulk-dir
+@pytest.fixture(scope='module')
+def outputs(tmp_path_factory):
+    d = tmp_path_factory.mktemp('bulk')
+    rng = np.random.default_rng(0)
+    # image 5000 is panoramic (see benchmark.tile_features), 5001 is not
+    write_tiles(d / 'tiles', 1, 2, rng, firstid=5000)
+    for imgid, labels in ((5000, pano_label_map(rng)), (5001, photo_label_map(rng))):
+        np.savez_compressed(d / f'{imgid}.npz', predict=labels, modelname='synthetic_citys')
+        write_jpeg(d / f'{imgid}.jpg', synthetic_image(labels, (labels.shape[0] * 2, labels.shape[1] * 2), rng))
+    args = torch_process_segm.parser.parse_args([ '-T', str(d / 'tiles'), '-O', '--fast', '-S', str(d / 'sql'), '--sql-bulk-dir', str(d / 'bulk'),
+                                                  '-C', 'Town', '-D', '/images', '-U', 'https://example.org/images' ])
+    proc = torch_process_segm.setup(args, lambda s: None)
+    for _ in range(2):
+        for imgid in (5000, 5001):
+            assert proc.do_file(d / f'{imgid}.npz')['status'] == 'ok'
+    return d
+
+##################################################
+# Tests
+
+def insert_files(d):
+    files = sorted((d / 'sql').glob('*/*_insert.sql'))
+    # the panorama, its crops and the other image
+    assert len(files) > 2
+    return files
+
+def test_insert(outputs):
+    expected = connect()
+    for f in insert_files(outputs):
+        run_insert_sql(expected, f.read_text())
+    actual = connect()
+    load_bulk(actual, outputs / 'bulk')
+    assert len(tables(actual)) == len(insert_files(outputs))
+    assert tables(actual) == tables(expected)
+
+@pytest.mark.parametrize('accepted', [ None, [ 5000 ], [ 5001 ], [] ])
+def test_enable(outputs, accepted):
+    expected = connect()
+    for f in insert_files(outputs):
+        run_insert_sql(expected, f.read_text())
+    for f in sorted((outputs / 'sql').glob('*/*_enable.sql')):
+        # the crops of an image are named after it
+        if accepted is None or int(f.name.split('_')[0]) in accepted:
+            expected.execute(f.read_text())
+    actual = connect()
+    load_bulk(actual, outputs / 'bulk', accepted=accepted, enable_all=accepted is None)
+    assert tables(actual) == tables(expected)
+
+def test_loaded_again(outputs):
+    # loading again adds nothing, as running the _insert.sql files again
+    actual = connect()
+    load_bulk(actual, outputs / 'bulk')
+    before = tables(actual)
+    actual.execute('DROP TABLE bulk_image')
+    actual.execute('DROP TABLE bulk_image_unique')
+    actual.execute('DROP TABLE image_ins')
+    load_bulk(actual, outputs / 'bulk')
+    assert tables(actual) == before
+
+def test_load_script(outputs):
+    # the script copies every bulk file
+    sql = subprocess.run([ 'bash', Path(__file__).parent / 'load_bulk_sql.sh', '-n', '-E', outputs / 'bulk' ],
+                         capture_output=True, text=True, check=True).stdout
+    files = sorted(outputs.glob(f'bulk/*{torch_process_segm.bulk_suffix}'))
+    assert len(files) == 1
+    for f in files:
+        assert f"\\copy bulk_image FROM '{f}'" in sql
+    assert 'UPDATE image SET enabled=true' in sql
+
+# vim: ai sw=4 sts=4 ts=4 et
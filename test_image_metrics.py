@@ -0,0 +1,84 @@
+# Tests of the fused image_metrics of image_metrics.py against the separate
+# metric functions it replaced (as called by torch_process_segm.py before),
+# which it must agree with to within rounding, except for the one documented
+# difference of Michaelson contrast (run with pytest).
+import cv2
+import numpy as np
+import pytest
+from skimage.exposure import is_low_contrast
+from image_metrics import (image_metrics, image_metrics_batch, prescreen_image, rms_contrast, michaelson_contrast, compute_hdr,
+                           skimage_contrast, simple_brightness, finley_brightness, laplacian)
+from benchmark import pano_label_map, photo_label_map, synthetic_image, write_jpeg
+
+##################################################
+# Reference: the separate functions
+
+def ref_image_metrics(img):
+    rgbimg = img[:, :, ::-1]
+    return { 'simple_brightness': float(simple_brightness(img)),
+             'finley_brightness': float(finley_brightness(img)),
+             'michaelson_contrast': float(michaelson_contrast(img)),
+             'rms_contrast': float(rms_contrast(img)),
+             'is_low_contrast': bool(is_low_contrast(rgbimg, fraction_threshold=0.35)),
+             'laplacian': float(laplacian(img)),
+             'skimage_contrast': float(skimage_contrast(rgbimg)),
+             'tone_mapping': float(compute_hdr(img)) }
+
+##################################################
+# Images (BGR)
+
+def images():
+    rng = np.random.default_rng(0)
+    imgs = [ synthetic_image(pano_label_map(rng), (400, 1600), rng),
+             synthetic_image(photo_label_map(rng), (300, 400), rng),
+             rng.integers(0, 256, size=(123, 77, 3), dtype=np.uint8) ]
+    # low contrast: a narrow band of grey levels
+    imgs.append(rng.integers(100, 140, size=(64, 96, 3), dtype=np.uint8))
+    # dark, with a few bright pixels
+    dark = rng.integers(0, 20, size=(80, 80, 3), dtype=np.uint8)
+    dark[::17, ::13] = 250
+    imgs.append(dark)
+    return imgs
+
+##################################################
+# Tests
+
+@pytest.mark.parametrize('i', range(5))
+def test_same_as_separate(i):
+    img = images()[i]
+    expected = ref_image_metrics(img)
+    actual = image_metrics(img)
+    assert actual.keys() == expected.keys()
+    for k in ('simple_brightness', 'finley_brightness', 'rms_contrast', 'laplacian', 'skimage_contrast', 'tone_mapping'):
+        assert actual[k] == pytest.approx(expected[k], rel=1e-6, abs=1e-9), k
+    assert actual['is_low_contrast'] == expected['is_low_contrast']
+    # computed on the grey image instead of the Y channel of YUV, whose
+    # extremes may differ by one grey level
+    Y = cv2.cvtColor(img, cv2.COLOR_BGR2YUV)[:, :, 0].astype(float)
+    lo, hi = Y.min(), Y.max()
+    bounds = [ (hi + dhi - lo - dlo) / (hi + dhi + lo + dlo) for dlo in (-1, 0, 1) for dhi in (-1, 0, 1) if hi + dhi + lo + dlo > 0 ]
+    assert min(bounds) - 1e-12 <= actual['michaelson_contrast'] <= max(bounds) + 1e-12
+
+def test_quality_only():
+    for img in images():
+        full = image_metrics(img)
+        quality = image_metrics(img, quality_only=True)
+        assert quality == { k: full[k] for k in ('skimage_contrast', 'tone_mapping') }
+
+def test_batch():
+    imgs = images()
+    expected = [ image_metrics(img) for img in imgs ]
+    assert image_metrics_batch(imgs, threads=3) == expected
+    assert image_metrics_batch(imgs) == expected
+
+def test_prescreen(tmp_path):
+    # without scaling down, the scores of the decoded image
+    img = images()[0]
+    write_jpeg(tmp_path / 'a.jpg', img)
+    decoded = cv2.imread(str(tmp_path / 'a.jpg'))
+    expected = ref_image_metrics(decoded)
+    contrast, tone_mapping = prescreen_image(tmp_path / 'a.jpg', scale=1)
+    assert contrast == pytest.approx(expected['skimage_contrast'], rel=1e-6)
+    assert tone_mapping == pytest.approx(expected['tone_mapping'], rel=1e-6)
+
+# vim: ai sw=4 sts=4 ts=4 et
@@ -0,0 +1,75 @@
+# Tests of the mask rendering of torch_process_segm.py --lut-masks against the
+# drawing with one boolean mask per label by draw_segmentation_masks, kept
+# below as the reference (as done without --lut-masks): the mask image and
+# the greyscale image the edges are found in must be exactly the same (run
+# with pytest).
+import cv2
+import numpy as np
+import pytest
+import torch
+from torchvision.utils import draw_segmentation_masks
+from torch_process_segm import render_masks_lut
+from benchmark import pano_label_map, photo_label_map, synthetic_image
+
+##################################################
+# Reference implementation (without --lut-masks)
+
+def ref_render_masks(predictplus, baseimg, colors, alpha):
+    colors = list(colors)
+    blank = torch.zeros(3, predictplus.shape[0], predictplus.shape[1], dtype=torch.uint8)
+    seginput = blank if baseimg is None else torch.from_numpy(np.transpose(baseimg, (2, 0, 1)))
+    masks_bool = np.array([predictplus == x for x in np.unique(predictplus)])
+    while len(colors) < masks_bool.shape[0]:
+        colors.append('#808080')
+    maskedimg = draw_segmentation_masks(seginput, torch.tensor(masks_bool,dtype=torch.bool), alpha=alpha, colors=colors).numpy()
+    maskedimg = np.transpose(maskedimg, [1, 2, 0])
+    mask = draw_segmentation_masks(blank, torch.tensor(masks_bool,dtype=torch.bool)).numpy()
+    mask = np.transpose(mask, [1, 2, 0])
+    gray = cv2.cvtColor(mask, cv2.COLOR_RGB2GRAY)
+    return maskedimg, gray
+
+##################################################
+# Label maps and palettes
+
+# (as in a --palette-file; the default palette is just black)
+palette19 = [ '#804080', '#f423e8', '#464646', '#66669c', '#be9999', '#999999', '#faaa1e', '#dcdc00', '#6b8e23', '#98fb98',
+              '#4682b4', '#dc143c', '#ff0000', '#00008e', '#000046', '#003c64', '#005064', '#0000e6', '#770b20' ]
+
+def label_maps():
+    rng = np.random.default_rng(0)
+    maps = [ pano_label_map(rng), photo_label_map(rng) ]
+    # labels missing in between, and labels beyond the palette
+    sparse = rng.choice([ 0, 2, 3, 7, 18, 21, 30 ], size=(60, 90)).astype(np.int64)
+    maps.append(sparse)
+    # a single label, which is not 0
+    maps.append(np.full((20, 30), 5, dtype=np.int64))
+    return maps
+
+def cases():
+    for i, labels in enumerate(label_maps()):
+        for colors in ([ '#000000' ], palette19):
+            for alpha in (0.5, 0.8, 0.35):
+                yield i, colors, alpha, True
+            # (no base image)
+            yield i, colors, 1, False
+
+##################################################
+# Tests
+
+@pytest.mark.parametrize('i, colors, alpha, withimage', list(cases()))
+def test_same_as_boolean_masks(i, colors, alpha, withimage):
+    labels = label_maps()[i]
+    rng = np.random.default_rng(i)
+    baseimg = synthetic_image(labels, labels.shape, rng)[:, :, ::-1].copy() if withimage else None
+    expected_img, expected_gray = ref_render_masks(labels, baseimg, colors, alpha)
+    maskedimg, gray = render_masks_lut(labels, baseimg, colors, alpha)
+    np.testing.assert_array_equal(maskedimg, expected_img)
+    np.testing.assert_array_equal(gray, expected_gray)
+
+def test_colors_unchanged():
+    # the palette given is not extended with grey
+    colors = [ '#000000' ]
+    render_masks_lut(label_maps()[2], None, colors, 1)
+    assert colors == [ '#000000' ]
+
+# vim: ai sw=4 sts=4 ts=4 et
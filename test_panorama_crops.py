@@ -0,0 +1,201 @@
+# Tests of the panoramic crops of torch_process_segm.py, taken by counting
+# columns modulo the width (wrap_columns), against the original
+# implementation, kept below as the reference, which assembled the crops that
+# wrap around either edge from two pieces of a PIL image and a torch tensor:
+# the crops must be exactly the same (run with pytest).
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+from torch_process_segm import crop_panoramic_image, wrap_columns
+from benchmark import pano_label_map, synthetic_image
+
+##################################################
+# Reference implementation (as before wrap_columns)
+
+def ref_crop_panoramic_image(image, segmentation, road_centres):
+    # img*: variables in image coordinates
+    imgw, imgh = image.size
+    # Segmentation may be performed on a downscaled image
+    # mat*: variables in matrix coordinates
+    matw = segmentation.size(dim=1)
+    # segmentation may have bottom cropped off, therefore calculate 'matrix
+    # height' based on image & assume that bottom quarter of segmentation
+    # matrix is not accessible
+    math = imgh * matw // imgw
+
+    # In addition to road centres we are also interested in views looking
+    # slightly to the left and right of the road, thus including more of the
+    # surroundings.
+    matxset = set()
+    matw4 = matw // 4
+    matw8 = matw // 8
+    matw4_100 = matw4 // 100
+    math4 = math // 4
+    mathFor43 = int(matw4 * 3 / 4) # height for 4:3 ratio submatrix
+    # assumes panoramic image has width approximately 2x the height
+    assert(mathFor43 <= math//2)
+    # road_centres is in matrix coords:
+    for centre in road_centres:
+        matxleft = centre - matw8 + matw4_100
+        matxright = centre + matw8 - matw4_100
+        if matxleft < 0: matxleft += matw
+        elif matxright >= matw: matxright -= matw
+        matxset.add(matxleft)
+        matxset.add(centre)
+        matxset.add(matxright)
+
+    # Calculate dimensions and offsets
+    # The size of a cropped image will be: (w4, hFor43)
+    # The crop will start at offset (x - w4/2, h4) for each x in the xlist
+    #
+    # Some complications arise when the desired cropped image wraps around
+    # either end of the panoramic input image, or because image segmentation
+    # input is calculated based on an image that has already been wrapped with
+    # the first 25% of the image copied to the right-hand side (to ensure that
+    # any roads on the edges of the panoramic image are found).
+    imgw4 = int(imgw / 4)
+    imgw8 = int(imgw / 8)
+    imgh4 = int(imgh / 4)
+    imghFor43 = int(imgw4 * 3 / 4) # height for 4:3 ratio image
+    imgw98 = imgw + imgw8
+    imgxwrapneeded = int(imgw * 7 / 8)
+
+    images = []
+    subsegms = []
+
+    # Crop the panoramic image based on road centers
+    for matx in matxset:
+        imgx = imgw * matx // matw  # img coords
+        # Thanks to Ilse Abril Vázquez Sánchez for translating my original
+        # shell script code (process_out_file.sh) into Python.
+        #
+        # Wrapped all the way around:
+        if imgx >= imgw98:
+            matwrapx = matx - matw
+            imgwrapx = imgx - imgw
+            matxlo = int(matwrapx - matw8)
+            imgxlo = int(imgwrapx - imgw8)
+            cropped_image = image.crop((imgxlo, imgh4, imgxlo + imgw4, imgh4 + imghFor43))
+            cropped_segmentation = segmentation[math4:math4+mathFor43, matxlo:matxlo+matw4]
+        
+        # Cropped image requires assembly of two sides, wrapping around
+        # righthand side of image:
+        elif imgx > imgxwrapneeded:
+            matxlo = int(matx - matw8)
+            imgxlo = int(imgx - imgw8)
+            # width of piece 1: between xlo and the righthand side of the image
+            matw4_p1 = matw - matxlo
+            imgw4_p1 = imgw - imgxlo
+            # width of piece 2: the remaining width needed, starting from the
+            # lefthand side of the image
+            matw4_p2 = matw4 - matw4_p1
+            imgw4_p2 = imgw4 - imgw4_p1
+
+            # Crop and concatenate image and segmentation
+            cropped_image_1 = image.crop((imgxlo, imgh4, imgxlo + imgw4_p1, imgh4 + imghFor43))
+            cropped_image_2 = image.crop((0, imgh4, imgw4_p2, imgh4 + imghFor43))
+
+            cropped_image = Image.new(image.mode, (imgw4, imghFor43))
+            cropped_image.paste(cropped_image_1, (0, 0))
+            cropped_image.paste(cropped_image_2, (imgw4_p1, 0))
+
+            cropped_segmentation_1 = segmentation[math4:math4+mathFor43, matxlo:matxlo+matw4_p1]
+            cropped_segmentation_2 = segmentation[math4:math4+mathFor43, 0:matw4_p2]
+            cropped_segmentation = torch.cat((cropped_segmentation_1, cropped_segmentation_2), dim=1)
+
+        
+        # Cropped image requires assembly of two sides, wrapping around
+        # lefthand side of image:
+        elif imgx < imgw8:
+            # given x appears between 0 and w8:
+            # x coords:        0     x    w8
+            #            |<---------w4----------->|
+            #            |<----w8--->|<----w8---->|
+            #                  |<-x->|
+            #            |<--->|<---------------->|
+            #              p1          p2
+            # ergo, width of piece 1 (p1) = w8 - x
+            imgw4_p1 = int(imgw8 - imgx)
+            matw4_p1 = int(matw8 - matx)
+            imgxhi = imgw - imgw4_p1
+            matxhi = matw - matw4_p1
+            # width of piece 2 (p2) is remainder
+            imgw4_p2 = imgw4 - imgw4_p1
+            matw4_p2 = matw4 - matw4_p1
+
+            # Crop and concatenate image and segmentation
+            cropped_image_1 = image.crop((imgxhi, imgh4, imgxhi + imgw4_p1, imgh4 + imghFor43))
+            cropped_image_2 = image.crop((0, imgh4, imgw4_p2, imgh4 + imghFor43))
+
+            cropped_image = Image.new(image.mode, (imgw4, imghFor43))
+            cropped_image.paste(cropped_image_1, (0, 0))
+            cropped_image.paste(cropped_image_2, (imgw4_p1, 0))
+
+            cropped_segmentation_1 = segmentation[math4:math4+mathFor43, matxhi:matxhi+matw4_p1]
+            cropped_segmentation_2 = segmentation[math4:math4+mathFor43, 0:matw4_p2]
+            cropped_segmentation = torch.cat((cropped_segmentation_1, cropped_segmentation_2), dim=1)
+
+        # Straightforward crop
+        else:
+            matxlo = int(matx - matw8)
+            imgxlo = int(imgx - imgw8)
+            cropped_image = image.crop((imgxlo, imgh4, imgxlo + imgw4, imgh4 + imghFor43))
+            cropped_segmentation = segmentation[math4:math4+mathFor43, matxlo:matxlo+matw4]
+
+        images.append(cropped_image)
+        subsegms.append(cropped_segmentation)
+
+    return images, subsegms
+
+##################################################
+# Tests
+
+# A panorama of the given width (twice as wide as high, and four times as wide
+# as its label map, as segmented with the default --scaledown-factor), its
+# label map, and the road centres in every region of the "plus" matrix
+# (including the appended quarter)
+def panorama(imgw, rng):
+    labels = pano_label_map(rng)
+    matw = imgw // 4
+    labels = np.array(Image.fromarray(labels.astype(np.uint8)).resize((matw, matw // 2 * 3 // 4), Image.NEAREST))
+    img = synthetic_image(labels, (imgw // 2, imgw), rng)
+    matw8 = matw // 8
+    centres = [ 0, 1, matw8 - 1, matw8, matw8 + 1, matw // 2, matw - matw8 - 1, matw - matw8, matw - 1, matw, matw + 1,
+                matw + matw8 - 1, matw + matw8, matw + matw // 4 - 1 ]
+    centres += list(rng.integers(0, matw + matw // 4, size=10))
+    return img, labels, centres
+
+@pytest.mark.parametrize('imgw', [ 1600, 2048, 2400, 3072 ])
+def test_same_crops(imgw):
+    rng = np.random.default_rng(imgw)
+    img, labels, centres = panorama(imgw, rng)
+    for centre in centres:
+        expected_imgs, expected_segms = ref_crop_panoramic_image(Image.fromarray(img), torch.from_numpy(labels), [ centre ])
+        imgs, segms, infos = crop_panoramic_image(img, labels, [ centre ])
+        assert len(imgs) == len(expected_imgs)
+        for im, seg, expected_im, expected_seg, info in zip(imgs, segms, expected_imgs, expected_segms, infos):
+            np.testing.assert_array_equal(im, np.asarray(expected_im), err_msg=str(info))
+            np.testing.assert_array_equal(seg, expected_seg.numpy(), err_msg=str(info))
+
+def test_several_centres():
+    # the crops of all the centres at once are those of each on its own
+    rng = np.random.default_rng(0)
+    img, labels, centres = panorama(2048, rng)
+    expected_imgs, expected_segms = ref_crop_panoramic_image(Image.fromarray(img), torch.from_numpy(labels), centres)
+    imgs, segms, _ = crop_panoramic_image(img, labels, centres)
+    assert len(imgs) == len(expected_imgs) > len(centres)
+    for im, seg, expected_im, expected_seg in zip(imgs, segms, expected_imgs, expected_segms):
+        np.testing.assert_array_equal(im, np.asarray(expected_im))
+        np.testing.assert_array_equal(seg, expected_seg.numpy())
+
+def test_wrap_columns():
+    a = np.arange(5 * 8).reshape(5, 8)
+    # a view when not wrapping around
+    assert np.shares_memory(wrap_columns(a, 2, 4), a)
+    np.testing.assert_array_equal(wrap_columns(a, 2, 4), a[:, 2:6])
+    np.testing.assert_array_equal(wrap_columns(a, 6, 4, rows=slice(1, 3)), np.concatenate((a[1:3, 6:], a[1:3, :2]), axis=1))
+    np.testing.assert_array_equal(wrap_columns(a, -2, 4), np.concatenate((a[:, 6:], a[:, :2]), axis=1))
+    np.testing.assert_array_equal(wrap_columns(a, 0, 10), np.concatenate((a, a[:, :2]), axis=1))
+
+# vim: ai sw=4 sts=4 ts=4 et
@@ -0,0 +1,170 @@
+# Tests of the vectorised road-finding functions of torch_process_segm.py
+# against the original column-by-column implementation, kept below as the
+# reference: the results must be exactly the same (run with pytest).
+import numpy as np
+import pytest
+from scipy.signal import find_peaks
+from torch_process_segm import road_pixels_per_col, road_pixel_dist_from_bottom, road_centres, road_centres_batch, road_peaks_params
+from benchmark import pano_label_map, photo_label_map
+
+##################################################
+# Reference implementation (as before vectorisation)
+
+def rle(inarray):
+    """ run length encoding. Partial credit to R rle function.
+        Multi datatype arrays catered for including non Numpy
+        returns: tuple (runlengths, startpositions, values) """
+    ia = np.asarray(inarray)                # force numpy
+    n = len(ia)
+    if n == 0:
+        return (None, None, None)
+    else:
+        y = ia[1:] != ia[:-1]               # pairwise unequal (string safe)
+        i = np.append(np.where(y), n - 1)   # must include last element posi
+        z = np.diff(np.append(-1, i))       # run lengths
+        p = np.cumsum(np.append(0, z))[:-1] # positions
+        return(z, p, ia[i])
+
+def ref_road_pixels_per_col(pred):
+    h2 = pred.shape[0]//2
+    a = pred == 0.0
+    out = np.zeros(a.shape[1])
+    for i in range(a.shape[1]):
+      (z, p, v) = rle(a[:,i])
+      out[i]=z[np.logical_and(p > h2, v != 0)].max(initial=0)
+    return out
+
+def ref_road_pixel_dist_from_bottom(pred):
+    h2 = pred.shape[0] // 2
+    a = pred == 0.0
+    out = np.zeros(a.shape[1])
+    for i in range(a.shape[1]):
+        js = np.argwhere(a[h2:,i] != 0)
+        out[i] = h2 - js[0,0] if np.any(js) else 0
+    return out
+
+def ref_road_centres(pred, distance=2000, prominence=100):
+    road = ref_road_pixel_dist_from_bottom(pred)
+    rppc = ref_road_pixels_per_col(pred)
+    road += rppc / 8
+    padding = prominence*2
+    roadplus = np.concatenate((np.zeros(padding),road,np.zeros(padding)))
+    peaks = find_peaks(roadplus,distance=distance,prominence=prominence)[0]
+    return peaks - padding
+
+##################################################
+# Label maps
+
+# Random label maps of the given shape, with road (label 0) in about the
+# given fraction of the pixels, in runs of random lengths down the columns
+def random_masks(rng, shape, density):
+    n, h, w = shape
+    masks = rng.integers(1, 19, size=shape)
+    for k in range(n):
+        for x in range(w):
+            y = 0
+            while y < h:
+                run = int(rng.integers(1, max(2, h // 4)))
+                if rng.random() < density:
+                    masks[k, y:y + run, x] = 0
+                y += run
+    return masks
+
+# A label map with the edge cases in its columns: no road, all road, road on
+# the middle row only, road from the middle row down, road ending just above
+# the middle row, and a single road pixel on the bottom row
+def edge_case_mask(h, w=12):
+    m = np.full((h, w), 2, dtype=np.int64)
+    h2 = h // 2
+    m[:, 1] = 0
+    m[h2, 2] = 0
+    m[h2:, 3] = 0
+    m[:h2, 4] = 0
+    m[-1, 5] = 0
+    m[h2 + 1:, 6] = 0
+    m[h2 - 1:h2 + 2, 7] = 0
+    m[::2, 8] = 0
+    return m
+
+heights = [ 1, 2, 3, 7, 8, 33, 64, 101 ]
+
+def assert_same(actual, expected):
+    assert actual.dtype == expected.dtype
+    np.testing.assert_array_equal(actual, expected)
+
+##################################################
+# Tests
+
+@pytest.mark.parametrize('h', heights)
+@pytest.mark.parametrize('density', [ 0.0, 0.2, 0.5, 0.9, 1.0 ])
+def test_random_masks(h, density):
+    rng = np.random.default_rng(h * 100 + int(density * 10))
+    for pred in random_masks(rng, (4, h, 23), density):
+        assert_same(road_pixels_per_col(pred), ref_road_pixels_per_col(pred))
+        assert_same(road_pixel_dist_from_bottom(pred), ref_road_pixel_dist_from_bottom(pred))
+
+@pytest.mark.parametrize('h', heights)
+def test_edge_cases(h):
+    pred = edge_case_mask(h)
+    assert_same(road_pixels_per_col(pred), ref_road_pixels_per_col(pred))
+    assert_same(road_pixel_dist_from_bottom(pred), ref_road_pixel_dist_from_bottom(pred))
+
+@pytest.mark.parametrize('value', [ 0, 5 ])
+def test_uniform_masks(value):
+    # all road, and no road at all
+    for h in heights:
+        pred = np.full((h, 9), value, dtype=np.int64)
+        assert_same(road_pixels_per_col(pred), ref_road_pixels_per_col(pred))
+        assert_same(road_pixel_dist_from_bottom(pred), ref_road_pixel_dist_from_bottom(pred))
+
+@pytest.mark.parametrize('h', [ 7, 64, 101 ])
+def test_stacks(h):
+    rng = np.random.default_rng(h)
+    preds = np.concatenate([ random_masks(rng, (5, h, 31), 0.4), edge_case_mask(h, 31)[None],
+                             np.zeros((1, h, 31), dtype=np.int64), np.ones((1, h, 31), dtype=np.int64) ])
+    perpix = road_pixels_per_col(preds)
+    dist = road_pixel_dist_from_bottom(preds)
+    assert perpix.shape == dist.shape == (len(preds), 31)
+    for k, pred in enumerate(preds):
+        assert_same(perpix[k], ref_road_pixels_per_col(pred))
+        assert_same(dist[k], ref_road_pixel_dist_from_bottom(pred))
+
+# Street scenes as drawn by benchmark.py, in the label map shapes produced by
+# torch_segm_images.py
+@pytest.mark.parametrize('make', [ pano_label_map, photo_label_map ])
+def test_street_scenes(make):
+    rng = np.random.default_rng(0)
+    preds = np.stack([ make(rng) for _ in range(3) ])
+    for pred in preds:
+        assert_same(road_pixels_per_col(pred), ref_road_pixels_per_col(pred))
+        assert_same(road_pixel_dist_from_bottom(pred), ref_road_pixel_dist_from_bottom(pred))
+        distance, prominence = road_peaks_params(pred.shape)
+        expected = ref_road_centres(pred, distance, prominence)
+        assert len(expected) > 0
+        assert_same(road_centres(pred, distance, prominence), expected)
+    distance, prominence = road_peaks_params(preds.shape[1:])
+    for centres, pred in zip(road_centres_batch(preds, distance, prominence), preds):
+        assert_same(centres, ref_road_centres(pred, distance, prominence))
+
+def test_plus_centres():
+    # the centres of a panorama with plus set are those of its "plus" matrix
+    # (with its leftmost 25-percent appended to the righthand side)
+    rng = np.random.default_rng(1)
+    pred = pano_label_map(rng)
+    # a road across the seam
+    pred = np.roll(pred, pred.shape[1] // 4 + 3, axis=1)
+    w = pred.shape[1]
+    plus = np.concatenate((pred, pred[:, :w // 4]), axis=1)
+    distance, prominence = road_peaks_params(pred.shape)
+    assert_same(road_centres(pred, distance, prominence, plus=True), ref_road_centres(plus, distance, prominence))
+
+def test_memory_mapped(tmp_path):
+    # as torch_process_segm.py reads .npy label maps
+    rng = np.random.default_rng(2)
+    pred = photo_label_map(rng).astype(np.uint8)
+    np.save(tmp_path / 'pred.npy', pred)
+    mapped = np.load(tmp_path / 'pred.npy', mmap_mode='r')
+    distance, prominence = road_peaks_params(pred.shape)
+    assert_same(road_centres(mapped, distance, prominence), ref_road_centres(pred, distance, prominence))
+
+# vim: ai sw=4 sts=4 ts=4 et
@@ -0,0 +1,78 @@
+# Tests of the class probabilities from which torch_segm_images.py --tile-size
+# stitches the tiles together, which must be those whose argmax is the label
+# map of processor.post_process_semantic_segmentation (as used for whole
+# images), on a small Mask2Former model with random weights, made here so
+# that nothing is downloaded (run with pytest).
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+import torch_segm_images
+from benchmark import pano_label_map, photo_label_map, synthetic_image
+
+@pytest.fixture(scope='module')
+def seg(tmp_path_factory):
+    from transformers import Mask2FormerConfig, Mask2FormerForUniversalSegmentation, Mask2FormerImageProcessor, SwinConfig
+    modeldir = tmp_path_factory.mktemp('model')
+    torch.manual_seed(0)
+    backbone = SwinConfig(embed_dim=16, depths=[ 1, 1, 1, 1 ], num_heads=[ 1, 1, 1, 1 ], window_size=4, out_features=[ 'stage1', 'stage2', 'stage3', 'stage4' ])
+    config = Mask2FormerConfig(backbone_config=backbone, hidden_dim=32, feature_size=32, mask_feature_size=32, num_queries=10, encoder_layers=1,
+                               decoder_layers=2, encoder_feedforward_dim=64, dim_feedforward=64, num_attention_heads=2, num_labels=19)
+    config.id2label = { i: str(i) for i in range(19) }
+    config.label2id = { str(i): i for i in range(19) }
+    model = Mask2FormerForUniversalSegmentation(config)
+    # the random mask logits are of the order of 1e-3, where the sigmoid is
+    # all but linear, so that the order of combining and scaling would make
+    # no difference: scaled up to the order of 1, as with trained weights
+    with torch.no_grad():
+        model.get_submodule('model.transformer_module.decoder.mask_predictor.mask_embedder.2.0').weight.mul_(3000)
+    model.save_pretrained(modeldir)
+    Mask2FormerImageProcessor(size={ 'shortest_edge': 64, 'longest_edge': 128 }).save_pretrained(modeldir)
+    args = torch_segm_images.parser.parse_args([ '--modelname', str(modeldir) ])
+    seg = torch_segm_images.setup(args, lambda s: None)
+    seg.modelname = str(modeldir)
+    return seg
+
+# The scores of post_process_semantic_segmentation, whose argmax is the label
+# map (only returned by recent versions of transformers)
+def hf_scores(modelname, img):
+    import inspect
+    from transformers import AutoImageProcessor, Mask2FormerForUniversalSegmentation
+    processor = AutoImageProcessor.from_pretrained(modelname)
+    if 'return_segmentation_scores' not in inspect.signature(processor.post_process_semantic_segmentation).parameters:
+        pytest.skip('post_process_semantic_segmentation does not return the scores')
+    model = Mask2FormerForUniversalSegmentation.from_pretrained(modelname)
+    with torch.no_grad():
+        outputs = model(**processor(images=[ img ], return_tensors='pt'))
+    [ result ] = processor.post_process_semantic_segmentation(outputs, target_sizes=[ img.size[::-1] ], return_segmentation_scores=True)
+    return result.segmentation_scores.numpy()
+
+def images():
+    rng = np.random.default_rng(0)
+    imgs = [ synthetic_image(pano_label_map(rng), (60, 200), rng), synthetic_image(photo_label_map(rng), (96, 128), rng),
+             synthetic_image(photo_label_map(rng), (150, 100), rng) ]
+    return [ Image.fromarray(img[:, :, ::-1]) for img in imgs ]
+
+def test_same_labels_as_whole(seg):
+    # a tile covering the whole image gives the label map of the whole image
+    for img in images():
+        probs = seg.class_probabilities([ img ])
+        assert probs.shape == (1, 19, img.size[1], img.size[0])
+        [ expected ] = seg.segment([ img ])
+        np.testing.assert_array_equal(probs[0].argmax(axis=0), expected)
+
+def test_same_scores(seg):
+    # combined at the resolution of the masks, and then scaled to the image
+    modelname = seg.modelname
+    for img in images():
+        np.testing.assert_allclose(seg.class_probabilities([ img ])[0], hf_scores(modelname, img), rtol=1e-5, atol=1e-6)
+
+def test_batch(seg):
+    # equally-sized tiles give the same probabilities together as one by one
+    img = images()[1]
+    tiles = [ img, img.transpose(Image.FLIP_LEFT_RIGHT) ]
+    together = seg.class_probabilities(tiles)
+    for tile, probs in zip(tiles, together):
+        np.testing.assert_allclose(probs, seg.class_probabilities([ tile ])[0], rtol=1e-5, atol=1e-6)
+
+# vim: ai sw=4 sts=4 ts=4 et
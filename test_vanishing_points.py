@@ -0,0 +1,118 @@
+# Tests of the vanishing point detection of torch_process_segm.py against the
+# original implementation, kept below as the reference (drawing the Hough
+# lines one by one over a colour image of the edges): at full resolution, the
+# results must be exactly the same (run with pytest).
+import cv2
+import numpy as np
+import pytest
+from scipy.signal import find_peaks
+import torch_process_segm
+from benchmark import pano_label_map, photo_label_map
+
+##################################################
+# Reference implementation (as before --hough-scale)
+
+def ref_vanishing_points(gray, width, blur=False):
+    if blur:
+        gray = cv2.GaussianBlur(gray, (5, 5), 1)
+    edgeImg = cv2.Canny(gray, 40, 255)
+    lines = cv2.HoughLines(edgeImg, 1.0, np.pi/120, 120, min_theta=np.pi/36, max_theta=np.pi-np.pi/36)
+
+    cdst = cv2.cvtColor(edgeImg, cv2.COLOR_GRAY2BGR)
+    if lines is not None:
+        for line in lines:
+            rho,theta = line[0]
+            a = np.cos(theta)
+            b = np.sin(theta)
+            x0 = a*rho
+            y0 = b*rho
+            x1 = int(x0 + 10000*(-b))
+            y1 = int(y0 + 10000*(a))
+            x2 = int(x0 - 10000*(-b))
+            y2 = int(y0 - 10000*(a))
+            cv2.line(cdst,(x1,y1),(x2,y2),(0,255,0),1, cv2.LINE_AA)
+
+    blobs = np.copy(cdst)
+    kernel = np.ones((3,3),np.uint8)
+    blobs = cv2.erode(blobs,kernel,iterations=1)
+    kernel = np.ones((9,9),np.uint8)
+    blobs = cv2.dilate(blobs,kernel,iterations=1)
+    kernel = np.ones((11,11),np.uint8)
+    blobs = cv2.erode(blobs,kernel,iterations=1)
+    blobs = cv2.dilate(blobs,kernel,iterations=1)
+
+    grayblobs = cv2.cvtColor(blobs,cv2.COLOR_BGR2GRAY)
+    grayblobs1d = np.count_nonzero(grayblobs,axis=0)
+    return find_peaks(grayblobs1d, distance=width//4)[0]
+
+##################################################
+# Greyscale renderings
+
+# A label map rendered in grey levels (as the masks drawn by torch_process_segm.py)
+def render(labels, rng):
+    palette = rng.integers(0, 256, size=labels.max() + 1).astype(np.uint8)
+    return palette[labels]
+
+# The "plus" matrix of a panorama (with its leftmost 25-percent appended to
+# the righthand side), in which the vanishing points are found
+def plus(labels):
+    return np.concatenate((labels, labels[:, :labels.shape[1] // 4]), axis=1)
+
+# Regions bounded by rays from the given points, as the road, kerbs and
+# facades of a street seen along its length
+def street(shape, vps):
+    img = np.full(shape, 60, np.uint8)
+    for vx, vy in vps:
+        for k, angle in enumerate(np.linspace(0.25, np.pi - 0.25, 10)):
+            pts = np.array([ [ vx, vy ], [ vx + 3000*np.cos(angle), vy + 3000*np.sin(angle) ],
+                             [ vx + 3000*np.cos(angle + 0.12), vy + 3000*np.sin(angle + 0.12) ] ], np.int32)
+            cv2.fillPoly(img, [ pts ], int(90 + 15 * k))
+    return img
+
+def scenes():
+    rng = np.random.default_rng(0)
+    grays = [ render(plus(pano_label_map(rng)), rng) for _ in range(3) ]
+    grays += [ render(photo_label_map(rng), rng) for _ in range(3) ]
+    grays += [ street((540, 1800), [ (600, 250), (1500, 260) ]), street((750, 1000), [ (480, 330) ]) ]
+    # (no lines at all)
+    grays.append(np.full((100, 400), 128, np.uint8))
+    return grays
+
+# (with an empty tiles directory)
+def detector(tmp_path, *options):
+    args = torch_process_segm.parser.parse_args([ '-T', str(tmp_path), *options ])
+    return torch_process_segm.setup(args, lambda s: None).vanishing_points
+
+##################################################
+# Tests
+
+@pytest.mark.parametrize('blur', [ False, True ])
+def test_full_resolution(tmp_path, blur):
+    vanishing_points = detector(tmp_path, *([ '--blur' ] if blur else []))
+    for gray in scenes():
+        expected = ref_vanishing_points(gray, gray.shape[1], blur=blur)
+        np.testing.assert_array_equal(vanishing_points(gray, gray.shape[1], lambda s: None), expected)
+
+@pytest.mark.parametrize('scale', [ 2, 3, 4 ])
+def test_scaled_down(tmp_path, scale):
+    # the columns found at reduced resolution are those of the full width,
+    # at least a quarter of the width apart
+    vanishing_points = detector(tmp_path)
+    for gray in scenes():
+        width = gray.shape[1]
+        vps = vanishing_points(gray, width, lambda s: None, scale)
+        assert ((vps >= 0) & (vps < width)).all()
+        assert (np.diff(vps) >= width // 4 // scale * scale).all()
+
+def test_images_written(tmp_path):
+    # the lines and blobs images can still be written
+    vanishing_points = detector(tmp_path, '--linefile', str(tmp_path / 'lines.png'), '--blobfile', str(tmp_path / 'blobs.png'))
+    gray = scenes()[-2]
+    vanishing_points(gray, gray.shape[1], lambda s: None)
+    lines = cv2.imread(str(tmp_path / 'lines.png'))
+    assert lines.shape == gray.shape + (3,)
+    # (green lines over white edges)
+    assert (lines[:, :, 1] >= lines[:, :, 0]).all() and (lines[:, :, 1] > lines[:, :, 0]).any()
+    assert cv2.imread(str(tmp_path / 'blobs.png'), cv2.IMREAD_GRAYSCALE).shape == gray.shape
+
+# vim: ai sw=4 sts=4 ts=4 et
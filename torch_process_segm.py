@@ -3,37 +3,56 @@ import argparse
 import os
 import json
 import numpy as np
-from numpy.linalg import norm
 from pathlib import Path
 import sys
 from scipy.signal import find_peaks
-from skimage.exposure import is_low_contrast
-from skimage.util.dtype import dtype_range, dtype_limits
-from PIL import ImageDraw, Image
+from PIL import ImageDraw, Image, ImageColor
 from torchvision.utils import draw_segmentation_masks
 import torch
 import cv2
-import math
-from scipy.stats import beta
 import pickle
 import lzma
+import gc
+import socket
+import multiprocessing as mp
+import threading
+from collections import deque
+from time import time
+from contextlib import nullcontext
+from types import SimpleNamespace
+from segm_store import SegmStore
+from metrics_io import append_rows
+from result_cache import ResultCache, file_identity
+from image_metrics import image_metrics, image_metrics_batch
+import instrument
+import job_queue
 
 parser = argparse.ArgumentParser(prog='torch_process_segm.py', description='Output image mask with possible road centres marked')
-parser.add_argument('filename', metavar='FILENAME', help='Saved numpy (.npz or .npy) file to process, or list of such files (see -F)')
+parser.add_argument('filename', metavar='FILENAME', nargs='?', default=None, help='Saved numpy (.npz or .npy) file to process, or list of such files (see -F). With --store: an image ID or image filename to look up, or a list of them (see -F), or omit it to process the whole store.')
 parser.add_argument('--verbose', '-v', action='store_true', default=False, help='Run in verbose mode')
-parser.add_argument('--filelist', '-F', action='store_true', default=False, help='Supplied path is actually a list of numpy filenames, one per line, to process.')
+parser.add_argument('--filelist', '-F', action='store_true', default=False, help='Supplied path is actually a list of numpy filenames, one per line, to process; a path of - reads the list from standard input, processing each file as soon as its name arrives')
+parser.add_argument('--done-filelist', metavar='FILE', default=None, help='Record the name of each input file in FILE (exactly as given) once it has been dealt with, whatever the outcome, including any that are not numpy files')
+parser.add_argument('--jobs', '-j', metavar='N', default=1, type=int, help='Process the files in N parallel worker processes, and print a summary at the end (default: 1)')
 parser.add_argument('--fast', action='store_true', default=False, help='Fast mode, skip most functionality except: Road Finding, SKImage Contrast, Tone-mapping, and panoramic-image cropping.')
 parser.add_argument('--centres-only', action='store_true', default=False, help='Skip all functionality except Road Finding')
 parser.add_argument('--overwrite', '-O', action='store_true', default=False, help='Overwrite output files')
 parser.add_argument('--sqloutdir', '-S', metavar='DIR', default=None, help='Directory to output SQL files')
+parser.add_argument('--sql-bulk-dir', metavar='DIR', default=None, help='Write the rows for the image and image_geo tables into a few large tab-separated files in DIR (one per process), to be loaded with load_bulk_sql.sh, rather than two SQL files per image')
+parser.add_argument('--store', metavar='DIR', default=None, help='Read label maps from a sharded store (see torch_segm_images.py --store) instead of numpy files')
 parser.add_argument('--cropsdir', metavar='DIR', default=None, help='Directory to output cropped JPGs (default: same directory as original image)')
 parser.add_argument('--tiles', '-T', metavar='FILENAME-OR-DIR', required=True, help='Directory to find tiles files in JSON, or a tiles picklefile')
 parser.add_argument('--dirprefix', '-D', default='/data/img/mapillary', help='prefix of system path for images')
 parser.add_argument('--urlprefix', '-U', default='/img/mapillary', help='prefix of URL for images')
 parser.add_argument('--cityname', '-C', default='Amsterdam', help='name of city associated with the given numpy files')
+parser.add_argument('--metrics-scale', metavar='N', default=1, type=int, choices=[1, 2, 4, 8], help='With --fast, decode non-panoramic images at 1/N of their resolution, as only the image metrics are computed from them (default: 1)')
+parser.add_argument('--recompute-quality', action='store_true', default=False, help='With --fast, recompute the Skimage contrast and Tone-mapping scores even if torch_segm_images.py --prescreen already saved them (without --fast, they are always computed at full resolution with the other metrics)')
+parser.add_argument('--cache-dir', metavar='DIR', default=None, help='Cache the results of each stage in DIR, and reuse them when run again with the same inputs and relevant options; images for which nothing has changed are skipped entirely')
+parser.add_argument('--cache-size-mb', metavar='MB', default=1024, type=int, help='Size budget of the cache (see --cache-dir); the least recently used entries are removed beyond it (default: 1024)')
 parser.add_argument('--log', action='store_true', default=False, help='Save verbose output to .out file')
+parser.add_argument('--metrics-file', metavar='FILENAME', default=None, help='Append the metrics, road centres and crops of each image to FILENAME as JSON lines (see metrics_io.py)')
 parser.add_argument('--blur', action='store_true', default=False, help='Run Gaussian blur before finding edges')
 parser.add_argument('--palette-file', '-P', metavar='FILENAME', default=None, help='File with list of colour names for mask output, one per line')
+parser.add_argument('--lut-masks', action='store_true', default=False, help='Draw the mask image with a palette lookup table rather than one boolean mask per class (same result, using far less memory)')
 parser.add_argument('--mask-alpha', metavar='ALPHA', default=0.7, type=float, help='Alpha transparency value when drawing mask over image (0 = fully transparent; 1 = fully opaque)')
 parser.add_argument('--no-houghtransform-road-centrelines', action='store_true', default=False, help='Do not draw Hough transform-based road centrelines')
 parser.add_argument('--no-segmentation-road-centrelines', action='store_true', default=False, help='Do not draw segmentation-based road centrelines')
@@ -47,169 +66,83 @@ parser.add_argument('--blobfile', '-b', metavar='FILENAME', default=None, help='
 parser.add_argument('--dataset', metavar='DATASET', default=None, help='Override segmentation dataset name (for visualisation)')
 parser.add_argument('--road-peaks-distance', metavar='N', default=None, type=int, help='Distance between peaks of road pixels')
 parser.add_argument('--road-peaks-prominence', metavar='N', default=None, type=int, help='Prominence of peaks of road pixels')
+parser.add_argument('--hough-scale', metavar='N', default=1, type=int, help='Find the vanishing points in the label map scaled down by a factor of N, with the Hough threshold and the larger morphology kernels scaled to match (the columns found are mapped back to full resolution); faster, but only approximate, as the blobs of lines depend on the resolution (see --hough-compare) (default: 1, full resolution)')
+parser.add_argument('--hough-compare', action='store_true', default=False, help='With --hough-scale, also find the vanishing points at full resolution, and report how well they agree')
 parser.add_argument('--houghlines-rho', metavar='RHO', default=None, type=float, help='Hough transform RHO parameter')
 parser.add_argument('--houghlines-theta', metavar='THETA', default=None, type=float, help='Hough transform THETA parameter')
 parser.add_argument('--houghlines-threshold', metavar='THRESH', default=None, type=int, help='Hough transform THRESHOLD parameter')
 parser.add_argument('--houghlines-min-theta', metavar='THETA', default=None, type=float, help='Hough transform MIN_THETA parameter')
 parser.add_argument('--houghlines-max-theta', metavar='THETA', default=None, type=float, help='Hough transform MAX_THETA parameter')
+instrument.add_arguments(parser)
+job_queue.add_arguments(parser)
 
-# https://stackoverflow.com/questions/58821130/how-to-calculate-the-contrast-of-an-image
-def rms_contrast(img):
-    img_grey = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    return img_grey.std()
-
-def michaelson_contrast(img):
-    Y = cv2.cvtColor(img, cv2.COLOR_BGR2YUV)[:,:,0]
-
-    # compute min and max of Y
-    min = np.min(Y).astype(float)
-    max = np.max(Y).astype(float)
-
-    # compute contrast
-    contrast = (max-min)/(max+min)
-    return contrast
-
-###################################################
-# https://towardsdatascience.com/measuring-enhancing-image-quality-attributes-234b0f250e10
-RED_SENSITIVITY = 0.299
-GREEN_SENSITIVITY = 0.587
-BLUE_SENSITIVITY = 0.114
-def convert_to_brightness_image(image: np.ndarray) -> np.ndarray:
-    if image.dtype == np.uint8:
-        raise ValueError("uint8 is not a good dtype for the image")
-
-    return np.sqrt(
-        image[..., 2] ** 2 * RED_SENSITIVITY
-        + image[..., 1] ** 2 * GREEN_SENSITIVITY
-        + image[..., 0] ** 2 * BLUE_SENSITIVITY
-    )
-def get_resolution(image: np.ndarray):
-    height, width = image.shape[:2]
-    return height * width
-
-def brightness_histogram(image: np.ndarray) -> np.ndarray:
-    nr_of_pixels = get_resolution(image)
-    brightness_image = convert_to_brightness_image(image)
-    hist, _ = np.histogram(brightness_image, bins=256, range=(0, 255))
-    return hist / nr_of_pixels
-def distribution_pmf(dist, start, stop, nr_of_steps):
-    xs = np.linspace(start, stop, nr_of_steps)
-    ys = dist.pdf(xs)
-    # divide by the sum to make a probability mass function
-    return ys / np.sum(ys)
-def correlation_distance(
-    distribution_a: np.ndarray, distribution_b: np.ndarray
-) -> float:
-    dot_product = np.dot(distribution_a, distribution_b)
-    squared_dist_a = np.sum(distribution_a ** 2)
-    squared_dist_b = np.sum(distribution_b ** 2)
-    return dot_product / math.sqrt(squared_dist_a * squared_dist_b)
-def compute_hdr(cv_image: np.ndarray):
-    img_brightness_pmf = brightness_histogram(np.float32(cv_image))
-    ref_pmf = distribution_pmf(beta(2, 2), 0, 1, 256)
-    return correlation_distance(ref_pmf, img_brightness_pmf)
-###################################################
-
-# Taken from skimage source code:
-def skimage_contrast(image, lower_percentile=1, upper_percentile=99):
-    image = np.asanyarray(image)
-
-    if image.dtype == bool:
-        return not ((image.max() == 1) and (image.min() == 0))
-
-    if image.ndim == 3:
-        from skimage.color import rgb2gray, rgba2rgb  # avoid circular import
-
-        if image.shape[2] == 4:
-            image = rgba2rgb(image)
-        if image.shape[2] == 3:
-            image = rgb2gray(image)
-
-    dlimits = dtype_limits(image, clip_negative=False)
-    limits = np.percentile(image, [lower_percentile, upper_percentile])
-    ratio = (limits[1] - limits[0]) / (dlimits[1] - dlimits[0])
-    return ratio
-
-# https://stackoverflow.com/questions/1066758/find-length-of-sequences-of-identical-values-in-a-numpy-array-run-length-encodi
-def rle(inarray):
-    """ run length encoding. Partial credit to R rle function. 
-        Multi datatype arrays catered for including non Numpy
-        returns: tuple (runlengths, startpositions, values) """
-    ia = np.asarray(inarray)                # force numpy
-    n = len(ia)
-    if n == 0: 
-        return (None, None, None)
-    else:
-        y = ia[1:] != ia[:-1]               # pairwise unequal (string safe)
-        i = np.append(np.where(y), n - 1)   # must include last element posi
-        z = np.diff(np.append(-1, i))       # run lengths
-        p = np.cumsum(np.append(0, z))[:-1] # positions
-        return(z, p, ia[i])
-
-# https://stackoverflow.com/questions/14243472/estimate-brightness-of-an-image-opencv
-def simple_brightness(img):
-    if len(img.shape) == 3:
-        # Colored RGB or BGR (*Do Not* use HSV images with this function)
-        # create brightness with euclidean norm
-        return np.average(norm(img, axis=2)) / np.sqrt(3)
-    else:
-        # Grayscale
-        return np.average(img)
-
-# http://alienryderflex.com/hsp.html
-def finley_brightness(img):
-    return np.average(np.sqrt(np.sum(img.reshape(-1,3).astype(np.float32)**2 * [0.114, 0.587, 0.299], axis=1)))
+##################################################
 
-def laplacian(image):
-    return cv2.Laplacian(image, cv2.CV_64F).var()
+# The road-finding functions below work on whole matrices at once rather than
+# column by column. They also accept a stack of matrices (shape N x H x W),
+# working along the second-to-last axis, and then return N x W arrays.
 
-##################################################
+# A boolean matrix (0 meaning non-road and 1 meaning road) of the rows of a
+# matrix of predicted labels from the middle one downwards, all that the
+# functions below need: of a memory-mapped label map, only these rows are read.
+def road_rows(pred):
+    return pred[..., pred.shape[-2]//2:, :] == 0
 
 # Given a matrix of predicted labels for pixel segmentation, where the label
 # for 'road' is 0, return the count of the longest run of 'road' labeled pixels
-# in the bottom part of the input matrix.
-def road_pixels_per_col(pred):
-    h2 = pred.shape[0]//2
-    # a is a boolean matrix (0 meaning non-road and 1 meaning road)
-    a = pred == 0.0
-    out = np.zeros(a.shape[1])
-    # For each column, i
-    for i in range(a.shape[1]):
-      # RLE - Run Length Encode column i in the matrix a.
-      # z = [count of value v]
-      # p = [position of first v]
-      # v = [actual value]
-      (z, p, v) = rle(a[:,i])
-      # For each column, test for runs of 'True' (v != 0) in the bottom part of
-      # the image (p > h2), and choose the largest run (z):
-      out[i]=z[np.logical_and(p > h2, v != 0)].max(initial=0)
-    return out
+# in the bottom part of the input matrix (considering only runs that start
+# below the middle row). a: road_rows(pred), if already computed.
+def road_pixels_per_col(pred, a=None):
+    # the rows from the middle one downwards are all that is needed to find
+    # the runs starting below the middle row (r >= 1 below)
+    if a is None:
+        a = road_rows(pred)
+    n = a.shape[-2]
+    rows = np.arange(n, dtype=np.int32).reshape(n, 1)
+    # A run of road pixels starts on each road pixel whose upper neighbour is not road
+    starts = a[..., 1:, :] & ~a[..., :-1, :]
+    # For each pixel, the row of the nearest non-road pixel at or below it (or
+    # n if none), found by a running minimum from the bottom upwards; for the
+    # start of a run, the difference with its own row is the run length.
+    nonroad = np.where(a, np.int32(n), rows)
+    nextnonroad = np.flip(np.minimum.accumulate(np.flip(nonroad, axis=-2), axis=-2), axis=-2)
+    runlengths = np.where(starts, nextnonroad[..., 1:, :] - rows[1:], 0)
+    return runlengths.max(axis=-2, initial=0).astype(np.float64)
 
 # Given a matrix of predicted labels for pixel segmentation, where the label
 # for 'road' is 0, return an array corresponding to the vertical distance
 # between the bottom of the image and the topmost 'road' pixel in each column
-# of the input matrix.
-def road_pixel_dist_from_bottom(pred):
-    h2 = pred.shape[0] // 2
-    # a is a boolean matrix (0 meaning non-road and 1 meaning road)
-    a = pred == 0.0
-    out = np.zeros(a.shape[1])
-    # For each column, i
-    for i in range(a.shape[1]):
-        # Find the rows (js) with road pixels in the bottom half of the image.
-        js = np.argwhere(a[h2:,i] != 0)
-        # Distance from image bottom to topmost road pixel, or 0 if no road.
-        out[i] = h2 - js[0,0] if np.any(js) else 0
-    return out
+# of the input matrix. a: road_rows(pred), if already computed.
+def road_pixel_dist_from_bottom(pred, a=None):
+    h2 = pred.shape[-2] // 2
+    if a is None:
+        a = road_rows(pred)
+    # Row (from the middle) of the topmost road pixel in each column
+    top = a.argmax(axis=-2)
+    # Distance from image bottom to topmost road pixel, or 0 if no road. (A
+    # column whose only road pixel is on the middle row also counts as 'no
+    # road', as it always has.)
+    hasroad = a[..., 1:, :].any(axis=-2)
+    return np.where(hasroad, h2 - top, 0).astype(np.float64)
+
+# Combined per-column road score used to find road centres
+def road_profile(pred):
+    a = road_rows(pred)
+    return road_pixel_dist_from_bottom(pred, a) + road_pixels_per_col(pred, a) / 8
 
 # Given a matrix of predicted labels for pixel segmentation, where the label
 # for 'road' is 0, return an array containing the X-coordinate values that
 # identify the centrelines of roads in the image corresponding to the
-# segmentation array.
-def road_centres(pred, distance=2000, prominence=100):
-    road = road_pixel_dist_from_bottom(pred)
-    rppc = road_pixels_per_col(pred)
-    road += rppc / 8
+# segmentation array. With plus set, the centres are those of the "plus"
+# matrix of a panoramic image (with its leftmost 25-percent appended to the
+# righthand side), found without making it: as the score of each column
+# depends on that column alone, those of the plus matrix are the scores of
+# the columns of pred, counted modulo its width.
+def road_centres(pred, distance=2000, prominence=100, plus=False):
+    road = road_profile(pred)
+    if plus:
+        w = road.shape[-1]
+        road = road[np.arange(w + w // 4) % w]
     # Adding padding on either side to ensure find_peaks will find peaks near
     # the edges.
     padding = prominence*2
@@ -217,21 +150,90 @@ def road_centres(pred, distance=2000, prominence=100):
     peaks = find_peaks(roadplus,distance=distance,prominence=prominence)[0]
     return peaks - padding
 
+# As road_centres, for a stack of equally-sized matrices (N x H x W),
+# returning a list of N arrays of X-coordinates.
+def road_centres_batch(preds, distance=2000, prominence=100):
+    padding = prominence*2
+    roads = np.pad(road_profile(preds), ((0, 0), (padding, padding)))
+    return [ find_peaks(road,distance=distance,prominence=prominence)[0] - padding for road in roads ]
+
+# The distance and prominence of the peaks of road_centres for a label map of
+# the given shape, unless given: scaled from those suited to 5760x2880 images
+def road_peaks_params(shape, distance=None, prominence=None):
+    if distance is None:
+        distance = int(2000 * shape[1] // 5760)
+    if prominence is None:
+        prominence = int(100 * shape[0] // 2880)
+    return distance, prominence
+
 ##################################################
 
-# image: PIL image
-# segmentation: Torch matrix
+# Columns xlo..xlo+width-1 of a matrix or image array (optionally only the
+# given rows), counting modulo its width, so that the columns of a panoramic
+# image wrap around from the righthand side to the lefthand side. A view of the
+# array is returned if no wrapping is needed, otherwise a copy.
+def wrap_columns(a, xlo, width, rows=slice(None)):
+    w = a.shape[1]
+    xlo %= w
+    if xlo + width <= w:
+        return a[rows, xlo:xlo+width]
+    return np.take(a[rows], np.arange(xlo, xlo + width) % w, axis=1)
+
+# An image file decoded once (by OpenCV) and shared between the metrics, the
+# overlays and the panoramic crops. With reduce=2, 4 or 8 the JPEG decoder
+# scales the image down by that factor while decoding, which is much faster
+# when only the metrics are needed.
+class DecodedImage:
+    reduce_flags = { 1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8 }
+
+    def __init__(self, path, reduce=1):
+        self.path = path
+        self.reduce = reduce
+        self.bgr = cv2.imread(str(path), self.reduce_flags[reduce])
+        if self.bgr is None:
+            raise ValueError(f'Unable to decode image "{path}"')
+        # RGB view of the same pixels
+        self.rgb = self.bgr[:, :, ::-1]
+
+    # An image already decoded by other means, given as an RGB array
+    @classmethod
+    def from_rgb(cls, path, rgb):
+        self = cls.__new__(cls)
+        self.path = path
+        self.reduce = 1
+        self.bgr = np.ascontiguousarray(rgb[:, :, ::-1])
+        self.rgb = self.bgr[:, :, ::-1]
+        return self
+
+    @property
+    def width(self):
+        return self.bgr.shape[1]
+
+    @property
+    def height(self):
+        return self.bgr.shape[0]
+
+    # The "plus" image: the leftmost 25-percent appended to the righthand side
+    # (as done before the segmentation of panoramic images), in RGB.
+    def plus(self, rows=slice(None)):
+        return wrap_columns(self.rgb, 0, self.width + self.width // 4, rows=rows)
+
+# image: image array (H x W x C)
+# segmentation: matrix of labels
 # road_centres: Matrix columns corresponding to road centres found.
 #               It is permitted for road centres to exceed matrix width by 25%
 #               because detection is performed on a matrix that wraps the first
 #               quarter of the matrix onto the righthand side in order not to
 #               miss any roads that are on the edge.
+#
+# Returns the cropped images and segmentation matrices (views of the inputs,
+# unless they wrap around the edge), and some information about each crop.
 def crop_panoramic_image(image, segmentation, road_centres):
     # img*: variables in image coordinates
-    imgw, imgh = image.size
+    imgh, imgw = image.shape[:2]
     # Segmentation may be performed on a downscaled image
     # mat*: variables in matrix coordinates
-    matw = segmentation.size(dim=1)
+    matw = segmentation.shape[1]
     # segmentation may have bottom cropped off, therefore calculate 'matrix
     # height' based on image & assume that bottom quarter of segmentation
     # matrix is not accessible
@@ -258,21 +260,19 @@ def crop_panoramic_image(image, segmentation, road_centres):
         matxset.add(centre)
         matxset.add(matxright)
 
-    # Calculate dimensions and offsets
     # The size of a cropped image will be: (w4, hFor43)
-    # The crop will start at offset (x - w4/2, h4) for each x in the xlist
+    # The crop will start at offset (x - w8, h4) for each x in the xlist
     #
-    # Some complications arise when the desired cropped image wraps around
-    # either end of the panoramic input image, or because image segmentation
+    # The cropped image wraps around either end of the panoramic image when x
+    # is near its edges, or beyond its righthand side (since segmentation
     # input is calculated based on an image that has already been wrapped with
-    # the first 25% of the image copied to the right-hand side (to ensure that
-    # any roads on the edges of the panoramic image are found).
+    # the first 25% of the image copied to the right-hand side, to ensure that
+    # any roads on the edges of the panoramic image are found); wrap_columns
+    # takes care of this by counting columns modulo the width.
     imgw4 = int(imgw / 4)
     imgw8 = int(imgw / 8)
     imgh4 = int(imgh / 4)
     imghFor43 = int(imgw4 * 3 / 4) # height for 4:3 ratio image
-    imgw98 = imgw + imgw8
-    imgxwrapneeded = int(imgw * 7 / 8)
 
     images = []
     subsegms = []
@@ -283,112 +283,9 @@ def crop_panoramic_image(image, segmentation, road_centres):
         imgx = imgw * matx // matw  # img coords
         # Thanks to Ilse Abril Vázquez Sánchez for translating my original
         # shell script code (process_out_file.sh) into Python.
-        #
-        # Wrapped all the way around:
-        if imgx >= imgw98:
-            matwrapx = matx - matw
-            imgwrapx = imgx - imgw
-            matxlo = int(matwrapx - matw8)
-            imgxlo = int(imgwrapx - imgw8)
-            cropped_image = image.crop((imgxlo, imgh4, imgxlo + imgw4, imgh4 + imghFor43))
-            cropped_segmentation = segmentation[math4:math4+mathFor43, matxlo:matxlo+matw4]
-            info = {
-                'imgx': imgx, 'matx': matx, 'case': 'imgx >= imgw98', 'vars': { 'matxlo': matxlo, 'imgxlo': imgxlo },
-                'imgpieces': [ (imgxlo, imgh4, imgxlo + imgw4, imgh4 + imghFor43) ],
-                'matpieces': [ (math4,math4+mathFor43, matxlo,matxlo+matw4) ]
-            }
-        
-        # Cropped image requires assembly of two sides, wrapping around
-        # righthand side of image:
-        elif imgx > imgxwrapneeded:
-            matxlo = int(matx - matw8)
-            imgxlo = int(imgx - imgw8)
-            # width of piece 1: between xlo and the righthand side of the image
-            matw4_p1 = matw - matxlo
-            imgw4_p1 = imgw - imgxlo
-            # width of piece 2: the remaining width needed, starting from the
-            # lefthand side of the image
-            matw4_p2 = matw4 - matw4_p1
-            imgw4_p2 = imgw4 - imgw4_p1
-
-            # Crop and concatenate image and segmentation
-            cropped_image_1 = image.crop((imgxlo, imgh4, imgxlo + imgw4_p1, imgh4 + imghFor43))
-            cropped_image_2 = image.crop((0, imgh4, imgw4_p2, imgh4 + imghFor43))
-
-            cropped_image = Image.new(image.mode, (imgw4, imghFor43))
-            cropped_image.paste(cropped_image_1, (0, 0))
-            cropped_image.paste(cropped_image_2, (imgw4_p1, 0))
-
-            cropped_segmentation_1 = segmentation[math4:math4+mathFor43, matxlo:matxlo+matw4_p1]
-            cropped_segmentation_2 = segmentation[math4:math4+mathFor43, 0:matw4_p2]
-            cropped_segmentation = torch.cat((cropped_segmentation_1, cropped_segmentation_2), dim=1)
-
-            info = {
-                'imgx': imgx, 'matx': matx, 'case': 'imgx > imgxwrapneeded',
-                'vars': {
-                    'matxlo': matxlo, 'imgxlo': imgxlo,
-                    'matw4_p1': matw4_p1, 'imgw4_p1': imgw4_p1,
-                    'matw4_p2': matw4_p2, 'imgw4_p2': imgw4_p2,
-
-                },
-                'imgpieces': [ (imgxlo, imgh4, imgxlo + imgw4_p1, imgh4 + imghFor43), (0, imgh4, imgw4_p2, imgh4 + imghFor43) ],
-                'matpieces': [  (math4,math4+mathFor43, matxlo,matxlo+matw4_p1), (math4,math4+mathFor43, 0,matw4_p2) ]
-            }
-        
-        # Cropped image requires assembly of two sides, wrapping around
-        # lefthand side of image:
-        elif imgx < imgw8:
-            # given x appears between 0 and w8:
-            # x coords:        0     x    w8
-            #            |<---------w4----------->|
-            #            |<----w8--->|<----w8---->|
-            #                  |<-x->|
-            #            |<--->|<---------------->|
-            #              p1          p2
-            # ergo, width of piece 1 (p1) = w8 - x
-            imgw4_p1 = int(imgw8 - imgx)
-            matw4_p1 = int(matw8 - matx)
-            imgxhi = imgw - imgw4_p1
-            matxhi = matw - matw4_p1
-            # width of piece 2 (p2) is remainder
-            imgw4_p2 = imgw4 - imgw4_p1
-            matw4_p2 = matw4 - matw4_p1
-
-            # Crop and concatenate image and segmentation
-            cropped_image_1 = image.crop((imgxhi, imgh4, imgxhi + imgw4_p1, imgh4 + imghFor43))
-            cropped_image_2 = image.crop((0, imgh4, imgw4_p2, imgh4 + imghFor43))
-
-            cropped_image = Image.new(image.mode, (imgw4, imghFor43))
-            cropped_image.paste(cropped_image_1, (0, 0))
-            cropped_image.paste(cropped_image_2, (imgw4_p1, 0))
-
-            cropped_segmentation_1 = segmentation[math4:math4+mathFor43, matxhi:matxhi+matw4_p1]
-            cropped_segmentation_2 = segmentation[math4:math4+mathFor43, 0:matw4_p2]
-            cropped_segmentation = torch.cat((cropped_segmentation_1, cropped_segmentation_2), dim=1)
-
-            info = {
-                'imgx': imgx, 'matx': matx, 'case': 'imgx < imgw8',
-                'vars': {
-                    'matxhi': matxhi, 'imgxhi': imgxhi,
-                    'matw4_p1': matw4_p1, 'imgw4_p1': imgw4_p1,
-                    'matw4_p2': matw4_p2, 'imgw4_p2': imgw4_p2,
-
-                },
-                'imgpieces': [ (imgxhi, imgh4, imgxhi + imgw4_p1, imgh4 + imghFor43), (0, imgh4, imgw4_p2, imgh4 + imghFor43) ],
-                'matpieces': [ (math4,math4+mathFor43, matxhi,matxhi+matw4_p1), (math4,math4+mathFor43, 0,matw4_p2)]
-            }
-        # Straightforward crop
-        else:
-            matxlo = int(matx - matw8)
-            imgxlo = int(imgx - imgw8)
-            cropped_image = image.crop((imgxlo, imgh4, imgxlo + imgw4, imgh4 + imghFor43))
-            cropped_segmentation = segmentation[math4:math4+mathFor43, matxlo:matxlo+matw4]
-            info = {
-                'imgx': imgx, 'matx': matx, 'case': 'default',
-                'vars': { 'matxlo': matxlo, 'imgxlo': imgxlo },
-                'imgpieces': [ (imgxlo, imgh4, imgxlo + imgw4, imgh4 + imghFor43) ],
-                'matpieces': [ (math4,math4+mathFor43, matxlo,matxlo+matw4) ]
-            }
+        cropped_image = wrap_columns(image, imgx - imgw8, imgw4, rows=slice(imgh4, imgh4 + imghFor43))
+        cropped_segmentation = wrap_columns(segmentation, matx - matw8, matw4, rows=slice(math4, math4 + mathFor43))
+        info = { 'imgx': imgx, 'matx': matx, 'imgxlo': (imgx - imgw8) % imgw, 'matxlo': (matx - matw8) % matw }
 
         images.append(cropped_image)
         subsegms.append(cropped_segmentation)
@@ -398,11 +295,62 @@ def crop_panoramic_image(image, segmentation, road_centres):
 
 ##################################################
 
-def main():
-    args = parser.parse_args()
-    def vlog(s):
-        if args.verbose:
-            print(s)
+# Options that the vanishing points depend on (see --cache-dir)
+vps_args = [ 'blur', 'hough_scale', 'houghlines_rho', 'houghlines_theta', 'houghlines_threshold', 'houghlines_min_theta', 'houghlines_max_theta' ]
+
+# Options that do not affect the outcome of processing a file, left out of the
+# key of its cached result (see --cache-dir)
+uncached_args = [ 'filename', 'filelist', 'done_filelist', 'verbose', 'jobs', 'store', 'cache_dir', 'cache_size_mb', 'trace', 'progress', 'profile', 'queue', 'lease', 'max_attempts' ]
+
+# Suffix of the files written by --sql-bulk-dir (see load_bulk_sql.sh)
+bulk_suffix = '.image.tsv'
+
+# With --store, the minimum number of seconds between rereadings of its index
+# for keys that are missing (see do_store_task)
+store_update_interval = 1.0
+
+# A value in PostgreSQL's COPY text format
+def copy_field(v):
+    if v is None:
+        return '\\N'
+    return str(v).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+# Draws the segmentation labels in the colours of the given palette over the
+# image (RGB, same height and width as labels; None for a blank image), as
+# draw_segmentation_masks does with one boolean mask per label, but with a
+# lookup table from label to colour and a single alpha blend. As with
+# draw_segmentation_masks, the labels present are coloured in the order of the
+# palette (the lowest label present gets the first colour, and so on), and
+# missing colours are grey. Also returns the greyscale image of the labels
+# drawn over a blank image in draw_segmentation_masks' default colours and
+# alpha of 0.8, which is what the edges are found in, computed from the labels
+# directly.
+def render_masks_lut(labels, image, colors, alpha):
+    present = np.bincount(labels.ravel()) > 0
+    # rank of each label among the labels present
+    rank = np.maximum(np.cumsum(present) - 1, 0)
+    ncolors = max(len(colors), np.count_nonzero(present))
+    palette = np.array([ ImageColor.getrgb(c) for c in colors ] + [ (128, 128, 128) ] * (ncolors - len(colors)), dtype=np.uint8)
+    lut = palette[rank]
+    if image is None:
+        image = np.zeros(labels.shape + (3,), dtype=np.uint8)
+    # same single-precision arithmetic (and truncation) as draw_segmentation_masks
+    out = image * np.float32(1 - alpha)
+    out += (lut * np.float32(alpha))[labels]
+    maskedimg = out.astype(np.uint8)
+    defaultpalette = (np.arange(len(present)).reshape(-1, 1) * [ 2**25 - 1, 2**15 - 1, 2**21 - 1 ]) % 255
+    greylut = cv2.cvtColor((defaultpalette[rank] * np.float32(0.8)).astype(np.uint8)[None], cv2.COLOR_RGB2GRAY)[0]
+    return maskedimg, greylut[labels]
+
+# Loads the tiles database and sets up the outputs, and returns an object with
+# the function processing one file (do_file), the result cache (if any) and
+# the instrumentation timing the stages (instr, see instrument.py). Also used
+# by 'torch_segm_images.py --process' to process the label maps as they are
+# produced, timed by its own instr.
+def setup(args, vlog, instr=None):
+    if instr is None:
+        instr = instrument.from_args('torch_process_segm.py', args)
+
     def load_tiles_db(tilespath):
         tiles = Path(tilespath)
         if not tiles.is_dir():
@@ -439,7 +387,8 @@ def main():
             return db
 
     if args.tiles is not None:
-        db = load_tiles_db(args.tiles)
+        with instr.stage('tiles', images=0):
+            db = load_tiles_db(args.tiles)
     else:
         db = None
     sqloutdir = None
@@ -452,6 +401,13 @@ def main():
         if not sqloutdir.is_dir():
             print(f'Failed to make SQL output directory: {sqloutdir}')
             sys.exit(1)
+    sqlbulkdir = None
+    if args.sql_bulk_dir is not None:
+        if db is None:
+            print(f'Cannot output SQL files without tiles information.')
+            sys.exit(1)
+        sqlbulkdir = Path(args.sql_bulk_dir)
+        os.makedirs(sqlbulkdir, exist_ok=True)
 
     def sqlout(stem, seqid, typ, s):
         if sqloutdir is None: return
@@ -463,7 +419,133 @@ def main():
         else:
             vlog(f'WARNING: file {outfilename} already exists and overwriting is not enabled!')
 
-    def do_file(filename):
+    # Edges (Canny) of the greyscale rendering of a label map, and lines
+    # (Hough transform) along them, optionally with the rendering scaled down
+    # by scale (with the blur kernel and the Hough threshold scaled to match)
+    def hough_lines(gray, vlog, scale=1):
+        if scale > 1:
+            gray = gray[::scale, ::scale]
+        if args.blur or args.blurfile:
+            k = max(3, (5 // scale) | 1)
+            vlog(f'Running Gaussian blur with kernel {k}x{k}.')
+            blur = cv2.GaussianBlur(gray, (k, k), 1 / scale)
+            if args.blurfile:
+                vlog(f'Writing blur image "{args.blurfile}".')
+                cv2.imwrite(args.blurfile,blur)
+        else:
+            blur = None
+
+        edgeImg = cv2.Canny(blur if blur is not None else gray, 40, 255)
+        if args.edgefile:
+            vlog(f'Writing edges image to "{args.edgefile}".')
+            cv2.imwrite(args.edgefile, edgeImg)
+
+        #lines = cv2.HoughLinesP(edgeImg, 1, np.pi / 180, 50, None, 50, 10)
+        rho = float(args.houghlines_rho or 1)
+        theta = float(args.houghlines_theta or np.pi/120)
+        # the number of votes for a line is proportional to its length in pixels
+        threshold = max(1, int(args.houghlines_threshold or 120) // scale)
+        min_theta = float(args.houghlines_min_theta or np.pi/36)
+        max_theta = float(args.houghlines_max_theta or np.pi-np.pi/36)
+        vlog(f'Running HoughLines (rho={rho}, theta={theta}, threshold={threshold}, min_theta={min_theta}, max_theta={max_theta}).')
+        lines = cv2.HoughLines(edgeImg, rho, theta, threshold, min_theta=min_theta, max_theta=max_theta)
+        return edgeImg, lines
+
+    # Find vanishing points (as columns) in the greyscale rendering of a label
+    # map of the given width: the road edges are found with Canny, lines along
+    # them with the Hough transform, and the vanishing points as the columns
+    # where the most lines coalesce into blobs. With scale above 1 (see
+    # --hough-scale), all this is done on the rendering scaled down by scale,
+    # with the Hough threshold and the larger morphology kernels scaled to
+    # match, and the columns found are mapped back to full resolution.
+    def vanishing_points(gray, width, vlog, scale=1):
+        edgeImg, lines = hough_lines(gray, vlog, scale)
+
+        # The lines are drawn over the edges in one channel only: a pixel
+        # ends up in a blob if it is non-zero after the erosions and
+        # dilations, for which the other two channels of a colour image (the
+        # edges alone) make no difference, as they are never brighter.
+        linesImg = edgeImg.copy()
+
+        # https://stackoverflow.com/questions/57535865/extract-vanishing-point-from-lines-with-open-cv
+        if lines is not None:
+            vlog(f'Line count: {len(lines)}')
+            rho = lines[:, 0, 0]
+            theta = lines[:, 0, 1]
+            a = np.cos(theta)
+            b = np.sin(theta)
+            x0 = a*rho
+            y0 = b*rho
+            # the end points of all the lines, drawn in one call (the same
+            # pixels as drawing them one by one with cv2.line)
+            ends = np.stack([ x0 + 10000*(-b), y0 + 10000*(a), x0 - 10000*(-b), y0 - 10000*(a) ], axis=1).astype(np.int32)
+            cv2.polylines(linesImg, list(ends.reshape(-1, 2, 2)), False, 255, 1, cv2.LINE_AA)
+
+        if args.linefile:
+            vlog(f'Writing lines image to "{args.linefile}".')
+            # (the edges in white, with the lines in green)
+            cv2.imwrite(args.linefile, cv2.merge([ edgeImg, linesImg, edgeImg ]))
+
+        # The 3x3 erosion removes the lines (one pixel wide at any scale),
+        # leaving the places where many of them cross, which the larger
+        # kernels then coalesce into blobs (or remove, if too small)
+        def kernel(k):
+            if scale > 1 and k > 3:
+                k = max(3, (k // scale) | 1)
+            return np.ones((k,k),np.uint8)
+        blobs = cv2.erode(linesImg,kernel(3),iterations=1)
+        blobs = cv2.dilate(blobs,kernel(9),iterations=1)
+        blobs = cv2.erode(blobs,kernel(11),iterations=1)
+        blobs = cv2.dilate(blobs,kernel(11),iterations=1)
+        if args.blobfile:
+            vlog(f'Writing blobs image to "{args.blobfile}".')
+            cv2.imwrite(args.blobfile, blobs)
+
+        grayblobs1d = np.count_nonzero(blobs,axis=0)
+        #blobvp1 = grayblobs1d.argmax()
+        #blobvp2 = (blobvp1 + predict.shape[1]//2) % predict.shape[1]
+        #print(f'blobvp1={blobvp1} blobvp2={blobvp2}')
+
+        peaks = find_peaks(grayblobs1d, distance=max(1, width//4//scale))[0]
+        return peaks * scale + scale // 2
+
+    # Every process (see --jobs) appends to its own file, opened on first use,
+    # so that no two processes ever write to the same file. Each row is flushed
+    # as it is written, so an interrupted run leaves only complete rows.
+    bulkfps = {}
+    def bulkout(row):
+        if sqlbulkdir is None: return
+        pid = os.getpid()
+        if pid not in bulkfps:
+            bulkfps[pid] = open(sqlbulkdir / f'{socket.gethostname()}-{pid}-{int(time()*1000)}{bulk_suffix}', 'a')
+        bulkfps[pid].write('\t'.join(copy_field(v) for v in row) + '\n')
+        bulkfps[pid].flush()
+
+    cache = None
+    if args.cache_dir is not None:
+        cache = ResultCache(args.cache_dir, max_bytes=args.cache_size_mb << 20)
+        # everything else that the outcome of processing a file depends on
+        cacheargs = { k: v for k, v in vars(args).items() if k not in uncached_args }
+        tilessource = file_identity(args.tiles)
+
+    # filename: numpy file, or (if predict is supplied) the original image file,
+    # from which the names of the other inputs and outputs are derived.
+    # source: identity of the label map for --cache-dir (default: that of the file)
+    # image: the original image, if already decoded (a DecodedImage)
+    def do_file(filename, predict=None, modelname=None, quality=None, source=None, image=None):
+        jpgfile = Path(filename).with_suffix('.jpg')
+        if cache is not None:
+            if source is None:
+                source = file_identity(filename)
+            jpgsource = file_identity(jpgfile)
+            resultkey = cache.key('result', source=source, jpg=jpgsource, tiles=tilessource, args=cacheargs)
+            cached = cache.get(resultkey)
+            if cached is not None:
+                # checked before opening the .out file, which is kept as it is
+                if args.verbose:
+                    print(f'Unchanged since the last run, skipping "{filename}".')
+                return { **cached, 'status': 'unchanged' }
+
         if args.log:
             outfile = Path(filename).with_suffix('.out')
             logfp = open(outfile, 'w')
@@ -473,13 +555,22 @@ def main():
             if args.verbose:
                 print(s)
 
-        vlog(f'Loading "{filename}".')
-        if Path(filename).suffix == '.npz':
-            with np.load(filename) as f:
+        if predict is not None:
+            vlog(f'Label map of "{Path(filename).stem}" already loaded (from the store, or by torch_segm_images.py --process).')
+        elif Path(filename).suffix == '.npz':
+            vlog(f'Loading "{filename}".')
+            with instr.stage('load'), np.load(filename) as f:
                 predict = f['predict']
                 modelname = str(f['modelname'])
+                if 'skimage_contrast' in f and 'tone_mapping' in f:
+                    quality = { 'skimage_contrast': float(f['skimage_contrast']), 'tone_mapping': float(f['tone_mapping']) }
         else:
-            predict = np.load(filename)
+            vlog(f'Loading "{filename}".')
+            # an uncompressed label map is memory-mapped rather than read in,
+            # so that only the parts of it that are used are read (e.g. just
+            # the bottom half with --centres-only)
+            with instr.stage('load'):
+                predict = np.load(filename, mmap_mode='r')
             modelname = None
         origstem = Path(filename).stem
         try:
@@ -487,54 +578,100 @@ def main():
         except:
             imgid = origstem
         vlog(f'Assuming imgid={imgid}')
+        # summary of the outcome, returned to the caller
+        result = { 'filename': str(filename), 'imgid': imgid, 'status': 'ok' }
+        # rows for --metrics-file: the image itself, followed by any crops
+        metrics = {}
+        croprows = []
+        def finish():
+            if args.metrics_file is not None:
+                imagerow = { 'kind': 'image', **result, 'jpg': str(jpgfile) if jpgfile.exists() else None,
+                             'modelname': modelname, 'shape': list(predict.shape), **metrics }
+                append_rows(args.metrics_file, [ imagerow ] + croprows)
+            if args.log:
+                logfp.close()
+            if cache is not None:
+                cache.put(resultkey, result)
+            return result
 
-        jpgfile = Path(filename).with_suffix('.jpg')
+        is_pano = (imgid in db and db[imgid]['is_pano']) or predict.shape[1] >= predict.shape[0] * 2
+
+        # The image is decoded only once, here, and then used for everything
+        decoded = None
         rgbimg = None
         if jpgfile.exists() and not args.centres_only:
-            img = cv2.imread(str(jpgfile))
-            rgbimg = img[:, :, ::-1]
+            # only the metrics are needed from non-panoramic images in --fast mode
+            reduce = args.metrics_scale if args.fast and not is_pano and image is None else 1
+            imgmetrics = None
+            # in --fast mode, the quality scores are all the metrics there
+            # are, so those already computed (at --prescreen-scale) by the
+            # pre-screening in torch_segm_images.py are used instead
+            prescreened = quality is not None and not args.recompute_quality and args.fast
+            if prescreened:
+                imgmetrics = {}
+            elif cache is not None:
+                metricskey = cache.key('metrics', jpg=jpgsource, quality_only=args.fast, reduce=reduce)
+                imgmetrics = cache.get(metricskey)
+            # the image itself is needed for the crops and overlays
+            if imgmetrics is None or is_pano or not args.fast:
+                if image is not None:
+                    decoded = image
+                else:
+                    with instr.stage('decode'):
+                        decoded = DecodedImage(jpgfile, reduce=reduce)
+                img = decoded.bgr
+                rgbimg = decoded.rgb
+            if imgmetrics is None:
+                with instr.stage('metrics'):
+                    imgmetrics = image_metrics(img, quality_only=args.fast)
+                if cache is not None:
+                    cache.put(metricskey, imgmetrics)
+            metrics.update(imgmetrics)
+            if prescreened:
+                metrics.update(quality)
             if not args.fast:
-                vlog(f'Simple brightness: {simple_brightness(img)}')
-                vlog(f'Finley brightness: {finley_brightness(img)}')
-                vlog(f'Michaelson contrast: {michaelson_contrast(img)}')
-                vlog(f'RMS contrast: {rms_contrast(img)}')
-                vlog(f'Is low contrast?: {is_low_contrast(rgbimg, fraction_threshold=0.35)}')
-                vlog(f'Laplacian: {laplacian(img)}')
-            vlog(f'Skimage contrast: {skimage_contrast(rgbimg)}')
-            vlog(f'Tone-mapping score: {compute_hdr(img)}')
+                vlog(f'Simple brightness: {metrics["simple_brightness"]}')
+                vlog(f'Finley brightness: {metrics["finley_brightness"]}')
+                vlog(f'Michaelson contrast: {metrics["michaelson_contrast"]}')
+                vlog(f'RMS contrast: {metrics["rms_contrast"]}')
+                vlog(f'Is low contrast?: {metrics["is_low_contrast"]}')
+                vlog(f'Laplacian: {metrics["laplacian"]}')
+            vlog(f'Skimage contrast: {metrics["skimage_contrast"]}')
+            vlog(f'Tone-mapping score: {metrics["tone_mapping"]}')
 
         vlog(f'Matrix shape: {predict.shape}.')
-        if (imgid in db and db[imgid]['is_pano']) or predict.shape[1] >= predict.shape[0] * 2:
-            # panoramic
-            predictplus = np.append(predict, predict[:,:predict.shape[1]//4],axis=1)
-            vlog(f'Assuming panoramic input, extending width to {predictplus.shape[1]}.')
-            is_pano = True
-        else:
-            predictplus = predict
-            is_pano = False
-
-        distance=args.road_peaks_distance
-        if distance is None:
-            distance = int(2000 * predict.shape[1] // 5760)
+        if is_pano:
+            vlog(f'Assuming panoramic input, extending width to {predict.shape[1] + predict.shape[1]//4}.')
 
-        prominence=args.road_peaks_prominence
-        if prominence is None:
-            prominence = int(100 * predict.shape[0] // 2880)
+        distance, prominence = road_peaks_params(predict.shape, args.road_peaks_distance, args.road_peaks_prominence)
 
         vlog(f'Seeking road centres (using pixel segmentation; distance={distance}, prominence={prominence})...')
 
-        centres=road_centres(predictplus, distance=distance, prominence=prominence)
+        centres = None
+        if cache is not None:
+            centreskey = cache.key('centres', source=source, is_pano=is_pano, distance=distance, prominence=prominence)
+            centres = cache.get(centreskey)
+        if centres is not None:
+            centres = np.array(centres, dtype=np.int64)
+        else:
+            with instr.stage('centres'):
+                centres=road_centres(predict, distance=distance, prominence=prominence, plus=is_pano)
+            if cache is not None:
+                cache.put(centreskey, centres.tolist())
         vlog(f'Found road centres: {centres}.')
+        result.update(is_pano=is_pano, centres=centres.tolist())
         dataset = args.dataset or 'citys'
         if args.centres_only:
-            if args.log:
-                logfp.close()
-            return
+            return finish()
 
         if modelname is not None and args.dataset is None:
             dataset = modelname.split('_')[-1] 
 
         def sql(imgid, stem, angle_delta=0.0):
+            with instr.stage('sql'):
+                sql_stage(imgid, stem, angle_delta)
+
+        def sql_stage(imgid, stem, angle_delta):
             if imgid not in db:
                 vlog(f'Image ID {imgid} not found in tiles database, skipping SQL output.')
                 return
@@ -554,15 +691,22 @@ INSERT INTO image (url, system_path, cityname, enabled) VALUES ('{url}', '{syspa
 INSERT INTO image_geo (angle_deg, geo, image_id) SELECT {angle} AS angle_deg, {geo} AS geo, image_id FROM image_ins ON CONFLICT DO NOTHING;
 """)
             sqlout(stem, seq_id, 'enable', f"UPDATE image SET enabled=true WHERE system_path = '{syspath}';\n")
+            bulkout((imgid, seq_id, stem, url, syspath, cityname, angle, lon, lat))
 
-        if jpgfile.exists() and is_pano:
-            image = Image.open(jpgfile)
-            origwidth = image.size[0]
-            subimages, subsegms, infos = crop_panoramic_image(image, torch.from_numpy(predict), centres)
+        if decoded is not None and is_pano:
+            origwidth = decoded.width
+            with instr.stage('crops'):
+                subimages, subsegms, infos = crop_panoramic_image(decoded.rgb, predict, centres)
             #vlog(f'crop_panoramic_image: info={json.dumps(infos, default=int, indent=2)}')
             if args.cropsdir is not None:
                 os.makedirs(args.cropsdir, exist_ok=True)
-            for (subimg, info) in zip(subimages, infos):
+            # the crop rows of --metrics-file have the metrics of the crops
+            # themselves, not those of the whole panorama
+            cropmetrics = [ {} ] * len(subimages)
+            if args.metrics_file is not None and metrics:
+                with instr.stage('metrics'):
+                    cropmetrics = image_metrics_batch([ cv2.cvtColor(subimg, cv2.COLOR_RGB2BGR) for subimg in subimages ], quality_only=args.fast)
+            for (subimg, info, submetrics) in zip(subimages, infos, cropmetrics):
                 #vlog(f'imgx={info["imgx"]}')
                 imgx = info['imgx']
                 subimgfilename = Path(filename).with_stem(f'{origstem}_x{imgx}').with_suffix('.jpg')
@@ -571,18 +715,21 @@ INSERT INTO image_geo (angle_deg, geo, image_id) SELECT {angle} AS angle_deg, {g
                     subimgfilename = Path(args.cropsdir) / subimgfilename.name
                 if args.overwrite or not subimgfilename.exists():
                     vlog(f'Cropped image file: {subimgfilename}')
-                    subimg.save(subimgfilename)
+                    with instr.stage('crops'):
+                        Image.fromarray(subimg).save(subimgfilename)
                 else:
                     vlog(f'Cropped image file (already exists): {subimgfilename}')
-                sql(imgid, stem, 360.0 * imgx / origwidth if origwidth != 0.0 else 0.0)
+                angle_delta = 360.0 * imgx / origwidth if origwidth != 0.0 else 0.0
+                sql(imgid, stem, angle_delta)
+                croprows.append({ 'kind': 'crop', 'imgid': imgid, 'stem': stem, 'filename': str(subimgfilename),
+                                  'imgx': int(imgx), 'angle_delta': angle_delta, 'is_pano': True,
+                                  'shape': list(subimg.shape[:2]), 'modelname': modelname, **submetrics })
         else:
             # non-pano, or no jpg file found
             sql(imgid, origstem)
 
         if args.fast:
-            if args.log:
-                logfp.close()
-            return
+            return finish()
 
         colors = [ '#000000' ]
         if args.palette_file is not None:
@@ -591,119 +738,88 @@ INSERT INTO image_geo (angle_deg, geo, image_id) SELECT {angle} AS angle_deg, {g
                 for c in fp:
                     if len(c.strip()) > 0: colors.append(c.strip())
 
-        vlog(f'Generating mask image.')
-        blank = torch.zeros(3, predictplus.shape[0], predictplus.shape[1], dtype=torch.uint8)
-        rgbimgplus = None
-        if rgbimg is not None and is_pano:
-            # Simulate augmentation of underlying image in the same way that was
-            # done for the semantic segmentation process
-            rgbimgplus = np.append(rgbimg, rgbimg[:,:rgbimg.shape[1]//4],axis=1)
-            if (rgbimg.shape[0]*3//4) % predictplus.shape[0] == 0:
-                # crop bottom fourth of image, if it results in an integer scaledown_factor
-                rgbimgplus = rgbimgplus[:rgbimg.shape[0]*3//4,:]
-            #scaledown_factor = rgbimgplus.shape[0] // predictplus.shape[0]
-            # Thus, ensure that rgbimgplus has the same shape as predictplus
-            rgbimgplus = cv2.resize(rgbimgplus, (predictplus.shape[1], predictplus.shape[0]))
-            # Rearrange dimensions to make Torch draw_segmentation_masks happy
-            seginput = torch.from_numpy(np.transpose(rgbimgplus, (2, 0, 1)))
-            alpha = args.mask_alpha
-        elif rgbimg is not None:
-            # Rearrange dimensions to make Torch draw_segmentation_masks happy
-            rgbimgresized = cv2.resize(rgbimg, (predictplus.shape[1], predictplus.shape[0]))
-            seginput = torch.from_numpy(np.transpose(rgbimgresized, (2, 0, 1)))
-            alpha = args.mask_alpha
+        # the "plus" matrix itself is only needed from here on
+        if is_pano:
+            predictplus = wrap_columns(predict, 0, predict.shape[1] + predict.shape[1]//4)
         else:
-            # Can't find base image; so assume blank
-            seginput = blank
-            alpha = 1
-
-        # Split the predictplus array of integers (ranging 0..N) into N separate arrays
-        # of Boolean values, because this is what draw_segmentation_masks needs.
-        masks_bool = np.array([predictplus == x for x in np.unique(predictplus)])
-
-        # If there are insufficient colours then add grey to the list as many times as needed
-        while len(colors) < masks_bool.shape[0]:
-           colors.append('#808080')
-
-        # maskedimg has the combined masks drawn on top of the underlying image
-        maskedimg = draw_segmentation_masks(seginput, torch.tensor(masks_bool,dtype=torch.bool), alpha=alpha, colors=colors).numpy()
-        # transpose it back to OpenCV style
-        maskedimg = np.transpose(maskedimg, [1, 2, 0])
-
-        # This combined mask is drawn on top of blank underlying image, for further analysis
-        mask = draw_segmentation_masks(blank, torch.tensor(masks_bool,dtype=torch.bool)).numpy()
-        # transpose it back to OpenCV style
-        mask = np.transpose(mask, [1, 2, 0])
-
-        # Further analysis...
-        gray = cv2.cvtColor(mask, cv2.COLOR_RGB2GRAY)
-        
-        if args.blur or args.blurfile:
-            k=5
-            vlog(f'Running Gaussian blur with kernel {k}x{k}.')
-            blur = cv2.GaussianBlur(gray, (k, k), 1)
-            if args.blurfile:
-                vlog(f'Writing blur image "{args.blurfile}".')
-                cv2.imwrite(args.blurfile,blur)
-        else:
-            blur = None
-
-        edgeImg = cv2.Canny(blur if blur is not None else gray, 40, 255)
-        if args.edgefile:
-            vlog(f'Writing edges image to "{args.edgefile}".')
-            cv2.imwrite(args.edgefile, edgeImg)
-
-        #lines = cv2.HoughLinesP(edgeImg, 1, np.pi / 180, 50, None, 50, 10)
-        rho = float(args.houghlines_rho or 1)
-        theta = float(args.houghlines_theta or np.pi/120)
-        threshold = int(args.houghlines_threshold or 120)
-        min_theta = float(args.houghlines_min_theta or np.pi/36)
-        max_theta = float(args.houghlines_max_theta or np.pi-np.pi/36)
-        vlog(f'Running HoughLines (rho={rho}, theta={theta}, threshold={threshold}, min_theta={min_theta}, max_theta={max_theta}).')
-        lines = cv2.HoughLines(edgeImg, rho, theta, threshold, min_theta=min_theta, max_theta=max_theta)
-
-        cdst = cv2.cvtColor(edgeImg, cv2.COLOR_GRAY2BGR)
-
-        # https://stackoverflow.com/questions/57535865/extract-vanishing-point-from-lines-with-open-cv
-        if lines is not None:
-            vlog(f'Line count: {len(lines)}')
-            for line in lines:
-                rho,theta = line[0]
-                a = np.cos(theta)
-                b = np.sin(theta)
-                x0 = a*rho
-                y0 = b*rho
-                x1 = int(x0 + 10000*(-b))
-                y1 = int(y0 + 10000*(a))
-                x2 = int(x0 - 10000*(-b))
-                y2 = int(y0 - 10000*(a))
-                cv2.line(cdst,(x1,y1),(x2,y2),(0,255,0),1, cv2.LINE_AA)
-
-        if args.linefile:
-            vlog(f'Writing lines image to "{args.linefile}".')
-            cv2.imwrite(args.linefile, cdst)
-
-        blobs = np.copy(cdst)
-
-        kernel = np.ones((3,3),np.uint8)
-        blobs = cv2.erode(blobs,kernel,iterations=1)
-        kernel = np.ones((9,9),np.uint8)
-        blobs = cv2.dilate(blobs,kernel,iterations=1)
-        kernel = np.ones((11,11),np.uint8)
-        blobs = cv2.erode(blobs,kernel,iterations=1)
-        blobs = cv2.dilate(blobs,kernel,iterations=1)
-        if args.blobfile:
-            vlog(f'Writing blobs image to "{args.blobfile}".')
-            cv2.imwrite(args.blobfile, blobs)
+            predictplus = predict
 
-        grayblobs = cv2.cvtColor(blobs,cv2.COLOR_BGR2GRAY)
-        grayblobs1d = np.count_nonzero(grayblobs,axis=0)
-        #blobvp1 = grayblobs1d.argmax()
-        #blobvp2 = (blobvp1 + predict.shape[1]//2) % predict.shape[1]
-        #print(f'blobvp1={blobvp1} blobvp2={blobvp2}')
+        vlog(f'Generating mask image.')
+        with instr.stage('masks'):
+            rgbimgplus = None
+            if rgbimg is not None and is_pano:
+                # Simulate augmentation of underlying image in the same way that was
+                # done for the semantic segmentation process
+                if (rgbimg.shape[0]*3//4) % predictplus.shape[0] == 0:
+                    # crop bottom fourth of image, if it results in an integer scaledown_factor
+                    rgbimgplus = decoded.plus(rows=slice(0, rgbimg.shape[0]*3//4))
+                else:
+                    rgbimgplus = decoded.plus()
+                #scaledown_factor = rgbimgplus.shape[0] // predictplus.shape[0]
+                # Thus, ensure that rgbimgplus has the same shape as predictplus
+                rgbimgplus = cv2.resize(rgbimgplus, (predictplus.shape[1], predictplus.shape[0]))
+                baseimg = rgbimgplus
+                alpha = args.mask_alpha
+            elif rgbimg is not None:
+                baseimg = cv2.resize(rgbimg, (predictplus.shape[1], predictplus.shape[0]))
+                alpha = args.mask_alpha
+            else:
+                # Can't find base image; so assume blank
+                baseimg = None
+                alpha = 1
 
-        blobvps = find_peaks(grayblobs1d, distance=predict.shape[1]//4)[0]
-        vlog(f'Found vanishing points (using coalesced blobs): {blobvps}.')
+            if args.lut_masks:
+                maskedimg, gray = render_masks_lut(predictplus, baseimg, colors, alpha)
+            else:
+                # Rearrange dimensions to make Torch draw_segmentation_masks happy
+                blank = torch.zeros(3, predictplus.shape[0], predictplus.shape[1], dtype=torch.uint8)
+                seginput = blank if baseimg is None else torch.from_numpy(np.transpose(baseimg, (2, 0, 1)))
+
+                # Split the predictplus array of integers (ranging 0..N) into N separate arrays
+                # of Boolean values, because this is what draw_segmentation_masks needs.
+                masks_bool = np.array([predictplus == x for x in np.unique(predictplus)])
+
+                # If there are insufficient colours then add grey to the list as many times as needed
+                while len(colors) < masks_bool.shape[0]:
+                   colors.append('#808080')
+
+                # maskedimg has the combined masks drawn on top of the underlying image
+                maskedimg = draw_segmentation_masks(seginput, torch.tensor(masks_bool,dtype=torch.bool), alpha=alpha, colors=colors).numpy()
+                # transpose it back to OpenCV style
+                maskedimg = np.transpose(maskedimg, [1, 2, 0])
+
+                # This combined mask is drawn on top of blank underlying image, for further analysis
+                mask = draw_segmentation_masks(blank, torch.tensor(masks_bool,dtype=torch.bool)).numpy()
+                # transpose it back to OpenCV style
+                mask = np.transpose(mask, [1, 2, 0])
+
+                # Further analysis...
+                gray = cv2.cvtColor(mask, cv2.COLOR_RGB2GRAY)
+        
+        vpsmethod = 'coalesced blobs' + (f' at 1/{args.hough_scale} resolution' if args.hough_scale > 1 else '')
+        blobvps = None
+        if cache is not None and not (args.blurfile or args.edgefile or args.linefile or args.blobfile or args.hough_compare):
+            vpskey = cache.key('vps', source=source, is_pano=is_pano, args=[ getattr(args, a) for a in vps_args ])
+            blobvps = cache.get(vpskey)
+        if blobvps is not None:
+            blobvps = np.array(blobvps, dtype=np.int64)
+        else:
+            with instr.stage('vps'):
+                blobvps = vanishing_points(gray, predict.shape[1], vlog, args.hough_scale)
+            if cache is not None and not args.hough_compare:
+                cache.put(vpskey, blobvps.tolist())
+        if args.hough_compare and args.hough_scale > 1:
+            with instr.stage('vps'):
+                fullvps = vanishing_points(gray, predict.shape[1], vlog)
+            # vanishing points found at reduced resolution within 2% of the
+            # width of one found at full resolution
+            tolerance = max(1, predict.shape[1] // 50)
+            agree = sum(1 for vp in blobvps if len(fullvps) > 0 and np.abs(fullvps - vp).min() <= tolerance)
+            vlog(f'Vanishing points at full resolution: {fullvps}; {agree} of {len(blobvps)} within {tolerance} columns.')
+            metrics['vanishing_points_full'] = fullvps.tolist()
+            metrics['vanishing_points_agreement'] = agree / len(blobvps) if len(blobvps) > 0 else None
+        vlog(f'Found vanishing points (using {vpsmethod}): {blobvps}.')
+        metrics['vanishing_points'] = blobvps.tolist()
 
         sqrw = 30
         sqry = 5
@@ -714,14 +830,14 @@ INSERT INTO image_geo (angle_deg, geo, image_id) SELECT {angle} AS angle_deg, {g
         if not args.no_houghtransform_road_centrelines:
             for b1 in blobvps:
                 color = (256,0,0)
-                draw.line((b1,0,b1,mask.shape[1]),width=6,fill=color)
+                draw.line((b1,0,b1,predictplus.shape[1]),width=6,fill=color)
                 #b2 = (b1 + predict.shape[1]//2) % predict.shape[1]
                 #draw.line((b2,0,b2,mask.shape[1]),width=1,fill=(128,0,0))
                 draw.rectangle((b1 - sqrw//2, sqry, b1 + sqrw//2, sqry+sqrw), outline=color, fill=color)
         if not args.no_segmentation_road_centrelines:
             for c1 in centres:
                 color = (0,256,0)
-                draw.line((c1,0,c1,mask.shape[1]),width=6,fill=color)
+                draw.line((c1,0,c1,predictplus.shape[1]),width=6,fill=color)
                 draw.ellipse((c1 - sqrw//2, sqry, c1 + sqrw//2, sqry+sqrw), outline=color, fill=color)
                 #c2 = (c1 + predict.shape[1]//2) % predict.shape[1]
                 #draw.line((c2,0,c2,mask.shape[1]),width=1,fill=(0,256,0))
@@ -737,11 +853,13 @@ INSERT INTO image_geo (angle_deg, geo, image_id) SELECT {angle} AS angle_deg, {g
             if type(args.maskfile) != str:
                 args.maskfile = Path(filename).with_stem(f'{origstem}_mask').with_suffix('.jpg')
             vlog(f'Writing mask image to "{args.maskfile}".')
-            img.save(args.maskfile)
+            with instr.stage('overlays'):
+                img.save(args.maskfile)
 
         if args.plusfile and rgbimgplus is not None:
             vlog(f'Writing "plus" image to "{args.plusfile}".')
-            Image.fromarray(rgbimgplus).save(args.plusfile)
+            with instr.stage('overlays'):
+                Image.fromarray(rgbimgplus).save(args.plusfile)
 
         if args.overfile and rgbimg is not None:
             if rgbimgplus is not None:
@@ -777,20 +895,223 @@ INSERT INTO image_geo (angle_deg, geo, image_id) SELECT {angle} AS angle_deg, {g
             if type(args.overfile) != str:
                 args.overfile = Path(filename).with_stem(f'{origstem}_over').with_suffix('.jpg')
             vlog(f'Writing centrelines over original image to "{args.overfile}".')
-            orig_as_pil_rgb.save(args.overfile)
+            with instr.stage('overlays'):
+                orig_as_pil_rgb.save(args.overfile)
 
-        if args.log:
-            logfp.close()
+        return finish()
+
+    def do_file_timed(filename, **kw):
+        with instr.item(filename):
+            return do_file(filename, **kw)
+
+    return SimpleNamespace(do_file=do_file_timed, cache=cache, instr=instr, vanishing_points=vanishing_points)
+
+def main():
+    args = parser.parse_args()
+    def vlog(s):
+        if args.verbose:
+            print(s)
+
+    with instrument.profiled(args.profile if args.jobs <= 1 else None, show=args.verbose):
+        run(args, vlog)
+
+def run(args, vlog):
+    proc = setup(args, vlog)
+    do_file = proc.do_file
+    cache = proc.cache
+    instr = proc.instr
 
     np_extensions = ['npz', 'npy']
-    if args.filelist:
-        with open(args.filename) as fp:
-            for name in fp:
-                p = Path(name.strip())
-                if p.is_file() and p.suffix.lower()[1:] in np_extensions:
-                    do_file(p)
+    # Every input read is recorded in --done-filelist, including those
+    # that are not processed at all (pipeline.py waits for each of them)
+    def record_done(task):
+        if args.done_filelist is not None:
+            with open(args.done_filelist, 'a') as fp:
+                fp.write(f'{task}\n')
+
+    if args.store is not None:
+        store = SegmStore(args.store)
+        vlog(f'Opened store "{args.store}" with {len(store)} entries.')
+        if args.filename is None:
+            instr.total = len(store)
+        def do_entry(key, predict, entry):
+            # outputs go alongside the original image, as with numpy files
+            filename = Path(entry['path']) if entry['path'] is not None else Path(key)
+            return do_file(filename, predict=predict, modelname=entry['modelname'], quality=entry.get('quality'),
+                           source=[ entry['shard'], entry['offset'], entry['time'] ])
+        def do_task(name):
+            # timed here as the label map is read from the store
+            with instr.item(name):
+                return do_store_task(name)
+        # Rereading the index on every missing key would list and read the
+        # whole store each time, so it is only reread if the last reread
+        # found new records (a writer is active, as in pipeline.py, whose
+        # inputs are only handed on once written), or after an interval
+        lastupdate = { 'time': 0, 'records': 0 }
+        def do_store_task(name):
+            key = Path(name).stem
+            if key not in store and (lastupdate['records'] > 0 or time() - lastupdate['time'] >= store_update_interval):
+                # perhaps added since (e.g. by torch_segm_images.py --store
+                # running at the same time, as in pipeline.py)
+                lastupdate['records'] = store.update()
+                lastupdate['time'] = time()
+            if key not in store:
+                vlog(f'Image ID {key} not found in store, skipping.')
+                return { 'filename': str(name), 'imgid': key, 'status': 'missing' }
+            with instr.stage('load'):
+                predict = store.get(key)
+            return do_entry(key, predict, store.entry(key))
+        def tasks():
+            if args.filename is None:
+                # in shard order, so that the shards are read sequentially
+                yield from sorted(store.keys(), key=lambda k: (store.entry(k)['shard'], store.entry(k)['offset']))
+            elif args.filelist:
+                with (nullcontext(sys.stdin) if args.filename == '-' else open(args.filename)) as fp:
+                    for name in fp:
+                        if name.strip(): yield name.strip()
+            else:
+                yield args.filename
+    elif args.filename is None and args.queue is None:
+        parser.error('FILENAME is required unless --store or --queue is given')
     else:
-        do_file(args.filename)
+        do_task = do_file
+        def tasks():
+            if args.filelist:
+                with (nullcontext(sys.stdin) if args.filename == '-' else open(args.filename)) as fp:
+                    for line in fp:
+                        # the name is passed on as given, so that it is
+                        # recorded in --done-filelist exactly as received
+                        name = line.strip()
+                        if not name: continue
+                        p = Path(name)
+                        if p.is_file() and p.suffix.lower()[1:] in np_extensions:
+                            yield name
+                        else:
+                            vlog(f'Skipping "{name}": not a numpy file.')
+                            record_done(name)
+            else:
+                yield args.filename
+
+    if args.filelist:
+        instr.total = instrument.count_lines(args.filename)
+
+    # With --queue, any inputs given are added to it, and the tasks are then
+    # taken from it instead
+    jobs = None
+    if args.queue is not None:
+        jobs = job_queue.from_args(args, 'process')
+        if args.filename is not None or args.store is not None:
+            vlog(f'Added {jobs.add(tasks())} label map(s) to the queue.')
+        instr.total = jobs.remaining()
+
+    # The error of the outcome of a task, for --queue
+    def task_error(r):
+        if r is not None and r.get('status') in ('failed', 'missing'):
+            return r.get('error', r['status'])
+        return None
+
+    if args.done_filelist is not None:
+        undone_task = do_task
+        def do_task(task):
+            try:
+                return undone_task(task)
+            finally:
+                record_done(task)
+
+    if args.jobs <= 1:
+        if jobs is not None:
+            job_queue.work(jobs, lambda item: task_error(do_task(item)), log=vlog)
+        else:
+            for task in tasks():
+                do_task(task)
+        if cache is not None:
+            vlog(f'Cache: {cache.hits} hit(s), {cache.misses} miss(es).')
+        instr.close()
+        return
+
+    # The worker processes are forked from this one after the tiles database
+    # has been loaded, so they share it (copy-on-write) instead of each task
+    # receiving a pickled copy; only the filenames are sent to the workers.
+    # Freezing the garbage collector's view of the existing objects stops it
+    # from touching (and therefore copying) their memory pages.
+    global pool_do_task, pool_instr, pool_profile
+    pool_do_task = do_task
+    pool_instr = instr
+    pool_profile = args.profile
+    gc.freeze()
+
+    if jobs is not None:
+        # Only as many jobs as the workers can soon start on are leased at
+        # a time (as the pool takes its tasks as fast as they come), in the
+        # order of the results
+        leases = threading.Semaphore(args.jobs * 2)
+        leased = deque()
+        def tasks():
+            while True:
+                leases.acquire()
+                item = jobs.lease()
+                if item is None:
+                    return
+                leased.append(item)
+                yield item
+
+    t1 = time()
+    results = []
+    with mp.get_context('fork').Pool(args.jobs, initializer=pool_init) as pool:
+        for r in pool.imap(pool_task, tasks(), chunksize=4 if jobs is None else 1):
+            # the workers hand over the times of their stages with each result
+            instr.merge(r.pop('stages', {}))
+            instr.finished()
+            results.append(r)
+            if jobs is not None:
+                item = leased.popleft()
+                error = task_error(r)
+                held = jobs.done(item) if error is None else jobs.failed(item, error)
+                if not held:
+                    vlog(f'Lease of "{item}" expired before it was finished; left to the process holding it now.')
+                leases.release()
+    t2 = time()
+    instr.close()
+
+    # Summary, in the same order as the input
+    counts = {}
+    for r in results:
+        counts[r['status']] = counts.get(r['status'], 0) + 1
+        centres = ' '.join(map(str, r.get('centres', [])))
+        print(f'{r["filename"]}\t{r["status"]}\tpano={r.get("is_pano", "")}\tcentres=[{centres}]' + (f'\t{r["error"]}' if 'error' in r else ''))
+    onecentre = sum(1 for r in results if len(r.get('centres', [])) == 1)
+    print(f'Processed {len(results)} file(s) with {args.jobs} jobs in {t2-t1:.2f}s ({len(results)/max(t2-t1, 1e-9):.1f} files/s): ' +
+          ', '.join(f'{n} {status}' for status, n in sorted(counts.items())) + f'; {onecentre} with exactly one road centre.')
+
+# Set by main() before forking the worker processes of --jobs
+pool_do_task = None
+pool_instr = None
+pool_profile = None
+pool_profiler = None
+
+def pool_init():
+    global pool_profiler
+    # progress is reported by the parent process, which keeps its own totals
+    pool_instr.reporting = False
+    pool_instr.take_totals()
+    if pool_profile is not None:
+        import cProfile
+        pool_profiler = cProfile.Profile()
+
+def pool_task(task):
+    if pool_profiler is not None:
+        pool_profiler.enable()
+    try:
+        r = pool_do_task(task)
+    except Exception as e:
+        r = { 'filename': str(task), 'status': 'failed', 'error': str(e) }
+    finally:
+        if pool_profiler is not None:
+            pool_profiler.disable()
+            # saved after every task, as the workers are not told when they are done
+            pool_profiler.dump_stats(f'{pool_profile}.{os.getpid()}')
+    # a copy, as r may be the cached result
+    return { **r, 'stages': pool_instr.take_totals() }
 
 if __name__=='__main__':
     main()
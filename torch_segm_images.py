@@ -15,21 +15,33 @@
 #
 #       http://www.apache.org/licenses/LICENSE-2.0
 import argparse
-from time import time
+import json
 import numpy as np
 from pathlib import Path
 import sys
+import os
 import re
-import torch
-from transformers import AutoImageProcessor, Mask2FormerForUniversalSegmentation
+import zlib
+import multiprocessing as mp
+from queue import Full
+import shlex
+from types import SimpleNamespace
+from contextlib import nullcontext
 from PIL import Image, ImageFile
+from segm_store import SegmStore, ShardWriter
+from image_metrics import prescreen_image, quality_accept
+from compact_images import working_copy_scale
+from discover import ListingIndex, scan_images
+import instrument
+import job_queue
 
 parser = argparse.ArgumentParser(prog='torch_segm_images.py', description='Run semantic segmentation using a Mask2Former model from HuggingFace (see https://huggingface.co/models?search=mask2former)')
-parser.add_argument('paths', metavar='PATH', nargs='+', help='Filenames or directories to process as input (either images or filelists, see -e and -F)')
+parser.add_argument('paths', metavar='PATH', nargs='*', help='Filenames or directories to process as input (either images or filelists, see -e and -F)')
 parser.add_argument('--verbose', '-v', action='store_true', default=False, help='Run in verbose mode')
-parser.add_argument('--filelist', '-F', action='store_true', default=False, help='Supplied paths are actually a list of image filenames, one per line, to process (does not work with -r)')
+parser.add_argument('--filelist', '-F', action='store_true', default=False, help='Supplied paths are actually a list of image filenames, one per line, to process (does not work with -r); a path of - reads the list from standard input, processing each file as soon as its name arrives')
 parser.add_argument('--output-filelist', metavar='FILE', default=None, help='Record the names of saved numpy output files in this given FILE.')
-parser.add_argument('--output-extension', metavar='EXT', default='npz', help='Output filename extension (default: npz)')
+parser.add_argument('--done-filelist', metavar='FILE', default=None, help='Record the name of each input image in FILE (exactly as given) once it has been dealt with, whatever the outcome (saved, skipped, rejected or failed), including any that are not processed at all (e.g. not image files, excluded or in another --shard)')
+parser.add_argument('--output-extension', metavar='EXT', default='npz', help='Output filename extension (default: npz); npy saves the label maps uncompressed (without the model name or pre-screen scores), which torch_process_segm.py memory-maps instead of reading them in whole')
 parser.add_argument('--recursive', '-r', default=False, action='store_true',help='Recursively search for images in the given directory and subdirectories (only if -F not enabled).')
 parser.add_argument('--image-extensions', '-e', metavar='EXT', nargs='+', default=['jpg', 'jpeg'], help='Image filename extensions to consider (default: jpg jpeg). Case-insensitive.')
 parser.add_argument('--no-detect-panoramic', default=False, action='store_true',help='Do not try to detect and correct panoramic images')
@@ -39,13 +51,149 @@ parser.add_argument('--overwrite', '-O', action='store_true', default=False, hel
 parser.add_argument('--dry-run', action='store_true', default=False, help='Do not actually write any output file')
 parser.add_argument('--modelname', metavar='MODEL', help='Use a specified model (from https://huggingface.co/models?search=mask2former)',default="facebook/mask2former-swin-large-cityscapes-semantic")
 parser.add_argument('--gpu', '-G', metavar='N', nargs='?', default=None, const=True, help='Use GPU (optionally specify which one)')
+parser.add_argument('--store', metavar='DIR', default=None, help='Pack label maps into a sharded store in DIR instead of writing one numpy file per image (see segm_store.py)')
+parser.add_argument('--store-shard-size', metavar='MB', default=1024, type=int, help='Start a new shard in the --store after it reaches this many megabytes (default: 1024)')
 parser.add_argument('--exclusion-pattern', '-E', metavar='REGEX', default='.*(npz|mask|out|_x[0-9]+).*', help='Regex to indicate which files should be excluded from processing.')
+parser.add_argument('--prescreen', action='store_true', default=False, help='Before segmentation, skip images that filter_output.py would reject on image quality alone (computed on a scaled-down decode of the image)')
+parser.add_argument('--prescreen-scale', metavar='N', default=4, type=int, help='Scale down images by up to this factor (1, 2, 4 or 8) when decoding them for --prescreen; 1 gives exactly the scores of torch_process_segm.py (default: 4)')
+parser.add_argument('--prescreen-file', metavar='FILE', default=None, help='With --prescreen, append the quality scores of every image (as JSON lines) to FILE')
+parser.add_argument('--contrast-threshold', '-C', metavar='NUMBER', default=0.35, type=float, help='With --prescreen, minimum contrast as in filter_output.py (default: 0.35)')
+parser.add_argument('--tone-mapping-floor', metavar='NUMBER', default=0.8, type=float, help='With --prescreen, tone mapping floor as in filter_output.py (default: 0.8)')
+parser.add_argument('--tile-size', metavar='PX', default=0, type=int, help='Segment (scaled-down) images larger than PX pixels in overlapping PXxPX tiles, to bound memory usage (default: 0, meaning never)')
+parser.add_argument('--tile-overlap', metavar='PX', default=64, type=int, help='With --tile-size, overlap between neighbouring tiles in pixels (default: 64)')
+parser.add_argument('--tile-batch', metavar='N', default=1, type=int, help='With --tile-size, number of tiles to run through the model at once (default: 1)')
+parser.add_argument('--tile-stitch', choices=['logits', 'labels'], default='logits', help='With --tile-size, combine overlapping tiles by blending class probabilities (logits; only held for one row of tiles at a time), or by keeping the most confident label (labels; uses less memory)')
+parser.add_argument('--workers', '-j', metavar='N', default=1, type=int, help='Run N worker processes, each with its own copy of the model and an equal share of the CPU cores (default: 1)')
+parser.add_argument('--pin-cpus', action='store_true', default=False, help='With --workers, pin each worker process to its own share (a contiguous block) of the CPU cores')
+parser.add_argument('--serve', metavar='SOCKET', default=None, help='Run as a server: load the model once and then process jobs submitted to the Unix socket SOCKET (see --server)')
+parser.add_argument('--server', metavar='SOCKET', default=None, help='Run as a client: submit the images to the server listening on SOCKET (see --serve) instead of loading the model')
+parser.add_argument('--server-status', action='store_true', default=False, help='With --server, print the queue depth and latency statistics of the server and exit')
+parser.add_argument('--send-data', action='store_true', default=False, help='With --server, send the image data itself rather than its filename, and check for existing output, pre-screen and save the returned label maps locally (as files, or into the --store)')
+parser.add_argument('--max-batch', metavar='N', default=8, type=int, help='With --serve, the maximum number of (equally-sized) images to run through the model at once (default: 8)')
+parser.add_argument('--batch-wait', metavar='MS', default=50, type=float, help='With --serve, how long to wait for further jobs to fill up a batch, in milliseconds (default: 50)')
+parser.add_argument('--process', metavar='ARGS', default=None, help='Also run torch_process_segm.py with the given arguments (as one string, e.g. "-T tiles.pkl -S sqldir --fast") on each label map as soon as it is produced, in this process, handing over the label map and the decoded image directly')
+parser.add_argument('--no-save', action='store_true', default=False, help='With --process, do not save the label maps, only the results of processing them')
+parser.add_argument('--no-process-existing', action='store_true', default=False, help='With --process, do not process the label maps that exist already (as files, or in the --store), only those produced by this run')
+parser.add_argument('--listing-index', metavar='FILE', default=None, help='With -r, keep the listing of each directory in FILE, and reuse it as long as the modification time of the directory is unchanged (see discover.py)')
+parser.add_argument('--scan-threads', metavar='N', default=1, type=int, help='With -r, list the directories in N parallel threads (default: 1)')
+parser.add_argument('--shard', metavar='K/N', default=None, help='Only process the K-th of N roughly equal shares of the input images (K=1..N), e.g. to spread one filelist across N machines')
+instrument.add_arguments(parser)
+job_queue.add_arguments(parser)
 
-def main():
-    args = parser.parse_args()
-    def vlog(s):
-        if args.verbose:
-            print(s)
+# Sets up the output of the label maps (as files, or into the --store) and
+# returns an object with the functions that deal with it: these do not need
+# the model, so that a --send-data client can save the label maps returned
+# by the server in just the same way. The label maps are recorded as those
+# of the model modelname, with npy_dtype the type of the labels saved as .npy
+# files; jobs is the job_queue to add the outputs to (if any).
+def setup_output(args, vlog, instr, modelname, npy_dtype, jobs=None):
+    store = None
+    if args.store is not None:
+        # records already present in the store (including those of other
+        # writers at the time of starting) are treated as existing output
+        store = SegmStore(args.store)
+        vlog(f'Using store "{args.store}" with {len(store)} existing entries.')
+        storewriter = ShardWriter(args.store, max_shard_bytes=args.store_shard_size*1024*1024)
+
+    def record_output(outputname, opts=args):
+        if opts.output_filelist is not None:
+            with open(opts.output_filelist, 'a') as fp:
+                fp.write(f'{outputname}\n')
+        if jobs is not None:
+            jobs.add([ outputname ], stage='process')
+
+    # If the output for inputpath already exists (and is not to be
+    # overwritten) then return its name, otherwise None.
+    def existing_output(inputpath, opts=args):
+        outputpath = inputpath.with_suffix(f'.{opts.output_extension}')
+        if store is not None:
+            if inputpath.stem in store and not opts.overwrite:
+                vlog(f'Skipping existing store entry "{inputpath.stem}".')
+                record_output(str(inputpath), opts)
+                return str(inputpath)
+        elif outputpath.exists() and not opts.overwrite:
+            try:
+                if outputpath.suffix == '.npy':
+                    # (only the header is read)
+                    np.load(outputpath, mmap_mode='r')
+                    vlog(f'Skipping existing output file "{outputpath}".')
+                    record_output(str(outputpath), opts)
+                    return str(outputpath)
+                with np.load(outputpath) as f:
+                    if 'predict' in f:
+                        vlog(f'Skipping existing output file "{outputpath}".')
+                        record_output(str(outputpath), opts)
+                        return str(outputpath)
+            except:
+                pass
+        return None
+
+    # Compute the quality scores of the image and return them, or return
+    # None if the image fails the criteria of filter_output.py.
+    def prescreen(inputpath, opts=args):
+        with instr.stage('prescreen') as s:
+            # a working copy (see compact_images.py) is already scaled down
+            scale = max(1, opts.prescreen_scale // working_copy_scale(inputpath))
+            contrast, tone_mapping = map(float, prescreen_image(inputpath, scale))
+            accept = bool(quality_accept(contrast, tone_mapping, opts.contrast_threshold, opts.tone_mapping_floor))
+        vlog(f'Pre-screen: contrast={contrast} tone-mapping={tone_mapping} accept?: {accept}. Runtime: {s.wall:.2f}s')
+        if opts.prescreen_file is not None:
+            with open(opts.prescreen_file, 'a') as fp:
+                fp.write(json.dumps({ 'path': str(inputpath), 'imgid': inputpath.stem, 'skimage_contrast': contrast,
+                                      'tone_mapping': tone_mapping, 'accept': accept }) + '\n')
+        return { 'skimage_contrast': contrast, 'tone_mapping': tone_mapping } if accept else None
+
+    # Save the label map (and the pre-screen quality scores, if any),
+    # returning the name of the output (or None if dry-run)
+    def save(inputpath, predict, opts=args, quality=None):
+        if opts.dry_run: return None
+        with instr.stage('save'):
+            return save_predict(inputpath, predict, opts, quality)
+
+    def save_predict(inputpath, predict, opts, quality):
+        if store is not None:
+            vlog(f'Saving predictions (shape={predict.shape}) into store entry "{inputpath.stem}".')
+            storewriter.put(inputpath.stem, predict, path=inputpath, modelname=modelname, quality=quality)
+            outputname = str(inputpath)
+        else:
+            outputpath = inputpath.with_suffix(f'.{opts.output_extension}')
+            vlog(f'Saving predictions (shape={predict.shape}) into "{outputpath}".')
+            if outputpath.suffix == '.npy':
+                # uncompressed, so in the smallest type that holds the labels
+                np.save(outputpath, predict.astype(npy_dtype, copy=False))
+            else:
+                np.savez_compressed(str(outputpath), predict=predict, modelname=modelname, **(quality or {}))
+            outputname = str(outputpath)
+        record_output(outputname, opts)
+        return outputname
+
+    # Record the failure of the segmentation of inputpath (in a .err file),
+    # or of the processing of its label map with --process (in a .process.err
+    # file)
+    def record_failure(inputpath, e, stage=None):
+        vlog(f'Failed{"" if stage is None else " to " + stage}: {e}. Skipping.')
+        errpath = inputpath.with_suffix('.err' if stage is None else f'.{stage}.err')
+        with open(errpath, 'w') as fp:
+            fp.write(str(e) + '\n')
+
+    def close():
+        if store is not None:
+            storewriter.close()
+
+    return SimpleNamespace(existing_output=existing_output, prescreen=prescreen, save=save, record_output=record_output,
+                           record_failure=record_failure, close=close, store=store)
+
+# Sets up the model (and output store, if any) and returns an object with
+# functions carrying out each step of processing an image file (do_file does
+# them all for a single file), and a function to call when finished. The
+# 'opts' parameters allow the caller to override the per-image arguments
+# (e.g. --overwrite, --scaledown-factor) for a particular image. The stages
+# are timed with instr (see instrument.py), if given.
+def setup(args, vlog, instr=None):
+    # imported here rather than at the top so that the --server client does
+    # not need to pay for loading them
+    import torch
+    from transformers import AutoImageProcessor, Mask2FormerForUniversalSegmentation
 
     if args.gpu is not None:
         vlog(f'Using GPU ({args.gpu}).')
@@ -59,104 +207,466 @@ def main():
         vlog('Using CPU.')
         device = torch.device('cpu')
 
+    if instr is None:
+        instr = instrument.from_args('torch_segm_images.py', args)
+
     vlog(f'device={device}')
     vlog(f'Loading model "{args.modelname}".')
     processor = AutoImageProcessor.from_pretrained(args.modelname)
     model = Mask2FormerForUniversalSegmentation.from_pretrained(args.modelname)
     model = model.to(device)
+    # type of the label maps saved as .npy files
+    npy_dtype = np.uint8 if len(model.config.id2label) <= 256 else np.int32
 
-    def do_file(inputpath):
-        try:
-            inputfilename = inputpath.name
-            outputpath = inputpath.with_suffix(f'.{args.output_extension}')
-            if outputpath.exists() and not args.overwrite:
-                try:
-                    with np.load(outputpath) as f:
-                        if 'predict' in f:
-                            vlog(f'Skipping existing output file "{outputpath}".')
-                            if args.output_filelist is not None:
-                                with open(args.output_filelist, 'a') as fp:
-                                    fp.write(f'{str(outputpath)}\n')
-                            return
-                except:
-                    pass
-            vlog(f'Loading image "{inputpath}"...')
-            t1 = time()
-            img = Image.open(inputpath)
-
-            vlog(f'Image size={img.size[0]}x{img.size[1]}.')
-            if not args.no_detect_panoramic and img.size[0] >= img.size[1]*2:
+    analyser = None
+    if args.process is not None:
+        import torch_process_segm
+        from torch_process_segm import DecodedImage
+        from result_cache import file_identity
+        procargs = torch_process_segm.parser.parse_args(shlex.split(args.process))
+        analyser = torch_process_segm.setup(procargs, vlog, instr=instr)
+
+    # with --queue, the label maps are queued up for torch_process_segm.py
+    jobs = job_queue.from_args(args, 'segment') if getattr(args, 'queue', None) is not None else None
+    out = setup_output(args, vlog, instr, args.modelname, npy_dtype, jobs=jobs)
+    existing_output, prescreen, save, record_failure = out.existing_output, out.prescreen, out.save, out.record_failure
+    store = out.store
+
+    # Load, crop and scale an image, optionally from an already-open file fp,
+    # or an already-open image img
+    def load_image(inputpath, opts=args, fp=None, img=None):
+        vlog(f'Loading image "{inputpath}"...')
+        decodetime = 0
+        if img is None:
+            with instr.stage('decode') as s1:
+                img = Image.open(fp or inputpath)
+                # (PIL otherwise decodes lazily, within the resize)
+                img.load()
+            decodetime = s1.wall
+
+        vlog(f'Image size={img.size[0]}x{img.size[1]}.')
+        with instr.stage('resize') as s2:
+            is_pano = not opts.no_detect_panoramic and img.size[0] >= img.size[1]*2
+            if is_pano:
                 img = img.crop((0, 0, img.size[0], img.size[1]*3//4))
                 vlog(f'Assuming panoramic image, cropping to {img.size[0]}x{img.size[1]}.')
 
-            if args.scaledown_factor != 1:
-                img = img.resize(( int(img.size[0]//args.scaledown_factor),
-                                   int(img.size[1]//args.scaledown_factor) ),
-                                 resample=args.scaledown_interp)
+            # a working copy (see compact_images.py) is already scaled down,
+            # and is scaled down less to give a label map of the same size
+            factor = opts.scaledown_factor / working_copy_scale(img)
+            if factor != 1:
+                img = img.resize(( int(img.size[0]//factor),
+                                   int(img.size[1]//factor) ),
+                                 resample=opts.scaledown_interp)
                 vlog(f'Scaling down image to {img.size[0]}x{img.size[1]}.')
 
-            t2 = time()
-            vlog(f'Loading complete. Runtime: {(t2-t1):.2f}s')
-
-            vlog('Running model...')
-            t1 = time()
-
-            # Preprocess the image using the image processor
-            inputs = processor(images=img, return_tensors="pt")
-
-            # Perform a forward pass through the model to obtain the segmentation
-            with torch.no_grad():
-                # Check if a GPU is available
-                if args.gpu is not None and torch.cuda.is_available():
-                    # Move the inputs to the GPU
-                    inputs = {k: v.to('cuda') for k, v in inputs.items()}
-                    # Perform the forward pass through the model
-                    outputs = model(**inputs)
-                    # Post-process the semantic segmentation outputs using the processor and move the results to CPU
-                    segmentation = processor.post_process_semantic_segmentation(outputs, target_sizes=[img.size[::-1]])[0].to('cpu')
+        # panoramic images wrap around horizontally (see segment_tiled)
+        img.info['panoramic'] = is_pano
+
+        vlog(f'Loading complete. Runtime: {(decodetime+s2.wall):.2f}s')
+        return img
+
+    # Run the model on a list of images, returning a list of label maps. The
+    # image processor pads the images of a batch to the same size, so batched
+    # images should all have the same size to get the same results as one by one.
+    # Images larger than --tile-size are segmented tile by tile instead.
+    def segment(imgs):
+        if args.tile_size and any(max(img.size) > args.tile_size for img in imgs):
+            return [ segment_tiled(img) for img in imgs ]
+        return segment_whole(imgs)
+
+    def segment_whole(imgs):
+        # Preprocess the image using the image processor
+        inputs = processor(images=imgs, return_tensors="pt")
+
+        # Perform a forward pass through the model to obtain the segmentation
+        with torch.no_grad():
+            # Check if a GPU is available
+            if args.gpu is not None and torch.cuda.is_available():
+                # Move the inputs to the GPU
+                inputs = {k: v.to('cuda') for k, v in inputs.items()}
+                # Perform the forward pass through the model
+                outputs = model(**inputs)
+                # Post-process the semantic segmentation outputs using the processor and move the results to CPU
+                segmentations = [ s.to('cpu') for s in processor.post_process_semantic_segmentation(outputs, target_sizes=[img.size[::-1] for img in imgs]) ]
+            else:
+                # Perform the forward pass through the model
+                outputs = model(**inputs)
+                # Post-process the semantic segmentation outputs using the processor
+                segmentations = processor.post_process_semantic_segmentation(outputs, target_sizes=[img.size[::-1] for img in imgs])
+
+        return [ s.numpy() for s in segmentations ]
+
+    # Class probabilities (C x H x W) for each of a list of equally-sized
+    # images, computed as in processor.post_process_semantic_segmentation but
+    # without the final argmax: the class and mask probabilities are combined
+    # at the resolution of the masks (scaled to 384x384 first, as there), and
+    # only then scaled to the size of the images.
+    def class_probabilities(imgs):
+        inputs = processor(images=imgs, return_tensors="pt")
+        with torch.no_grad():
+            inputs = {k: v.to(device) for k, v in inputs.items()}
+            outputs = model(**inputs)
+            # the last class is the 'null' class
+            class_probs = outputs.class_queries_logits.softmax(dim=-1)[..., :-1]
+            mask_probs = torch.nn.functional.interpolate(outputs.masks_queries_logits, size=(384, 384),
+                                                         mode='bilinear', align_corners=False).sigmoid()
+            probs = torch.einsum('bqc,bqhw->bchw', class_probs, mask_probs)
+            return torch.nn.functional.interpolate(probs, size=imgs[0].size[::-1], mode='bilinear', align_corners=False).to('cpu').numpy()
+
+    # Sliding-window segmentation of a large image, in overlapping square
+    # tiles of --tile-size pixels, --tile-batch tiles at a time. Overlapping
+    # tiles are blended with weights that ramp down towards the tile edges.
+    # Panoramic images are treated as wrapping around horizontally, so that
+    # tiles crossing the righthand edge continue from the lefthand edge, and
+    # the segmentation is consistent across that seam.
+    def segment_tiled(img):
+        imgw, imgh = img.size
+        wrap = img.info.get('panoramic', False)
+        rgb = np.asarray(img.convert('RGB'))
+        tilew = min(args.tile_size, imgw)
+        tileh = min(args.tile_size, imgh)
+        overlap = min(args.tile_overlap, args.tile_size // 2)
+
+        def positions(length, tilelen, wrap):
+            stride = max(1, tilelen - overlap)
+            if wrap:
+                return list(range(0, length, stride)) if tilelen < length else [0]
+            ps = list(range(0, max(1, length - tilelen + 1), stride))
+            if ps[-1] != length - tilelen: ps.append(length - tilelen)
+            return ps
+        xs = positions(imgw, tilew, wrap)
+        ys = positions(imgh, tileh, False)
+
+        # blending weights: linear ramps across the overlapping margins
+        def ramp(n):
+            r = np.minimum(np.arange(1, n + 1), np.arange(n, 0, -1)) / (overlap + 1)
+            return np.minimum(1.0, r).astype(np.float32)
+        weight = np.outer(ramp(tileh), ramp(tilew))
+
+        labels = np.zeros((imgh, imgw), dtype=np.int64)
+        if args.tile_stitch == 'logits':
+            # The class probabilities are only accumulated for the band of
+            # rows acclo..acclo+tileh-1 covered by the current row of tiles:
+            # the rows above the next row of tiles are complete by then, and
+            # are reduced to labels, so that the memory used is bounded by
+            # the tile size rather than the image size.
+            acc = None
+            acclo = 0
+            def next_band(y):
+                nonlocal acclo
+                n = y - acclo
+                labels[acclo:y] = acc[:, :n].argmax(axis=0)
+                # the rows still to be covered by the next row of tiles
+                acc[:, :tileh - n] = acc[:, n:]
+                acc[:, tileh - n:] = 0
+                acclo = y
+        else:
+            best = np.full((imgh, imgw), -1.0, dtype=np.float32)
+
+        tiles = [ (x, y) for y in ys for x in xs ]
+        vlog(f'Segmenting {len(tiles)} tiles of {tilew}x{tileh} (overlap {overlap}, wrap={wrap}).')
+        for i in range(0, len(tiles), args.tile_batch):
+            batch = tiles[i:i + args.tile_batch]
+            # column indices modulo the image width handle the wrap-around
+            cols = [ (x + np.arange(tilew)) % imgw for (x, y) in batch ]
+            probs = class_probabilities([ Image.fromarray(rgb[y:y + tileh][:, c]) for (x, y), c in zip(batch, cols) ])
+            for ((x, y), c, p) in zip(batch, cols, probs):
+                if args.tile_stitch == 'logits':
+                    if acc is None:
+                        acc = np.zeros((p.shape[0], tileh, imgw), dtype=np.float32)
+                    elif y != acclo:
+                        next_band(y)
+                    acc[:, :, c] += p * weight
                 else:
-                    # Perform the forward pass through the model
-                    outputs = model(**inputs)
-                    # Post-process the semantic segmentation outputs using the processor
-                    segmentation = processor.post_process_semantic_segmentation(outputs, target_sizes=[img.size[::-1]])[0]
-
-            predict = segmentation.numpy()
-
-            t2 = time()
-            vlog(f'Complete. Runtime: {(t2-t1):.2f}s.')
-
-            if not args.dry_run:
-                vlog(f'Saving predictions (shape={predict.shape}) into "{outputpath}".')
-                np.savez_compressed(str(outputpath), predict=predict, modelname=args.modelname)
-                if args.output_filelist is not None:
-                    with open(args.output_filelist, 'a') as fp:
-                        fp.write(f'{str(outputpath)}\n')
-        except Exception as e:
-            vlog(f'Failed: {e}. Skipping.')
-            errpath = inputpath.with_suffix(f'.err')
-            with open(errpath, 'w') as fp:
-                fp.write(str(e) + '\n')
+                    conf = p.max(axis=0) * weight
+                    better = conf > best[y:y + tileh, c]
+                    best[y:y + tileh, c] = np.where(better, conf, best[y:y + tileh, c])
+                    labels[y:y + tileh, c] = np.where(better, p.argmax(axis=0), labels[y:y + tileh, c])
+        if args.tile_stitch == 'logits':
+            labels[acclo:] = acc[:, :imgh - acclo].argmax(axis=0)
+        return labels
+
+    # With --process: process the label map of inputpath, whose image has
+    # already been decoded into original (a PIL image)
+    def process(inputpath, predict, original, quality):
+        vlog(f'Processing the label map of "{inputpath}".')
+        with instr.stage('process') as s:
+            process_predict(inputpath, predict, original, quality)
+        vlog(f'Processing complete. Runtime: {s.wall:.2f}s.')
+
+    def process_predict(inputpath, predict, original, quality):
+        rgb = np.asarray(original if original.mode == 'RGB' else original.convert('RGB'))
+        # the label map is identified by the image and the options that it depends on
+        source = [ file_identity(inputpath), { k: getattr(args, k) for k in segm_args } ]
+        analyser.do_file(inputpath, predict=predict, modelname=args.modelname, quality=quality, source=source,
+                          image=DecodedImage.from_rgb(inputpath, rgb))
 
+    # With --process: process the label map of inputpath saved before (as
+    # output, the name returned by existing_output)
+    def process_existing(inputpath, output):
+        vlog(f'Processing the existing label map of "{inputpath}".')
+        if store is None:
+            analyser.do_file(output)
+            return
+        key = inputpath.stem
+        with instr.stage('load'):
+            predict = store.get(key)
+        entry = store.entry(key)
+        analyser.do_file(inputpath, predict=predict, modelname=entry['modelname'], quality=entry.get('quality'),
+                         source=[ entry['shard'], entry['offset'], entry['time'] ])
+
+    # Returns the error if the image could not be dealt with, otherwise None.
+    # name: the input as given, for --done-filelist (default: inputpath)
+    def do_file(inputpath, name=None):
+        with instr.item(inputpath):
+            return do_file_stages(inputpath, inputpath if name is None else name)
+
+    def do_file_stages(inputpath, name):
+        try:
+            try:
+                processing = segment_file(inputpath)
+            except Exception as e:
+                record_failure(inputpath, e)
+                return str(e)
+            if processing is None:
+                return
+            try:
+                processing()
+            except Exception as e:
+                record_failure(inputpath, e, stage='process')
+                return f'process: {e}'
+        finally:
+            record_done(args, name)
+
+    # Segment the image of inputpath, unless its label map exists already,
+    # and return a function processing the label map with --process (None
+    # if there is nothing to process)
+    def segment_file(inputpath):
+        output = existing_output(inputpath)
+        if output is not None:
+            if analyser is None or args.no_process_existing:
+                return None
+            return lambda: process_existing(inputpath, output)
+        quality = None
+        if args.prescreen:
+            quality = prescreen(inputpath)
+            if quality is None:
+                vlog(f'Skipping "{inputpath}": rejected by pre-screen.')
+                return None
+        # decoded only once, for both the model and the processing
+        with instr.stage('decode'):
+            original = Image.open(inputpath)
+            original.load()
+        img = load_image(inputpath, img=original)
+
+        vlog('Running model...')
+        with instr.stage('inference') as s:
+            [predict] = segment([img])
+        vlog(f'Complete. Runtime: {s.wall:.2f}s.')
+
+        if not args.no_save:
+            save(inputpath, predict, quality=quality)
+        if analyser is None:
+            return None
+        return lambda: process(inputpath, predict, original, quality)
+
+    def finish():
+        out.close()
+        instr.close()
+
+    return SimpleNamespace(existing_output=existing_output, prescreen=prescreen, load_image=load_image, segment=segment,
+                           class_probabilities=class_probabilities, save=save, record_failure=record_failure, do_file=do_file,
+                           finish=finish, instr=instr, jobs=jobs, num_labels=len(model.config.id2label))
+
+# Options that a label map depends on (for the --cache-dir of --process)
+segm_args = [ 'modelname', 'no_detect_panoramic', 'scaledown_factor', 'scaledown_interp', 'tile_size', 'tile_overlap', 'tile_stitch' ]
+
+# Parse the --shard K/N argument into a pair of integers (K, N)
+def parse_shard(shard):
+    try:
+        k, n = map(int, shard.split('/'))
+    except ValueError:
+        parser.error(f'--shard must be of the form K/N, not "{shard}"')
+    if n < 1 or k < 1 or k > n:
+        parser.error(f'--shard K/N requires 1 <= K <= N, not "{shard}"')
+    return k, n
+
+# Record the name of an input in the --done-filelist, if any
+def record_done(args, name):
+    if args.done_filelist is not None:
+        with open(args.done_filelist, 'a') as fp:
+            fp.write(f'{name}\n')
+
+# Yield the paths of all image files to process, according to the arguments
+def iter_inputs(args):
+    for _, p in iter_input_names(args):
+        yield p
+
+# As iter_inputs, but yield (name, path) pairs, where name is the input as
+# given (the line of the filelist, or the path found in a directory), and
+# pass the names in the filelists that are not to be processed (e.g. not
+# image files, excluded, or in another --shard) to rejected, if given
+def iter_input_names(args, rejected=None):
     image_extensions = [ e.lower() for e in args.image_extensions ]
     exclude = re.compile(args.exclusion_pattern)
+    if args.shard is not None:
+        shardk, shardn = parse_shard(args.shard)
+    # Images are assigned to shards by a hash of their filename, so that the
+    # assignment does not depend upon the order of the filelist or directory
+    # listing seen by each machine.
+    def in_shard(p):
+        return args.shard is None or zlib.crc32(p.name.encode()) % shardn == shardk - 1
     if args.filelist:
         for filelist in args.paths:
-            with open(filelist) as fp:
-                for name in fp:
-                    p = Path(name.strip())
-                    if p.is_file() and p.suffix.lower()[1:] in image_extensions:
-                        if not exclude.match(p.name):
-                            do_file(p)
+            with (nullcontext(sys.stdin) if filelist == '-' else open(filelist)) as fp:
+                for line in fp:
+                    name = line.strip()
+                    if not name: continue
+                    p = Path(name)
+                    if p.is_file() and p.suffix.lower()[1:] in image_extensions and not exclude.match(p.name) and in_shard(p):
+                        yield name, p
+                    elif rejected is not None:
+                        rejected(name)
     else:
-        def recur(paths):
-            for name in paths:
-                p = Path(name)
-                if p.is_file() and p.suffix.lower()[1:] in image_extensions:
-                    if not exclude.match(p.name):
-                        do_file(p)
-                elif args.recursive and p.is_dir():
-                    recur(p.iterdir())
-        recur(args.paths)
+        # (options only of this script, hence the defaults for the others)
+        indexfile = getattr(args, 'listing_index', None)
+        index = ListingIndex(indexfile, image_extensions) if indexfile is not None else None
+        for p in scan_images(args.paths, image_extensions, exclude, recursive=args.recursive, index=index,
+                             threads=getattr(args, 'scan_threads', 1)):
+            if in_shard(p):
+                yield str(p), p
+
+# Worker process for --workers mode: load the model once, then process paths
+# from the queue until receiving None.
+def worker(args, workerno, cpus, queue):
+    def vlog(s):
+        if args.verbose:
+            print(f'[worker {workerno}] {s}', flush=True)
+    import torch
+    if args.pin_cpus:
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(len(cpus))
+    vlog(f'Using {len(cpus)} threads{" pinned to CPUs " + str(sorted(cpus)) if args.pin_cpus else ""}.')
+    # each worker reports its own progress
+    instr = instrument.from_args('torch_segm_images.py', args, log=lambda s: print(f'[worker {workerno}] {s}', flush=True))
+    with instrument.profiled(f'{args.profile}.{workerno}' if args.profile else None):
+        seg = setup(args, vlog, instr=instr)
+        if seg.jobs is not None:
+            job_queue.work(seg.jobs, lambda item: seg.do_file(Path(item), name=item), log=vlog)
+        else:
+            while (item := queue.get()) is not None:
+                name, p = item
+                seg.do_file(p, name=name)
+        seg.finish()
+
+def main():
+    args = parser.parse_args()
+    def vlog(s):
+        if args.verbose:
+            print(s)
+
+    with instrument.profiled(args.profile, show=args.verbose):
+        run(args, vlog)
+
+def run(args, vlog):
+    if args.no_save and args.process is None:
+        parser.error('--no-save requires --process')
+    if args.no_process_existing and args.process is None:
+        parser.error('--no-process-existing requires --process')
+    if args.process is not None and (args.serve is not None or args.server is not None):
+        parser.error('--process cannot be used with --serve or --server')
+    if args.queue is not None and (args.serve is not None or args.server is not None):
+        parser.error('--queue cannot be used with --serve or --server')
+
+    if args.serve is not None:
+        from segm_server import serve
+        serve(args, vlog, setup(args, vlog))
+        return
+    if not args.paths and not args.server_status and args.queue is None:
+        parser.error('at least one PATH is required (except with --serve or --queue)')
+
+    # The inputs in the filelists that are not processed are recorded as
+    # done straight away (pipeline.py waits for every input it hands out)
+    def rejected(name):
+        vlog(f'Skipping "{name}": not an image file to process.')
+        record_done(args, name)
+    def inputs():
+        return iter_input_names(args, rejected=rejected)
+
+    if args.server is not None:
+        from segm_server import client
+        client(args, vlog, inputs())
+        return
+
+    if args.workers <= 1:
+        # the number of images is known in advance if they are listed in files
+        total = None
+        if args.filelist and args.shard is None and '-' not in args.paths:
+            total = sum(instrument.count_lines(filelist) or 0 for filelist in args.paths)
+        seg = setup(args, vlog, instr=instrument.from_args('torch_segm_images.py', args, total=total))
+        if seg.jobs is not None:
+            if args.paths:
+                vlog(f'Added {seg.jobs.add(p for _, p in inputs())} image(s) to the queue.')
+            seg.instr.total = seg.jobs.remaining()
+            job_queue.work(seg.jobs, lambda item: seg.do_file(Path(item), name=item), log=vlog)
+        else:
+            for name, p in inputs():
+                seg.do_file(p, name=name)
+        seg.finish()
+        return
+
+    # Divide the available cores as evenly as possible between the workers
+    cpus = sorted(os.sched_getaffinity(0))
+    if len(cpus) < args.workers:
+        vlog(f'Warning: only {len(cpus)} CPUs are available for {args.workers} workers.')
+    # in contiguous blocks, so that each worker keeps to neighbouring cores
+    # (sharing their caches)
+    cpushares = [ set(cpus[i * len(cpus) // args.workers:(i + 1) * len(cpus) // args.workers]) or set(cpus)
+                  for i in range(args.workers) ]
+    if args.queue is not None and args.paths:
+        vlog(f'Added {job_queue.from_args(args, "segment").add(p for _, p in inputs())} image(s) to the queue.')
+    vlog(f'Starting {args.workers} worker processes.')
+    # 'spawn' so that each worker initialises torch afresh (threads do not survive fork)
+    ctx = mp.get_context('spawn')
+    queue = ctx.Queue(maxsize=args.workers * 4)
+    procs = [ ctx.Process(target=worker, args=(args, i, cpushares[i], queue)) for i in range(args.workers) ]
+    for proc in procs:
+        proc.start()
+
+    # Workers that have died (e.g. failing to load the model, or killed when
+    # out of memory), leaving their share of the queue to be taken
+    def dead_workers():
+        return [ (i, proc.exitcode) for i, proc in enumerate(procs) if proc.exitcode not in (None, 0) ]
+    def abort(dead):
+        print('Worker process(es) exited unexpectedly: ' + ', '.join(f'{i} (status {code})' for i, code in dead) +
+              '; stopping.', file=sys.stderr)
+        for proc in procs:
+            proc.terminate()
+        # (without waiting for the items still buffered for the queue)
+        queue.cancel_join_thread()
+        sys.exit(1)
+    # Put an item on the queue, waiting for space while all the workers live
+    def put(item):
+        while True:
+            if dead := dead_workers():
+                abort(dead)
+            try:
+                queue.put(item, timeout=1)
+                return
+            except Full:
+                pass
+
+    # (with --queue, the workers take their images from it themselves)
+    if args.queue is None:
+        for item in inputs():
+            put(item)
+    for _ in procs:
+        put(None)
+    for proc in procs:
+        proc.join()
+    if dead := dead_workers():
+        abort(dead)
 
 if __name__=='__main__':
     main()